@@ -6,7 +6,7 @@ import logging
 from flask import abort, Blueprint, jsonify, request
 from werkzeug import exceptions
 
-from .. import auth, log
+from .. import auth, collections, log
 from ..data import service
 from ..documents import bp as documents
 
@@ -114,10 +114,8 @@ def is_ner_annotation(ann):
 def check_overlapping_annotations(document, ner_annotations):
     ner_annotations.sort(key = lambda x: x[0])
 
-    resp = service.get("collections/" + document["collection_id"])
-    if not resp.ok:
-        abort(resp.status_code)
-    collection = resp.json()
+    # already fetched (and cached) by the permission check
+    collection = collections.get_collection_permissions(document["collection_id"])
 
     # if allow_overlapping_ner_annotations is false, check them
     if "configuration" in collection and CONFIG_ALLOW_OVERLAPPING_NER_ANNOTATIONS in collection["configuration"] and not collection["configuration"][CONFIG_ALLOW_OVERLAPPING_NER_ANNOTATIONS]:
@@ -8,23 +8,56 @@ import os
 import random
 import traceback
 import unicodedata
+import zlib
 
-from flask import abort, Blueprint, current_app, jsonify, request, safe_join, send_file, send_from_directory
+from flask import abort, Blueprint, current_app, jsonify, request, Response, safe_join, send_file, send_from_directory, stream_with_context
 from werkzeug import exceptions
 
 from .. import auth, log
-from ..data import service
+from ..data import cache, parsed, service
 
 bp = Blueprint("collections", __name__, url_prefix = "/collections")
 logger = logging.getLogger(__name__)
 
+# Short-lived process cache of collection permission projections, keyed by collection id
+_COLLECTION_PERMISSIONS_CACHE = cache.TTLCache()
+
 def _collection_user_can_projection():
+    # configuration is included so annotation saving can check it without refetching the collection
     return {"projection": json.dumps({
         "creator_id": 1,
         "annotators": 1,
-        "viewers": 1
+        "viewers": 1,
+        "configuration": 1
     })}
 
+def get_collection_permissions(collection_id):
+    """
+    Return the permission projection ('creator_id', 'annotators', 'viewers', 'configuration') of the collection
+    matching the provided collection id.  The projection is memoized for the current request and cached for a short
+    time across requests.
+    :param collection_id: str
+    :return: dict
+    """
+    memo = cache.request_memo("collection_permissions")
+    if collection_id in memo:
+        return memo[collection_id]
+    collection = _COLLECTION_PERMISSIONS_CACHE.get(collection_id)
+    if collection is None:
+        collection = service.get_item_by_id("/collections", collection_id, _collection_user_can_projection())
+        _COLLECTION_PERMISSIONS_CACHE.set(collection_id, collection)
+    memo[collection_id] = collection
+    return collection
+
+def invalidate_collection_permissions(collection_id):
+    """
+    Drop any cached permission projection for the collection matching the provided collection id.
+    Only this process' cache is invalidated; other worker processes keep theirs for up to AUTH_CACHE_TTL seconds.
+    :param collection_id: str
+    """
+    _COLLECTION_PERMISSIONS_CACHE.invalidate(collection_id)
+    cache.request_memo("collection_permissions").pop(collection_id, None)
+
 def _collection_user_can(collection, annotate):
     user_id = auth.get_logged_in_user()["id"]
     if annotate and not auth.is_flat():
@@ -47,19 +80,19 @@ def user_can_modify_document_metadata(collection):
     return user_can_view(collection)
 
 def user_can_annotate_by_id(collection_id):
-    collection = service.get_item_by_id("/collections", collection_id, _collection_user_can_projection())
+    collection = get_collection_permissions(collection_id)
     return _collection_user_can(collection, annotate = True)
 
 def user_can_view_by_id(collection_id):
-    collection = service.get_item_by_id("/collections", collection_id, _collection_user_can_projection())
+    collection = get_collection_permissions(collection_id)
     return _collection_user_can(collection, annotate = False)
 
 def user_can_add_documents_or_images_by_id(collection_id):
-    collection = service.get_item_by_id("/collections", collection_id, _collection_user_can_projection())
+    collection = get_collection_permissions(collection_id)
     return user_can_add_documents_or_images(collection)
 
 def user_can_modify_document_metadata_by_id(collection_id):
-    collection = service.get_item_by_id("/collections", collection_id, _collection_user_can_projection())
+    collection = get_collection_permissions(collection_id)
     return user_can_modify_document_metadata(collection)
 
 
@@ -130,6 +163,7 @@ def archive_or_unarchive_collection(collection_id, archive):
     headers = {"If-Match": collection["_etag"]}
     service.remove_nonupdatable_fields(collection)
     resp = service.put(["collections", collection_id], json = collection, headers = headers)
+    invalidate_collection_permissions(collection_id)
     if not resp.ok:
         abort(resp.status_code)
     return get_collection(collection_id)
@@ -189,6 +223,9 @@ def download_collection(collection_id):
     include_annotations = flag("include_annotations")
     include_annotation_latest_version_only = flag("include_annotation_latest_version_only")
     as_file = flag("as_file")
+    export_format = request.args.get("format", "json")
+    if export_format not in ["json", "ndjson", "ndjson.gz"]:
+        raise exceptions.BadRequest("Unknown format {}".format(export_format))
 
     if include_collection_metadata:
         col = dict(collection)
@@ -199,6 +236,11 @@ def download_collection(collection_id):
             "_id": collection["_id"]
         }
 
+    if export_format != "json":
+        return _download_collection_ndjson(collection_id, data, include_document_metadata, include_document_text,
+                                           include_annotations, include_annotation_latest_version_only, as_file,
+                                           export_format == "ndjson.gz")
+
     params = service.where_params({
         "collection_id": collection_id
     })
@@ -261,6 +303,70 @@ def download_collection(collection_id):
     else:
         return jsonify(data)
 
+def _annotation_versions(document):
+    """
+    Return every version of a document's annotations, as get_all_versions_of_item_by_id would, from a document of
+    eve's documents_with_annotations with versions=1.
+    :param document: dict
+    :return: list of dicts
+    """
+    versions = {}
+    for version in document.pop("annotation_versions", []):
+        versions.setdefault(version.pop("_id_document"), []).append(version)
+    annotations = []
+    for annotation in document["annotations"]:
+        latest_version = annotation.get("_version", 1)
+        # annotations saved before versioning was turned on have no stored versions
+        for version in sorted(versions.get(annotation["_id"]) or [annotation], key = lambda v: v.get("_version", 1)):
+            annotations.append(dict(version, _id = annotation["_id"], _version = version.get("_version", 1),
+                                    _latest_version = latest_version))
+    return annotations
+
+def _download_collection_ndjson(collection_id, header, include_document_metadata, include_document_text,
+                                include_annotations, latest_version_only, as_file, compress):
+    """
+    Stream a collection export as newline-delimited JSON: the first line is the collection (without documents) and
+    every following line is one document, with its annotations if requested.  The documents and their annotations
+    (and the annotations' versions, for the full history) are streamed from eve's documents_with_annotations, which
+    joins them in mongo, so memory use does not depend on the size of the collection and only one request is made.
+    :return: Response
+    """
+    params = {
+        "details": int(include_document_metadata),
+        "metadata": int(include_document_metadata),
+        "text": int(include_document_text),
+        "annotations": int(include_annotations),
+        "versions": int(not latest_version_only)
+    }
+
+    def lines():
+        yield json.dumps(header).encode() + b"\n"
+        for document in service.iter_ndjson(["collections", collection_id, "documents_with_annotations"], params):
+            if not include_document_metadata:
+                document.pop("overlap", None)
+            if include_annotations and not latest_version_only:
+                document["annotations"] = _annotation_versions(document)
+            service.remove_eve_fields(document)
+            yield json.dumps(document).encode() + b"\n"
+
+    def gzipped(data):
+        compressor = zlib.compressobj(wbits = 16 + zlib.MAX_WBITS)
+        for chunk in data:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    body = gzipped(lines()) if compress else lines()
+    filename = "collection_{}.ndjson".format(collection_id)
+    headers = {}
+    if compress:
+        filename += ".gz"
+    if as_file:
+        headers["Content-Disposition"] = "attachment; filename={}".format(filename)
+    return Response(stream_with_context(body), headers = headers,
+                    mimetype = "application/gzip" if compress else "application/x-ndjson")
+
 def get_doc_and_overlap_ids(collection_id):
     """
     Return lists of ids for overlapping and non-overlapping documents for the collection matching the provided
@@ -305,6 +411,7 @@ def add_annotator_to_collection(collection_id):
             }
         headers = {'Content-Type': 'application/json', 'If-Match': collection["_etag"]}
         resp = service.patch(["collections", collection["_id"]], json=to_patch, headers=headers)
+        invalidate_collection_permissions(collection_id)
         if not resp.ok:
             abort(resp.status_code, resp.content)
         return service.convert_response(resp)
@@ -331,6 +438,7 @@ def add_viewer_to_collection(collection_id):
         }
         headers = {'Content-Type': 'application/json', 'If-Match': collection["_etag"]}
         resp = service.patch(["collections", collection["_id"]], json=to_patch, headers=headers)
+        invalidate_collection_permissions(collection_id)
         if not resp.ok:
             abort(resp.status_code, resp.content)
         return service.convert_response(resp)
@@ -543,6 +651,7 @@ def create_collection():
                 abort(400, "Unable to create documents")
         doc_ids = [obj["_id"] for obj in r["_items"]]
         logger.info("Added docs:", doc_ids)
+        parsed.tokenize_in_background([dict(doc, _id = doc_id) for (doc, doc_id) in zip(docs, doc_ids)])
 
     # create next ids
     (doc_ids, overlap_ids) = get_doc_and_overlap_ids(collection_id)
@@ -647,4 +756,6 @@ def post_collection_image(collection_id, path):
     return jsonify(_upload_collection_image_file(collection_id, path, request.files["file"]))
 
 def init_app(app):
+    _COLLECTION_PERMISSIONS_CACHE.configure(maxsize = app.config.get("AUTH_CACHE_MAXSIZE"),
+                                            ttl = app.config.get("AUTH_CACHE_TTL"))
     app.register_blueprint(bp)
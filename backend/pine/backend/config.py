@@ -14,6 +14,27 @@ elif os.environ.get("FLASK_ENV") and os.environ.get("FLASK_ENV").startswith("dev
 else:
     EVE_SERVER = "http://eve:7510"
 
+# pooled connections to eve
+EVE_POOL_CONNECTIONS = int(os.environ.get("EVE_POOL_CONNECTIONS", 1))
+EVE_POOL_MAXSIZE = int(os.environ.get("EVE_POOL_MAXSIZE", 10))
+EVE_POOL_BLOCK = os.environ.get("EVE_POOL_BLOCK", "false").lower() in ("true", "1")
+EVE_MAX_RETRIES = int(os.environ.get("EVE_MAX_RETRIES", 3))
+EVE_RETRY_BACKOFF_FACTOR = float(os.environ.get("EVE_RETRY_BACKOFF_FACTOR", 0.1))
+# number of pages fetched concurrently by service.get_all_using_pagination
+EVE_PAGINATION_WORKERS = int(os.environ.get("EVE_PAGINATION_WORKERS", 4))
+
+# whether the tokens of added documents are computed in the background and saved to eve's "parsed" resource, and the
+# number of documents whose tokens are fetched together
+PARSED_PRETOKENIZE = os.environ.get("PARSED_PRETOKENIZE", "true").lower() in ("true", "1")
+PARSED_CHUNK_SIZE = int(os.environ.get("PARSED_CHUNK_SIZE", 100))
+
+# cache of collection permissions and document->collection mappings, in seconds
+# the cache is per worker process: changing a collection's permissions invalidates it only in the process that handled
+# the change, so the other (gunicorn) workers can keep using the old permissions for up to AUTH_CACHE_TTL seconds;
+# set AUTH_CACHE_TTL to 0 to disable the cache where that isn't acceptable
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 30))
+AUTH_CACHE_MAXSIZE = int(os.environ.get("AUTH_CACHE_MAXSIZE", 1024))
+
 if os.environ.get("REDIS_SERVER"):
     REDIS_SERVER = os.environ.get("REDIS_SERVER")
 elif os.environ.get("FLASK_ENV") and os.environ.get("FLASK_ENV").startswith("dev"):
@@ -23,6 +44,9 @@ else:
 
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6479))
 
+# how often the next document queues (kept in redis) are saved to eve, in seconds; 0 disables saving
+NEXT_INSTANCES_SNAPSHOT_INTERVAL = int(os.environ.get("NEXT_INSTANCES_SNAPSHOT_INTERVAL", 30))
+
 AUTH_MODULE = os.environ.get("AUTH_MODULE", "vegas")
 
 VEGAS_CLIENT_SECRET = os.environ.get("VEGAS_CLIENT_SECRET", None)
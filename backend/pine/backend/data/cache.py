@@ -0,0 +1,82 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import collections
+import threading
+import time
+
+from flask import g, has_request_context
+
+class TTLCache(object):
+    """A small thread-safe, size-bounded cache whose entries expire after a fixed number of seconds.
+
+    Entries are evicted least-recently-used first once maxsize is reached.
+    """
+
+    def __init__(self, maxsize = 1024, ttl = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def configure(self, maxsize = None, ttl = None):
+        self.lock.acquire()
+        try:
+            if maxsize is not None: self.maxsize = maxsize
+            if ttl is not None: self.ttl = ttl
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+    def get(self, key, default = None):
+        self.lock.acquire()
+        try:
+            if key not in self.data:
+                return default
+            (expires, value) = self.data[key]
+            if expires < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self.lock.acquire()
+        try:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+def request_memo(name):
+    """Returns a dict that lives for the duration of the current flask request.
+
+    Outside of a request context a new (empty) dict is returned every time, so nothing is memoized.
+
+    :param name: str: name of the memo, so different lookups don't collide
+    :return: dict
+    """
+    if not has_request_context():
+        return {}
+    if "pine_memos" not in g:
+        g.pine_memos = {}
+    return g.pine_memos.setdefault(name, {})
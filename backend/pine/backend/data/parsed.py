@@ -0,0 +1,134 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import threading
+
+from flask import current_app
+import numpy as np
+
+from . import service
+
+logger = logging.getLogger(__name__)
+
+# Pre-tokenized documents, kept in eve's "parsed" resource with one item per document (with the document's _id):
+#   "text_hash"   hash of the text the tokens were computed from
+#   "tokens"      tokenizer name -> the offsets of the document's tokens, as base64 of little-endian int32
+#                 [start, end, start, end, ...]
+# Tokens are computed in the background when documents are added, and by get_tokens for documents that don't have
+# them yet; when a document's text no longer matches the hash, all of its tokens are recomputed.  The pipelines add the
+# tokens of their own tokenizers (e.g. spaCy's) to the same items, see pipelines/pine/pipelines/parsed.py.
+
+def _whitespace_tokenize(text):
+    # the tokenization of the IAA reports (imported here, the IAA package imports this module)
+    from ..pineiaa.bratiaa.utils import tokenize
+    return tokenize(text)
+
+TOKENIZERS = {
+    "whitespace": _whitespace_tokenize
+}
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def encode_offsets(tokens):
+    """Packs token offsets into a string that can be stored in eve.
+
+    :param tokens: list: (start, end) offsets
+    :return: str
+    """
+    return base64.b64encode(np.asarray(tokens, dtype="<i4").reshape(-1).tobytes()).decode("ascii")
+
+def decode_offsets(encoded):
+    """Unpacks token offsets packed by encode_offsets.
+
+    :param encoded: str: packed offsets
+    :return: list of (start, end) tuples
+    """
+    offsets = np.frombuffer(base64.b64decode(encoded), dtype="<i4").reshape(-1, 2)
+    return [(int(start), int(end)) for (start, end) in offsets]
+
+def _get_items(document_ids):
+    items = {}
+    chunk_size = current_app.config.get("PARSED_CHUNK_SIZE", 100)
+    for start in range(0, len(document_ids), chunk_size):
+        chunk = document_ids[start:start + chunk_size]
+        params = service.params({"where": {"_id": {"$in": chunk}}, "projection": {"text_hash": 1, "tokens": 1}})
+        for item in service.get_all_using_pagination("parsed", params)["_items"]:
+            items[item["_id"]] = item
+    return items
+
+def _save(new_items, stale_items):
+    # new items are posted in chunks, each a single request; stale ones (whose text changed) are replaced one by one
+    chunk_size = current_app.config.get("PARSED_CHUNK_SIZE", 100)
+    for start in range(0, len(new_items), chunk_size):
+        chunk = new_items[start:start + chunk_size]
+        resp = service.post("parsed", json = chunk)
+        if not resp.ok:
+            # another request saved some of them first; they're recomputed next time
+            logger.warning("Unable to save the tokens of {} documents: {}".format(len(chunk), resp.content))
+    for (etag, item) in stale_items:
+        resp = service.put(["parsed", item["_id"]], headers = {"If-Match": etag},
+                           json = {key: value for (key, value) in item.items() if key != "_id"})
+        if not resp.ok:
+            logger.warning("Unable to save tokens of document {}: {}".format(item["_id"], resp.content))
+
+def get_tokens(documents, tokenizer = "whitespace"):
+    """Returns the token offsets of documents, computing and saving the ones that aren't in eve or are stale.
+
+    :param documents: list: documents with their "_id", "collection_id" and "text"
+    :param tokenizer: str: name of the tokenizer in TOKENIZERS
+    :return: dict of document id -> list of (start, end) token offsets
+    """
+    items = _get_items([document["_id"] for document in documents])
+    tokens = {}
+    new_items = []
+    stale_items = []
+    for document in documents:
+        item = items.get(document["_id"])
+        digest = text_hash(document["text"])
+        if item is not None and item.get("text_hash") == digest and tokenizer in item.get("tokens", {}):
+            tokens[document["_id"]] = decode_offsets(item["tokens"][tokenizer])
+            continue
+        tokens[document["_id"]] = list(TOKENIZERS[tokenizer](document["text"]))
+        item_tokens = dict(item.get("tokens", {})) if item is not None and item.get("text_hash") == digest else {}
+        item_tokens[tokenizer] = encode_offsets(tokens[document["_id"]])
+        new_item = {"_id": document["_id"], "collection_id": document["collection_id"], "text_hash": digest,
+                    "tokens": item_tokens}
+        if item is None:
+            new_items.append(new_item)
+        else:
+            stale_items.append((item["_etag"], new_item))
+    _save(new_items, stale_items)
+    computed = len(new_items) + len(stale_items)
+    logger.info("Read the {} tokens of {} documents, computed {}".format(tokenizer, len(documents) - computed, computed))
+    return tokens
+
+def _tokenize_all(app, documents):
+    # runs on the background worker thread, which has no app context of its own
+    with app.app_context():
+        try:
+            for tokenizer in TOKENIZERS:
+                get_tokens(documents, tokenizer)
+        except Exception as e:
+            logger.error("Unable to pre-tokenize {} documents: {}".format(len(documents), e))
+
+def tokenize_in_background(documents):
+    """Computes and saves the tokens of newly added documents on a background thread, unless PARSED_PRETOKENIZE is off.
+
+    :param documents: list: documents with their "_id", "collection_id" and "text"
+    """
+    global _EXECUTOR
+    documents = [document for document in documents if document.get("text")]
+    if not documents or not current_app.config.get("PARSED_PRETOKENIZE", True):
+        return
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "parsed")
+    _EXECUTOR.submit(_tokenize_all, current_app._get_current_object(), documents)
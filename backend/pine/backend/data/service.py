@@ -1,5 +1,7 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import math
@@ -8,6 +10,9 @@ import threading
 
 from flask import abort, current_app, Response
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
@@ -21,12 +26,27 @@ class PerformanceHistory(object):
             "delete": {},
             "patch": {}
         }
+        self.connections = {
+            "requests": 0,
+            "new": 0,
+            "reused": 0
+        }
         self.lock = threading.Lock()
 
     def pprint(self):
         self.lock.acquire()
         try:
             pprint(self.data)
+            pprint(self.connections)
+        finally:
+            self.lock.release()
+
+    def add_new_connection(self):
+        """Records that the pooled session had to open a new connection to eve.
+        """
+        self.lock.acquire()
+        try:
+            self.connections["new"] += 1
         finally:
             self.lock.release()
 
@@ -47,11 +67,79 @@ class PerformanceHistory(object):
             p["response_content_size"] += len(response.content)
             if response.request.body:
                 p["request_body_size"] += len(response.request.body)
+            c = self.connections
+            c["requests"] += 1
+            c["reused"] = max(0, c["requests"] - c["new"])
         finally:
             self.lock.release()
 
 PERFORMANCE_HISTORY = PerformanceHistory()
 
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+
+    def _new_conn(self):
+        PERFORMANCE_HISTORY.add_new_connection()
+        return super()._new_conn()
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+
+    def _new_conn(self):
+        PERFORMANCE_HISTORY.add_new_connection()
+        return super()._new_conn()
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report new connections to PERFORMANCE_HISTORY.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def _create_session(config):
+    retries = Retry(total=config.get("EVE_MAX_RETRIES", 3),
+                    backoff_factor=config.get("EVE_RETRY_BACKOFF_FACTOR", 0.1),
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False)
+    adapter = _PooledAdapter(pool_connections=config.get("EVE_POOL_CONNECTIONS", 1),
+                             pool_maxsize=config.get("EVE_POOL_MAXSIZE", 10),
+                             max_retries=retries,
+                             pool_block=config.get("EVE_POOL_BLOCK", False))
+    session = requests.Session()
+    session.headers["Connection"] = "keep-alive"
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    """Returns the process-wide pooled session used to talk to eve.
+    
+    The session is created on first use from the current app's configuration.  Its connection pools are thread-safe,
+    so it is shared by every Flask worker thread in the process.
+    
+    :return: requests.Session
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _create_session(current_app.config)
+    return _SESSION
+
+def close_session():
+    """Closes the pooled session, if any; a new one will be created on next use.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+            _SESSION = None
+
 def _standardize_path(path, *additional_paths):
     if type(path) not in [list, tuple, set]:
         path = [path]
@@ -94,62 +182,62 @@ def params(params):
 
 
 def get(path, **kwargs):
-    """Wraps requests.get for the given eve-relative path.
+    """Wraps requests.get for the given eve-relative path using the pooled session.
     
     :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
     :param **kwargs: dict: any additional arguments to pass to requests.get
     :return: requests.Response
     """
     global PERFORMANCE_HISTORY
-    resp = requests.get(url(path), **kwargs)
+    resp = get_session().get(url(path), **kwargs)
     PERFORMANCE_HISTORY.add("get", path, resp)
     return resp
 
 def post(path, **kwargs):
-    """Wraps requests.post for the given eve-relative path.
+    """Wraps requests.post for the given eve-relative path using the pooled session.
     
     :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
     :param **kwargs: dict: any additional arguments to pass to requests.post
     :return: requests.Response
     """
     global PERFORMANCE_HISTORY
-    resp = requests.post(url(path), **kwargs)
+    resp = get_session().post(url(path), **kwargs)
     PERFORMANCE_HISTORY.add("post", path, resp)
     return resp
 
 def put(path, **kwargs):
-    """Wraps requests.put for the given eve-relative path.
+    """Wraps requests.put for the given eve-relative path using the pooled session.
     
     :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
     :param **kwargs: dict: any additional arguments to pass to requests.put
     :return: requests.Response
     """
     global PERFORMANCE_HISTORY
-    resp = requests.put(url(path), **kwargs)
+    resp = get_session().put(url(path), **kwargs)
     PERFORMANCE_HISTORY.add("put", path, resp)
     return resp
 
 def delete(path, **kwargs):
-    """Wraps requests.delete for the given eve-relative path.
+    """Wraps requests.delete for the given eve-relative path using the pooled session.
     
     :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
     :param **kwargs: dict: any additional arguments to pass to requests.delete
     :return: requests.Response
     """
     global PERFORMANCE_HISTORY
-    resp = requests.delete(url(path), **kwargs)
+    resp = get_session().delete(url(path), **kwargs)
     PERFORMANCE_HISTORY.add("delete", path, resp)
     return resp
 
 def patch(path, **kwargs):
-    """Wraps requests.patch for the given eve-relative path.
+    """Wraps requests.patch for the given eve-relative path using the pooled session.
     
     :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
     :param **kwargs: dict: any additional arguments to pass to requests.patch
     :return: requests.Response
     """
     global PERFORMANCE_HISTORY
-    resp = requests.patch(url(path), **kwargs)
+    resp = get_session().patch(url(path), **kwargs)
     PERFORMANCE_HISTORY.add("patch", path, resp)
     return resp
 
@@ -176,7 +264,42 @@ def get_all_versions_of_item_by_id(path, item_id, params = {}):
     return resp.json()
 
 
+_PAGINATION_EXECUTOR = None
+
+def _get_pagination_executor():
+    global _PAGINATION_EXECUTOR
+    if _PAGINATION_EXECUTOR is None:
+        with _SESSION_LOCK:
+            if _PAGINATION_EXECUTOR is None:
+                _PAGINATION_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=current_app.config.get("EVE_PAGINATION_WORKERS", 4),
+                    thread_name_prefix="eve-pagination")
+    return _PAGINATION_EXECUTOR
+
+def _get_page(app, path, params, page):
+    # runs on a pagination worker thread, which has no app context of its own
+    with app.app_context():
+        page_params = dict(params)
+        page_params["page"] = page
+        resp = get(path, params=page_params)
+        if not resp.ok:
+            abort(resp.status_code)
+        return resp.json()["_items"]
+
+def _total_pages(body):
+    return math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"])
+
+
 def get_all_using_pagination(path, params):
+    """Returns all items for the given eve-relative path, fetching every page.
+    
+    The first page is fetched to find the total number of pages; the remaining pages are then fetched concurrently on
+    a bounded thread pool and reassembled in order.
+    
+    :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
+    :param params: dict: parameters to pass to eve (not modified)
+    :return: dict with all the items under "_items"
+    """
     resp = get(path, params=params)
     if not resp.ok:
         abort(resp.status_code)
@@ -187,22 +310,76 @@ def get_all_using_pagination(path, params):
     all_items["_items"] += body["_items"]
 
     page = body["_meta"]["page"]
-    total_pages = math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"])
+    total_pages = _total_pages(body)
+    if page >= total_pages:
+        return all_items
 
-    while page < total_pages:
-        page += 1
-        params["page"] = page
-        resp = get(path, params=params)
-        if not resp.ok:
-            abort(resp.status_code)
-        body = resp.json()
-        all_items["_items"] += body["_items"]
-        page = body["_meta"]["page"]
-        total_pages = math.ceil(body["_meta"]["total"] / body["_meta"]["max_results"])
+    app = current_app._get_current_object()
+    pages = range(page + 1, total_pages + 1)
+    for items in _get_pagination_executor().map(lambda p: _get_page(app, path, params, p), pages):
+        all_items["_items"] += items
 
     return all_items
 
 
+def iter_all_using_pagination(path, params):
+    """Generator over all items for the given eve-relative path, in order.
+    
+    Like get_all_using_pagination, except that items are yielded page by page and at most EVE_PAGINATION_WORKERS
+    pages are fetched ahead, so memory use does not grow with the number of items.
+    
+    :param path: str: eve-relative path (e.g. "collections" or ["collections", id])
+    :param params: dict: parameters to pass to eve (not modified)
+    :return: generator of item dicts
+    """
+    resp = get(path, params=params)
+    if not resp.ok:
+        abort(resp.status_code)
+    body = resp.json()
+    yield from body.get("_items", [])
+    if "_meta" not in body:
+        return
+
+    next_page = body["_meta"]["page"] + 1
+    total_pages = _total_pages(body)
+    del body
+
+    app = current_app._get_current_object()
+    executor = _get_pagination_executor()
+    window = max(1, current_app.config.get("EVE_PAGINATION_WORKERS", 4))
+    pending = collections.deque()
+    try:
+        while next_page <= total_pages or pending:
+            while next_page <= total_pages and len(pending) < window:
+                pending.append(executor.submit(_get_page, app, path, params, next_page))
+                next_page += 1
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def iter_ndjson(path, params = {}):
+    """Generator over the objects of a newline-delimited JSON response for the given eve-relative path.
+    
+    The response is streamed, so memory use does not grow with the size of the response.  It is not added to the
+    performance history, since that would read the whole response.
+    
+    :param path: str: eve-relative path (e.g. ["collections", id, "documents_with_annotations"])
+    :param params: dict: parameters to pass to eve
+    :return: generator of dicts
+    """
+    resp = get_session().get(url(path), params=params, stream=True)
+    try:
+        if not resp.ok:
+            abort(resp.status_code, resp.content)
+        for line in resp.iter_lines():
+            if line:
+                yield json.loads(line)
+    finally:
+        resp.close()
+
+
 def convert_response(requests_response):
     return Response(requests_response.content,
                     requests_response.status_code,
@@ -6,15 +6,36 @@ from flask import abort, Blueprint, jsonify, request
 from werkzeug import exceptions
 
 from .. import auth, collections, log
-from ..data import service
+from ..data import cache, parsed, service
 
 bp = Blueprint("documents", __name__, url_prefix = "/documents")
 
+# Process cache of document id -> collection id (documents never move between collections)
+_DOCUMENT_COLLECTION_CACHE = cache.TTLCache()
+
 def _document_user_can_projection():
     return service.params({"projection": {
         "collection_id": 1
     }})
 
+def get_document_collection_id(document_id):
+    """
+    Return the id of the collection containing the document matching the provided document id.  The mapping is
+    memoized for the current request and cached for a short time across requests.
+    :param document_id: str
+    :return: str
+    """
+    memo = cache.request_memo("document_collection_id")
+    if document_id in memo:
+        return memo[document_id]
+    collection_id = _DOCUMENT_COLLECTION_CACHE.get(document_id)
+    if collection_id is None:
+        document = service.get_item_by_id("documents", document_id, params=_document_user_can_projection())
+        collection_id = document["collection_id"]
+        _DOCUMENT_COLLECTION_CACHE.set(document_id, collection_id)
+    memo[document_id] = collection_id
+    return collection_id
+
 def user_can_annotate(document):
     return collections.user_can_annotate_by_id(document["collection_id"])
 
@@ -25,16 +46,13 @@ def user_can_modify_metadata(document):
     return collections.user_can_modify_document_metadata_by_id(document["collection_id"])
 
 def user_can_annotate_by_id(document_id):
-    document = service.get_item_by_id("documents", document_id, params=_document_user_can_projection())
-    return user_can_annotate(document)
+    return collections.user_can_annotate_by_id(get_document_collection_id(document_id))
 
 def user_can_view_by_id(document_id):
-    document = service.get_item_by_id("documents", document_id, params=_document_user_can_projection())
-    return user_can_view(document)
+    return collections.user_can_view_by_id(get_document_collection_id(document_id))
 
 def user_can_modify_metadata_by_id(document_id):
-    document = service.get_item_by_id("documents", document_id, params=_document_user_can_projection())
-    return user_can_modify_metadata(document)
+    return collections.user_can_modify_document_metadata_by_id(get_document_collection_id(document_id))
 
 
 @bp.route("/by_id/<doc_id>", methods = ["GET"])
@@ -90,6 +108,7 @@ def add_document():
     resp = service.post("documents", json=document)
     if resp.ok:
         log.access_flask_add_document(resp.json())
+        parsed.tokenize_in_background([dict(document, _id = resp.json()["_id"])])
     return service.convert_response(resp)
 
 @bp.route("/can_annotate/<doc_id>", methods = ["GET"])
@@ -130,4 +149,6 @@ def update_metadata(doc_id):
         service.patch(["documents", doc_id], json = document, headers = headers))
 
 def init_app(app):
+    _DOCUMENT_COLLECTION_CACHE.configure(maxsize = app.config.get("AUTH_CACHE_MAXSIZE"),
+                                         ttl = app.config.get("AUTH_CACHE_TTL"))
     app.register_blueprint(bp)
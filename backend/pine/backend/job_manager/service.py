@@ -45,7 +45,8 @@ class ServiceManager(object):
     redis_reg_key_prefix = redis_key_prefix + "codex:"
     redis_channels_key = redis_key_prefix + "channels"
     redis_channel_ttl_key_prefix = redis_key_prefix + "channel-ttl:"  # not really ttl, but more like registered date
-    redis_work_queue_key_prefix = redis_key_prefix + "work-queue:"
+    redis_work_queue_key_prefix = redis_key_prefix + "work-queue:"  # the queue holds job ids only
+    redis_work_job_key_infix = ":job:"  # job payloads are hashes at "<work-queue key>:job:<job_id>"
     redis_work_mutex_key_prefix = redis_key_prefix + "work-mutex:"
     redis_handler_mutex_key_prefix = redis_key_prefix + "handler-mutex:"
 
@@ -159,6 +160,16 @@ class ServiceManager(object):
                 continue
         return final_values
 
+    @classmethod
+    def get_job_key(cls, redis_queue_key, job_id):
+        """
+        Get the key of the hash holding a queued job's payload.
+        :type redis_queue_key: str
+        :type job_id: str
+        :rtype: str
+        """
+        return redis_queue_key + cls.redis_work_job_key_infix + job_id
+
     @classmethod
     def send_service_request(cls, service_name, data, job_id=None, encoder=None):
         """
@@ -188,26 +199,35 @@ class ServiceManager(object):
             return None
         redis_queue_key = cls.redis_work_queue_key_prefix + service_name
         job_id_to_use = job_id if isinstance(job_id, str) else uuid.uuid4().hex
+        redis_job_key = cls.get_job_key(redis_queue_key, job_id_to_use)
         request_body = {"job_id": job_id_to_use, "job_type": "request", "job_queue": redis_queue_key}
         request_body_publish = json.dumps(request_body.copy(), separators=(",", ":"), cls=encoder)
-        request_body.update({"job_data": data})
         try:
-            request_body_queue = json.dumps(request_body, separators=(",", ":"), cls=encoder)
+            job_data_str = json.dumps(data, separators=(",", ":"), cls=encoder)
         except (json.JSONDecodeError, TypeError):
             logger.warning("Unable to encode data.")
             return None
+        request_body.update({"job_data": data})
+        # Schema after this
+        # "<prefix>:registration:work-queue:<service_name>" --> LIST of job ids
+        # "<prefix>:registration:work-queue:<service_name>:job:<job_id>" --> HASH of job_id, job_type, job_queue, job_data
         with cls.r_conn.pipeline() as pipe:
-            pipe.rpush(redis_queue_key, request_body_queue)
+            pipe.hset(redis_job_key, mapping = {"job_id": job_id_to_use, "job_type": "request",
+                                                "job_queue": redis_queue_key, "job_data": job_data_str})
+            pipe.expire(redis_job_key, cls.redis_work_queue_key_ttl)
+            pipe.rpush(redis_queue_key, job_id_to_use)
             # if nothing is processed in "redis_queue_key_ttl" minutes since last insert, the queue will be deleted
             pipe.expire(redis_queue_key, cls.redis_work_queue_key_ttl)
-            num_pushed, expire_is_set = pipe.execute()
+            _, _, num_pushed, expire_is_set = pipe.execute()
         if num_pushed < 1 or expire_is_set is not True:
             return None
         num_received = cls.r_conn.publish(service_channel, request_body_publish)
         # no-one consumed it
         if num_received <= 0:
-            # TODO: potential race-condition here due to popping potentially wrong thing in multi-process (we should use a lock)
-            cls.r_conn.rpop(redis_queue_key)
+            with cls.r_conn.pipeline() as pipe:
+                pipe.lrem(redis_queue_key, 1, job_id_to_use)
+                pipe.delete(redis_job_key)
+                pipe.execute()
             return None
         return request_body
 
@@ -24,11 +24,12 @@ np.seterr(divide='ignore', invalid='ignore')
 LOGGER = logging.getLogger(__name__)
 
 class Document:
-    __slots__ = ['ann_files', 'txt', 'doc_id']
+    __slots__ = ['ann_files', 'txt', 'doc_id', 'tokens']
 
-    def __init__(self, txt, doc_id):
+    def __init__(self, txt, doc_id, tokens=None):
         self.txt = txt
         self.doc_id = doc_id
+        self.tokens = tokens  # (start, end) offsets of the tokens, if known; otherwise the token function is used
         self.ann_files = []
 
 
@@ -41,7 +42,7 @@ def input_generator(json_list):
     for id, ann_doc in enumerate(json_list):
         anns_people = []
         #Annotation = namedtuple('Annotation', ['type', 'label', 'offsets'])
-        doc = Document(ann_doc['text'], ann_doc['_id'])
+        doc = Document(ann_doc['text'], ann_doc['_id'], ann_doc.get('tokens'))
         for ann_name, ann_list in ann_doc['annotations'].items():
             anns = []
             for ann in ann_list:
@@ -58,12 +59,120 @@ def compute_f1(tp, fp, fn):
     return (2 * tp) / (2 * tp + fp + fn)
 
 
+class DenseCounts:
+    """
+    Counts of shape (p, d, c, l) in a single array, for when most annotator pairs annotated most documents.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self._pdcl = np.zeros(shape, dtype=np.int32)
+
+    def add(self, indices, values=1):
+        """
+        Adds values at indices, a tuple of (p, d, c, l) index arrays; repeated indices are all added.
+        """
+        np.add.at(self._pdcl, indices, values)
+
+    def sum(self, axis):
+        return np.sum(self._pdcl, axis=axis)
+
+    def document(self, doc_idx):
+        """
+        Counts of one document, of shape (p, c, l).
+        """
+        return self._pdcl[:, doc_idx]
+
+
+class SparseCounts:
+    """
+    Counts of shape (p, d, c, l) stored as coordinates and values of the non-zero entries, for when most annotator pairs
+    never annotated the same documents.  Additions are buffered and merged when the counts are read.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self._keys = np.zeros(0, dtype=np.int64)  # flat indices of the non-zero entries, sorted
+        self._values = np.zeros(0, dtype=np.int32)
+        self._pending = []
+        self._by_document = None  # (document index, order) of the entries sorted by document, made by document()
+
+    def add(self, indices, values=1):
+        """
+        Adds values at indices, a tuple of (p, d, c, l) index arrays; repeated indices are all added.
+        """
+        keys = np.ravel_multi_index(indices, self.shape).ravel()
+        self._pending.append((keys, np.broadcast_to(np.asarray(values, dtype=np.int32), keys.shape)))
+
+    def _merge(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self._keys] + [k for k, _ in self._pending])
+        values = np.concatenate([self._values] + [v for _, v in self._pending])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._values = np.zeros(len(self._keys), dtype=np.int32)
+        np.add.at(self._values, inverse.ravel(), values)
+        self._pending = []
+        self._by_document = None
+
+    def sum(self, axis):
+        self._merge()
+        axis = axis if isinstance(axis, tuple) else (axis,)
+        kept = [i for i in range(len(self.shape)) if i not in axis]
+        shape = tuple(self.shape[i] for i in kept)
+        coordinates = np.unravel_index(self._keys, self.shape)
+        result = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        if len(self._keys):
+            np.add.at(result, np.ravel_multi_index([coordinates[i] for i in kept], shape), self._values)
+        return result.reshape(shape)
+
+    def document(self, doc_idx):
+        """
+        Counts of one document, of shape (p, c, l).
+        """
+        self._merge()
+        p, d, c, l = self.shape
+        if self._by_document is None:
+            # sorted by document once, so that every document's entries are a slice
+            documents = np.unravel_index(self._keys, self.shape)[1]
+            order = np.argsort(documents, kind='stable')
+            self._by_document = (documents[order], order)
+        documents, order = self._by_document
+        entries = order[np.searchsorted(documents, doc_idx, side='left'):np.searchsorted(documents, doc_idx, side='right')]
+        result = np.zeros((p, c, l), dtype=np.int32)
+        coordinates = np.unravel_index(self._keys[entries], self.shape)
+        result[coordinates[0], coordinates[2], coordinates[3]] = self._values[entries]
+        return result
+
+
+# dense counts up to this many entries regardless of their density
+DENSE_MAX_SIZE = 10 ** 7
+# above that, sparse counts when fewer than this fraction of (pair, document) combinations can have counts
+SPARSE_MAX_DENSITY = 0.25
+
+
+def make_counts(num_pairs, documents, num_labels):
+    """
+    Dense or sparse counts for the documents, depending on how many (pair, document) combinations can be non-zero,
+    i.e. how many pairs of annotators annotated each document.
+    """
+    shape = (num_pairs, len(documents), 3, num_labels)
+    size = int(np.prod(shape, dtype=np.int64))
+    if size <= DENSE_MAX_SIZE:
+        return DenseCounts(shape)
+    co_annotated = sum(comb(len(d.ann_files), 2, exact=True) for d in documents)
+    density = co_annotated / (num_pairs * len(documents))
+    LOGGER.debug(f'{density:.3f} of {num_pairs * len(documents)} (pair, document) combinations can have counts')
+    return SparseCounts(shape) if density < SPARSE_MAX_DENSITY else DenseCounts(shape)
+
+
 class F1Agreement:
-    def __init__(self, annotators, documents, labels, eval_func=exact_match_instance_evaluation, token_func=None):
+    def __init__(self, annotators, documents, labels, eval_func=exact_match_instance_evaluation, token_func=None,
+                 document_counts=None):
         assert len(annotators) > 1, 'At least two annotators are necessary to compute agreement!'
         num_pairs = comb(len(annotators), 2, exact=True)
         # (p, d, c, l) where p := annotator pairs, d := documents, c := counts (tp, fp, fn), l := labels
-        self._pdcl = np.zeros((num_pairs, len(documents), 3, len(labels)))
+        self._pdcl = make_counts(num_pairs, documents, len(labels))
         self._documents = list(documents)
         self._doc2idx = {d: i for i, d in enumerate(documents)}
         self._labels = list(labels)
@@ -76,7 +185,10 @@ class F1Agreement:
             self._pair2idx[(a2, a1)] = value
         self._eval_func = eval_func  # function used to extract true positives, false positives and false negatives
         self._token_func = token_func  # function used for tokenization
-        self._compute_tp_fp_fn(documents)
+        # documents whose counts are known (from a previous report) are not evaluated again
+        document_counts = document_counts or {}
+        self._set_counts(document_counts)
+        self._compute_tp_fp_fn([d for d in documents if d.doc_id not in document_counts])
 
     @property
     def annotators(self):
@@ -91,25 +203,58 @@ class F1Agreement:
         return list(self._labels)
 
     def _compute_tp_fp_fn(self, documents):
+        # (p, d, c, l) indices of every count, added at once
+        indices = ([], [], [], [])
         for doc_index, document in enumerate(documents):
             assert doc_index < len(self._documents), 'Input generator yields more documents than expected!'
             to = None
             if self._token_func:
                 text = document.txt
-                tokens = list(self._token_func(text))
+                tokens = document.tokens if document.tokens is not None else list(self._token_func(text))
                 to = TokenOverlap(text, tokens)
             for anno_file_1, anno_file_2 in combinations(document.ann_files, 2):
                 tp, fp, fn = self._eval_func(anno_file_1.annotations, anno_file_2.annotations, tokens=to)
                 pair_idx = self._pair2idx[(anno_file_1.annotator_id, anno_file_2.annotator_id)]
                 doc_idx = self._doc2idx[document]
-                self._increment_counts(tp, pair_idx, doc_idx, 0)
-                self._increment_counts(fp, pair_idx, doc_idx, 1)
-                self._increment_counts(fn, pair_idx, doc_idx, 2)
-
-    def _increment_counts(self, annotations, pair, doc, kind):
+                self._increment_counts(tp, pair_idx, doc_idx, 0, indices)
+                self._increment_counts(fp, pair_idx, doc_idx, 1, indices)
+                self._increment_counts(fn, pair_idx, doc_idx, 2, indices)
+        self._pdcl.add(tuple(np.array(i, dtype=np.int64) for i in indices))
+
+    def _set_counts(self, document_counts):
+        doc_id2idx = {d.doc_id: i for i, d in enumerate(self._documents)}
+        indices = ([], [], [], [])
+        values = []
+        for doc_id, counts in document_counts.items():
+            if doc_id not in doc_id2idx:
+                continue
+            for annotator_1, annotator_2, label, tp, fp, fn in counts:
+                if label not in self._label2idx:
+                    continue
+                for kind, value in enumerate((tp, fp, fn)):
+                    for i, index in enumerate((self._pair2idx[(annotator_1, annotator_2)], doc_id2idx[doc_id], kind,
+                                               self._label2idx[label])):
+                        indices[i].append(index)
+                    values.append(value)
+        self._pdcl.add(tuple(np.array(i, dtype=np.int64) for i in indices), np.array(values, dtype=np.int32))
+
+    def counts_per_document(self):
+        """
+        Non-zero counts of every document as {doc_id: [[annotator 1, annotator 2, label, tp, fp, fn], ...]}, which can
+        be passed back as document_counts.
+        """
+        counts = {}
+        for doc_idx, document in enumerate(self._documents):
+            pcl = self._pdcl.document(doc_idx)
+            pair_indices, label_indices = np.nonzero(pcl.sum(axis=1))
+            counts[document.doc_id] = [list(self._pairs[p]) + [self._labels[l]] + [int(c) for c in pcl[p, :, l]]
+                                       for p, l in zip(pair_indices, label_indices)]
+        return counts
+
+    def _increment_counts(self, annotations, pair, doc, kind, indices):
         for a in annotations:
             try:
-                self._pdcl[pair][doc][kind][self._label2idx[a.label]] += 1
+                label_idx = self._label2idx[a.label]
             except KeyError:
                 logging.error(
                     f'Encountered unknown label "{a.label}"! Please make sure that your "annotation.conf" '
@@ -117,12 +262,14 @@ class F1Agreement:
                     f'is located under the project root and contains an exhaustive list of entities!'
                 )
                 raise
+            for i, index in enumerate((pair, doc, kind, label_idx)):
+                indices[i].append(index)
 
     def mean_sd_per_label(self):
         """
         Mean and standard deviation of all annotator combinations' F1 scores by label.
         """
-        pcl = np.sum(self._pdcl, axis=1)  # sum over documents
+        pcl = self._pdcl.sum(axis=1)  # sum over documents
         f1_pairs = compute_f1(pcl[:, 0], pcl[:, 1], pcl[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
         return avg, stddev
@@ -131,7 +278,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores per document.
         """
-        pdc = np.sum(self._pdcl, axis=3)  # sum over labels
+        pdc = self._pdcl.sum(axis=3)  # sum over labels
         f1_pairs = compute_f1(pdc[:, :, 0], pdc[:, :, 1], pdc[:, :, 2])
         avg, stddev = self._mean_sd(f1_pairs)
         return avg, stddev
@@ -140,7 +287,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator cominations' F1 scores.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = self._pdcl.sum(axis=(1, 3))  # sum over documents and labels
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
         return avg, stddev
@@ -149,7 +296,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores involving given annotator per label.
         """
-        pcl = np.sum(self._pdcl, axis=1)  # sum over documents
+        pcl = self._pdcl.sum(axis=1)  # sum over documents
         pcl = pcl[self._pairs_involving(annotator)]
         f1_pairs = compute_f1(pcl[:, 0], pcl[:, 1], pcl[:, 2])
         avg, stddev = self._mean_sd(f1_pairs)
@@ -159,7 +306,7 @@ class F1Agreement:
         """
         Mean and standard deviation of all annotator combinations' F1 scores involving given annotator.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = self._pdcl.sum(axis=(1, 3))  # sum over documents and labels
         pc = pc[self._pairs_involving(annotator)]
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         if len(f1_pairs) > 1:
@@ -194,7 +341,7 @@ class F1Agreement:
 
         By definition, the matrix is symmetric and F1 = 1 on the main diagonal.
         """
-        pc = np.sum(self._pdcl, axis=(1, 3))  # sum over documents and labels
+        pc = self._pdcl.sum(axis=(1, 3))  # sum over documents and labels
         f1_pairs = compute_f1(pc[:, 0], pc[:, 1], pc[:, 2])
         num_annotators = len(self._annotators)
         f1_matrix = np.zeros((num_annotators, num_annotators))
@@ -238,7 +385,7 @@ class F1Agreement:
         plt.savefig(out_path)
 
 
-def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_func=None):
+def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_func=None, document_counts=None):
     if not eval_func:
         eval_func = exact_match_instance_evaluation
         if token_func:
@@ -247,7 +394,8 @@ def compute_f1_agreement(annotators, documents, labels, token_func=None, eval_fu
     #input_gen = partial(input_gen, project_root)
     #annotators, documents = _collect_annotators_and_documents(input_gen)
 
-    return F1Agreement(annotators, documents, sorted(labels), eval_func=eval_func, token_func=token_func)
+    return F1Agreement(annotators, documents, sorted(labels), eval_func=eval_func, token_func=token_func,
+                       document_counts=document_counts)
 
 
 def iaa_report(f1_agreement, precision=3):
@@ -1,63 +1,77 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
-import requests
 from ..bratiaa import iaa_report, compute_f1_agreement, input_generator
 from ..bratiaa import tokenize
 from ..bratiaa import exact_match_token_evaluation
 from collections import defaultdict
 from .. import service
+from ...data import parsed
+import hashlib
+import json
+import logging
 import numpy as np
 
-EVE_HEADERS = {'Content-Type': 'application/json'}
+logger = logging.getLogger(__name__)
 
-def get_items(resource):
-    response = service.get(resource, headers=EVE_HEADERS)
-    if response.status_code == 200:
-        r = response.json()
-        if '_items' in r:
-            if '_links' in r and 'next' in r['_links']:
-                return r['_items'], r['_links']['next']['href']
-            else:
-                return r['_items'], None
-    return [], None
+TEXT_CHUNK_SIZE = 100
+COUNTS_CHUNK_SIZE = 100
 
+def annotations_signature(annotations):
+    # changes whenever one of the annotations is added, removed or updated
+    pairs = sorted([a['creator_id'], a.get('_updated', '')] for a in annotations)
+    return hashlib.sha1(json.dumps(pairs).encode("utf-8")).hexdigest()
 
-def get_all_items(query):
-    total_items = []
-    while True:
-        items, query = get_items(query)
-        total_items.extend(items)
-        if query is None:
-            break
-    return total_items
-
-
-
-def get_doc_annotations(collection_id, exclude=None):
-    #get documents
-    resource = 'documents?where={"collection_id":"%s"}' % (collection_id)
-    docs = get_all_items(resource)
-
-    #get annotations
-    resource = 'annotations?where={"collection_id":"%s"}' % (collection_id)
-    annotations = get_all_items(resource)
-
+def get_doc_annotations(collection_id, exclude=None, include_text=True):
+    # get documents with their annotations, joined by eve; "signature" changes whenever a document's (not excluded)
+    # annotations do
     combined = {}
-    for d in docs:
-        combined[d['_id']]={"_id":d['_id'], "text":d['text'], "annotations":{}}
+    params = {"updated": 1} if include_text else {"updated": 1, "text": 0}
+    for d in service.iter_ndjson(["collections", collection_id, "documents_with_annotations"], params):
+        included = [a for a in d['annotations'] if not (exclude and a['creator_id'] in exclude)]
+        combined[d['_id']]={"_id":d['_id'], "text":d.get('text'), "annotations":{},
+                            "signature": annotations_signature(included)}
         if "metadata" in d:
             combined[d['_id']]['metadata'] = d['metadata']
 
-    for a in annotations:
-        creator = a['creator_id']
-        if exclude and creator in exclude :
-            continue
-        docid = a['document_id']
-        anns = a['annotation']
-        if docid in combined:
-            combined[docid]["annotations"][creator]=anns
+        for a in included:
+            combined[d['_id']]["annotations"][a['creator_id']]=a['annotation']
     return combined
 
+def get_document_counts(collection_id):
+    # the counts of the collection's documents saved by previous reports, with the signature they were computed for
+    params = service.params({"where": {"collection_id": collection_id}, "projection": {"signature": 1, "counts": 1}})
+    return {item["_id"]: item for item in service.iter_all_using_pagination("iaa_document_counts", params)}
+
+def save_document_counts(collection_id, previous_counts, document_counts):
+    # one item per document, so that a report's counts aren't limited by the size of a single item; only the counts of
+    # new or changed documents are written
+    new_items = []
+    for doc_id, item in document_counts.items():
+        previous = previous_counts.get(doc_id)
+        if previous is None:
+            new_items.append(dict(item, _id=doc_id, collection_id=collection_id))
+        elif previous["signature"] != item["signature"]:
+            resp = service.put(["iaa_document_counts", doc_id], headers={"If-Match": previous["_etag"]},
+                               json=dict(item, collection_id=collection_id))
+            if not resp.ok:
+                # another report saved them first; they're recomputed next time if needed
+                logger.warning("Unable to save the IAA counts of document {}: {}".format(doc_id, resp.content))
+    for start in range(0, len(new_items), COUNTS_CHUNK_SIZE):
+        resp = service.post("iaa_document_counts", json=new_items[start:start + COUNTS_CHUNK_SIZE])
+        if not resp.ok:
+            logger.warning("Unable to save the IAA counts of {} documents: {}".format(
+                len(new_items[start:start + COUNTS_CHUNK_SIZE]), resp.content))
+
+def get_documents(doc_ids):
+    documents = []
+    for start in range(0, len(doc_ids), TEXT_CHUNK_SIZE):
+        params = service.params({
+            "where": {"_id": {"$in": doc_ids[start:start + TEXT_CHUNK_SIZE]}},
+            "projection": {"text": 1, "collection_id": 1}
+        })
+        documents += service.get_all_using_pagination("documents", params)['_items']
+    return documents
+
 def fix_num_for_json(number):
     if np.isnan(number):
         return "null"
@@ -66,8 +80,24 @@ def fix_num_for_json(number):
 
 
 def getIAAReportForCollection(collection_id):
-
-    combined = get_doc_annotations(collection_id) ## exclude=set(['bchee1'])
+    # documents whose annotations didn't change since the previous report keep their counts from it (see
+    # get_document_counts), only the others are fetched with their text and tokens (see data/parsed.py) and evaluated
+    # again
+
+    combined = get_doc_annotations(collection_id, include_text=False) ## exclude=set(['bchee1'])
+
+    previous_counts = get_document_counts(collection_id)
+    document_counts = {}
+    for doc_id, c in combined.items():
+        previous = previous_counts.get(doc_id)
+        if previous is not None and previous["signature"] == c["signature"]:
+            document_counts[doc_id] = previous["counts"]
+    documents = [d for d in get_documents([doc_id for doc_id in combined if doc_id not in document_counts])
+                 if d.get("text") is not None]
+    tokens = parsed.get_tokens(documents, "whitespace")
+    for d in documents:
+        combined[d["_id"]]["text"] = d["text"]
+        combined[d["_id"]]["tokens"] = tokens[d["_id"]]
 
     labels = set()
     for v in combined.values():
@@ -90,7 +120,8 @@ def getIAAReportForCollection(collection_id):
     annotators, documents = input_generator(anns)
 
     try:
-        f1_agreement = compute_f1_agreement(annotators, documents, labels, eval_func=eval_func, token_func=token_func)
+        f1_agreement = compute_f1_agreement(annotators, documents, labels, eval_func=eval_func, token_func=token_func,
+                                            document_counts=document_counts)
         # Get label counts by provider
         counts = defaultdict(lambda: defaultdict(int))
         for document in anns:
@@ -137,6 +168,9 @@ def getIAAReportForCollection(collection_id):
                                                    "annotators": list(f1_agreement.annotators)}},
             "labels_per_annotator": labels_per_annotator_dict
         }
+        save_document_counts(collection_id, previous_counts,
+                             {doc_id: {"signature": combined[doc_id]["signature"], "counts": counts}
+                              for doc_id, counts in f1_agreement.counts_per_document().items()})
 
         return new_iaa_report
     except AssertionError:
@@ -13,6 +13,8 @@ from .. import auth
 from ..data import service
 from ..collections import bp as collectionsbp
 from ..job_manager.service import ServiceManager
+from . import queues
+from .queues import NEXT_INSTANCES
 
 logger = logging.getLogger(__name__)
 service_manager = ServiceManager()
@@ -121,27 +123,24 @@ def _get_next_instance(classifier_id):
 @bp.route("/next_document/by_classifier_id/<classifier_id>", methods = ["GET"])
 @auth.login_required
 def get_next_by_classifier(classifier_id):
-    instance = _get_next_instance(classifier_id)
+    if classifier_id not in classifier_dict:
+        if not _get_classifier(classifier_id):
+            raise exceptions.NotFound(description = "Classifier not found: could not load classifier.")
+    NEXT_INSTANCES.ensure_loaded(classifier_id, lambda: _get_next_instance(classifier_id))
     user_id = auth.get_logged_in_user()["id"]
 
-    if user_id not in instance["overlap_document_ids"]:
-        print("new user: adding to overlap document ids")
-        instance["overlap_document_ids"][user_id] = collectionsbp.get_overlap_ids(classifier_dict[classifier_id]["collection_id"])
-        to_patch = {
-            "_id": instance["_id"],
-            "overlap_document_ids": instance["overlap_document_ids"]
-        }
-        headers = {"If-Match": instance["_etag"]}
-        r = service.patch(["next_instances", instance["_id"]], json = to_patch, headers = headers)
-        if not r.ok:
-            abort(r.status_code, r.content)
+    if not NEXT_INSTANCES.has_overlap_user(classifier_id, user_id):
+        logger.info("New user: adding to overlap document ids")
+        NEXT_INSTANCES.add_overlap_user(classifier_id, user_id,
+                                        collectionsbp.get_overlap_ids(classifier_dict[classifier_id]["collection_id"]))
 
-    if random.random() <= classifier_dict[classifier_id]["overlap"] and len(instance["overlap_document_ids"][user_id]) > 0:
-        return jsonify(instance["overlap_document_ids"][user_id].pop())
-    elif len(instance["document_ids"]) > 0:
-        return jsonify(instance["document_ids"].pop())
-    else:
-        return jsonify(None)
+    # queues are served from their end, rankings are stored best last; the top of the latest ranking is served before
+    # the rest
+    if random.random() <= classifier_dict[classifier_id]["overlap"]:
+        document_id = NEXT_INSTANCES.peek_overlap(classifier_id, user_id)
+        if document_id is not None:
+            return jsonify(document_id)
+    return jsonify(NEXT_INSTANCES.peek(classifier_id))
 
 
 @bp.route("/next_document/by_classifier_id/<classifier_id>/<document_id>", methods = ["POST"])
@@ -149,52 +148,29 @@ def get_next_by_classifier(classifier_id):
 def advance_to_next_document_by_classifier(classifier_id, document_id):
     user_id = auth.get_logged_in_user()["id"]
     
-    # get stored next data
+    # get stored next data; the cached classifier's annotated_document_count is not used, so it can't get out of sync
     if classifier_id not in classifier_dict:
         if not _get_classifier(classifier_id):
             raise exceptions.NotFound(description="Classifier not found: could not load classifier.")
-    else:
-        # reset classifier_dict for classifier, cached classifiers are getting out of sync
-        del classifier_dict[classifier_id]
-        if not _get_classifier(classifier_id):
-            raise exceptions.NotFound(description="Classifier not found: could not load classifier.")
-        logger.debug(classifier_dict[classifier_id])
     pipeline = pydash.get(classifier_pipelines, classifier_id, None)
     if pipeline is None:
         return jsonify("Error, pipeline not found"), 500
-    instance = _get_next_instance(classifier_id)
 
-    data = None
     trained = False
     request_body = None
 
-    if document_id in instance["overlap_document_ids"][user_id]:
-        instance["overlap_document_ids"][user_id].remove(document_id)
-        data = {"overlap_document_ids": instance["overlap_document_ids"]}
-    elif document_id in instance["document_ids"]:
-        instance["document_ids"].remove(document_id)
-        data = {"document_ids": instance["document_ids"]}
-    else:
+    # removed from the user's overlap queue, or else from the ranking (both the head and the rest, since until the
+    # pipeline saved the rest of a new ranking the rest is still the previous ranking)
+    if not NEXT_INSTANCES.remove(classifier_id, user_id, document_id, lambda: _get_next_instance(classifier_id)):
         logger.info("Document {} not found in instance, document already annotated".format(document_id))
-
-    if data is not None:
-        headers = {"If-Match": instance["_etag"]}
-        r = service.patch(["next_instances", instance["_id"]], json = data, headers = headers)
-        #r = requests.patch(ENTRY_POINT + "/next_instances/" + items[0]["_id"], json.dumps(data), headers=headers)
-        if not r.ok:
-            abort(r.status_code, r.content)
-
-        classifier_dict[classifier_id]["annotated_document_count"] += 1
-        headers = {"If-Match": classifier_dict[classifier_id]["_etag"]}
-        service.remove_nonupdatable_fields(classifier_dict[classifier_id])
-        r = service.patch(["classifiers", classifier_id], json=classifier_dict[classifier_id], headers=headers)
+    else:
+        # incremented atomically by eve, so exactly one annotator gets the count that triggers training
+        r = service.post(["classifiers", classifier_id, "annotated_document_count"])
         if not r.ok:
             abort(r.status_code, r.content)
-        del classifier_dict[classifier_id]
-        if not _get_classifier(classifier_id):
-            raise exceptions.NotFound(description="Classifier not found: could not load classifier.")
+        counts = r.json()
 
-        if classifier_dict[classifier_id]["annotated_document_count"] % classifier_dict[classifier_id]["train_every"] == 0:
+        if counts["annotated_document_count"] % counts["train_every"] == 0:
             ## Check to see if we should update classifier
             ## Add to work queue to update classifier - queue is pipeline_id
             ## ADD TO PUBSUB {classifier_id} to reload
@@ -254,4 +230,5 @@ def test_redis():
 
 def init_app(app):
     service_manager.start_listeners()
+    queues.init_app(app)
     app.register_blueprint(bp)
@@ -0,0 +1,248 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import logging
+import threading
+import time
+
+import click
+from flask.cli import with_appcontext
+import redis
+
+from ..data import service
+from ..shared.config import ConfigBuilder
+
+config = ConfigBuilder.get_config()
+logger = logging.getLogger(__name__)
+
+# The documents annotators are given next are kept in redis, so that advancing a document is a single atomic removal
+# instead of a read-modify-write of the whole next_instances item in eve (which made concurrent annotators fail with
+# 412s).  For a classifier, under "<prefix><classifier_id>:":
+#   "meta"                hash with the eve id of its next_instances item; the queues are loaded if it exists
+#   "head"                sorted set of the head_document_ids, scored by rank
+#   "documents"           sorted set of the document_ids, scored by rank
+#   "overlap:<user_id>"   sorted set of a user's overlap_document_ids, scored by position
+#   "overlap-users"       set of the users whose overlap queue was created
+# Like the lists of the next_instances item were pop()ped, every queue is served from its end (the highest score), so
+# rankings are stored best last.
+# Classifiers whose queues changed are added to the "<prefix>dirty" set, and their next_instances item is periodically
+# replaced by a snapshot of the queues.  The pipelines write new rankings with the same layout (see
+# pipelines/pine/pipelines/next_instances.py).
+
+KEY_PREFIX = config.REDIS_PREFIX + "next-instances:"
+DIRTY_KEY = KEY_PREFIX + "dirty"
+ZADD_CHUNK_SIZE = 10000
+
+def _key(classifier_id, *parts):
+    return ":".join([KEY_PREFIX + classifier_id] + list(parts))
+
+def _zadd_list(pipe, key, document_ids):
+    for start in range(0, len(document_ids), ZADD_CHUNK_SIZE):
+        chunk = document_ids[start:start + ZADD_CHUNK_SIZE]
+        pipe.zadd(key, {document_id: start + i for (i, document_id) in enumerate(chunk)})
+
+class NextInstanceQueues(object):
+    """The next documents of every classifier, with one queue for its ranking and one per annotator for overlap.
+    """
+
+    # KEYS: meta, user's overlap queue, head, documents, dirty; ARGV: document_id, classifier_id
+    # returns -1 if the queues aren't loaded, 1 if the document was removed from the overlap queue, 2 if it was removed
+    # from the ranking and 0 if it wasn't queued
+    REMOVE_SCRIPT = """
+    if redis.call("EXISTS", KEYS[1]) == 0 then
+        return -1
+    end
+    if redis.call("ZREM", KEYS[2], ARGV[1]) == 1 then
+        redis.call("SADD", KEYS[5], ARGV[2])
+        return 1
+    end
+    if redis.call("ZREM", KEYS[3], ARGV[1]) + redis.call("ZREM", KEYS[4], ARGV[1]) > 0 then
+        redis.call("SADD", KEYS[5], ARGV[2])
+        return 2
+    end
+    return 0
+    """
+
+    def __init__(self, r_conn):
+        self.r_conn = r_conn
+        self.remove_script = r_conn.register_script(self.REMOVE_SCRIPT)
+
+    def is_loaded(self, classifier_id):
+        return self.r_conn.exists(_key(classifier_id, "meta")) > 0
+
+    def load(self, classifier_id, instance):
+        """Replaces the classifier's queues with the contents of a next_instances item.
+
+        :param classifier_id: str: the classifier id
+        :param instance: dict: the classifier's next_instances item
+        """
+        old_users = self.r_conn.smembers(_key(classifier_id, "overlap-users"))
+        overlap = instance.get("overlap_document_ids", {})
+        with self.r_conn.pipeline() as pipe:
+            pipe.delete(_key(classifier_id, "head"), _key(classifier_id, "documents"),
+                        _key(classifier_id, "overlap-users"),
+                        *[_key(classifier_id, "overlap", user_id) for user_id in old_users])
+            _zadd_list(pipe, _key(classifier_id, "head"), instance.get("head_document_ids", []))
+            _zadd_list(pipe, _key(classifier_id, "documents"), instance.get("document_ids", []))
+            for (user_id, document_ids) in overlap.items():
+                _zadd_list(pipe, _key(classifier_id, "overlap", user_id), document_ids)
+            if overlap:
+                pipe.sadd(_key(classifier_id, "overlap-users"), *overlap.keys())
+            pipe.hset(_key(classifier_id, "meta"), mapping={"eve_id": instance["_id"], "loaded_at": time.time()})
+            pipe.execute()
+
+    def ensure_loaded(self, classifier_id, get_instance):
+        """Loads the classifier's queues from eve unless they already are.
+
+        :param classifier_id: str: the classifier id
+        :param get_instance: callable: returns the classifier's next_instances item
+        """
+        if self.is_loaded(classifier_id):
+            return
+        with self.r_conn.lock(_key(classifier_id, "loading"), timeout=60):
+            if not self.is_loaded(classifier_id):
+                logger.info("Loading next instances of classifier {} from eve".format(classifier_id))
+                self.load(classifier_id, get_instance())
+
+    def has_overlap_user(self, classifier_id, user_id):
+        return self.r_conn.sismember(_key(classifier_id, "overlap-users"), user_id)
+
+    def add_overlap_user(self, classifier_id, user_id, document_ids):
+        """Creates a user's overlap queue, unless another request did already.
+
+        :param classifier_id: str: the classifier id
+        :param user_id: str: the user id
+        :param document_ids: list: the overlap document ids
+        """
+        if not self.r_conn.sadd(_key(classifier_id, "overlap-users"), user_id):
+            return
+        with self.r_conn.pipeline() as pipe:
+            _zadd_list(pipe, _key(classifier_id, "overlap", user_id), document_ids)
+            pipe.sadd(DIRTY_KEY, classifier_id)
+            pipe.execute()
+
+    def peek(self, classifier_id):
+        """Returns the best ranked document, the last of the head or else of the rest, or None if there are no more.
+
+        :param classifier_id: str: the classifier id
+        :return: str
+        """
+        for queue in ("head", "documents"):
+            document_ids = self.r_conn.zrevrange(_key(classifier_id, queue), 0, 0)
+            if document_ids:
+                return document_ids[0]
+        return None
+
+    def peek_overlap(self, classifier_id, user_id):
+        """Returns the user's next overlap document, the last of their queue, or None if there are no more.
+
+        :param classifier_id: str: the classifier id
+        :param user_id: str: the user id
+        :return: str
+        """
+        document_ids = self.r_conn.zrevrange(_key(classifier_id, "overlap", user_id), 0, 0)
+        return document_ids[0] if document_ids else None
+
+    def remove(self, classifier_id, user_id, document_id, get_instance):
+        """Removes an annotated document from the user's overlap queue or else from the ranking.
+
+        :param classifier_id: str: the classifier id
+        :param user_id: str: the user id
+        :param document_id: str: the document id
+        :param get_instance: callable: returns the classifier's next_instances item, if the queues need to be loaded
+        :return: bool whether the document was queued
+        """
+        keys = [_key(classifier_id, "meta"), _key(classifier_id, "overlap", user_id), _key(classifier_id, "head"),
+                _key(classifier_id, "documents"), DIRTY_KEY]
+        removed = self.remove_script(keys=keys, args=[document_id, classifier_id])
+        if removed == -1:
+            self.ensure_loaded(classifier_id, get_instance)
+            removed = self.remove_script(keys=keys, args=[document_id, classifier_id])
+        return removed > 0
+
+    def snapshot(self, classifier_id):
+        """Returns the classifier's queues as the fields of its next_instances item.
+
+        :param classifier_id: str: the classifier id
+        :return: tuple of the eve id and the fields, or None if the queues aren't loaded
+        """
+        users = list(self.r_conn.smembers(_key(classifier_id, "overlap-users")))
+        with self.r_conn.pipeline() as pipe:
+            pipe.hget(_key(classifier_id, "meta"), "eve_id")
+            pipe.zrange(_key(classifier_id, "head"), 0, -1)
+            pipe.zrange(_key(classifier_id, "documents"), 0, -1)
+            for user_id in users:
+                pipe.zrange(_key(classifier_id, "overlap", user_id), 0, -1)
+            results = pipe.execute()
+        if results[0] is None:
+            return None
+        return results[0], {
+            "head_document_ids": results[1],
+            "document_ids": results[2],
+            "overlap_document_ids": dict(zip(users, results[3:]))
+        }
+
+    def save_snapshot(self, classifier_id):
+        """Writes the classifier's queues to its next_instances item in eve.
+
+        :param classifier_id: str: the classifier id
+        :return: bool whether it was saved
+        """
+        snapshot = self.snapshot(classifier_id)
+        if snapshot is None:
+            return False
+        (eve_id, data) = snapshot
+        instance = service.get_item_by_id("/next_instances", eve_id)
+        resp = service.patch(["next_instances", eve_id], json = data, headers = {"If-Match": instance["_etag"]})
+        if not resp.ok:
+            logger.warning("Unable to save next instances of classifier {}: {}".format(classifier_id, resp.content))
+        return resp.ok
+
+    def save_dirty_snapshots(self):
+        """Saves the queues of every classifier that changed since the last time.
+        """
+        while True:
+            classifier_id = self.r_conn.spop(DIRTY_KEY)
+            if classifier_id is None:
+                return
+            try:
+                saved = self.save_snapshot(classifier_id)
+            except Exception as e:
+                logger.error("Unable to save next instances of classifier {}: {}".format(classifier_id, e))
+                saved = False
+            if not saved and self.is_loaded(classifier_id):
+                # try again next time
+                self.r_conn.sadd(DIRTY_KEY, classifier_id)
+                return
+
+_R_POOL = redis.ConnectionPool(host=config.REDIS_HOST, port=config.REDIS_PORT, decode_responses=True)
+NEXT_INSTANCES = NextInstanceQueues(redis.StrictRedis(connection_pool=_R_POOL, charset="utf-8", decode_responses=True))
+
+def _save_snapshots_forever(app, interval):
+    with app.app_context():
+        while True:
+            time.sleep(interval)
+            try:
+                NEXT_INSTANCES.save_dirty_snapshots()
+            except Exception as e:
+                logger.error("Unable to save next instances snapshots: {}".format(e))
+
+@click.command("import-next-instances")
+@with_appcontext
+def import_next_instances_command():
+    """Loads every next_instances item from eve into redis, replacing queues that were loaded already."""
+    click.echo("Using data backend {}".format(service.url("")))
+    instances = service.get_all_using_pagination("next_instances", {})["_items"]
+    for instance in instances:
+        NEXT_INSTANCES.load(instance["classifier_id"], instance)
+        click.echo("* classifier {}: {} + {} documents, {} overlap users".format(
+            instance["classifier_id"], len(instance.get("head_document_ids", [])), len(instance["document_ids"]),
+            len(instance["overlap_document_ids"])))
+    click.echo("Imported {} next instances.".format(len(instances)))
+
+def init_app(app):
+    app.cli.add_command(import_next_instances_command)
+    interval = app.config.get("NEXT_INSTANCES_SNAPSHOT_INTERVAL", 30)
+    if interval > 0:
+        thread = threading.Thread(target = _save_snapshots_forever, args = (app, interval), daemon = True,
+                                  name = "next_instances_snapshots")
+        thread.start()
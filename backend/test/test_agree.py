@@ -0,0 +1,121 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.pineiaa.bratiaa import agree
+from pine.backend.pineiaa.bratiaa.evaluation import exact_match_token_evaluation
+from pine.backend.pineiaa.bratiaa.utils import tokenize
+
+
+def random_indices(rng, shape, n):
+    return tuple(rng.randint(0, size, n) for size in shape)
+
+
+def make_documents(rng, num_documents, annotators, labels):
+    # every document is annotated by a few of the annotators, with overlapping and differing spans
+    json_list = []
+    for i in range(num_documents):
+        annotations = {}
+        for annotator in rng.choice(annotators, rng.randint(2, 4), replace = False):
+            spans = []
+            for _ in range(rng.randint(0, 5)):
+                start = int(rng.randint(0, 8)) * 5
+                spans.append([start, start + 4, str(rng.choice(labels))])
+            annotations[str(annotator)] = spans
+        json_list.append({"_id": "doc%d" % i, "text": " ".join(["word"] * 10), "annotations": annotations})
+    return agree.input_generator(json_list)
+
+
+class CountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.shape = (6, 40, 3, 5)
+
+    def filled(self, adds):
+        dense, sparse = agree.DenseCounts(self.shape), agree.SparseCounts(self.shape)
+        for (indices, values) in adds:
+            dense.add(indices, values)
+            sparse.add(indices, values)
+        return dense, sparse
+
+    def test_sparse_matches_dense(self):
+        # several batches with repeated indices, scalar and array values
+        adds = [(random_indices(self.rng, self.shape, 200), 1),
+                (random_indices(self.rng, self.shape, 50), self.rng.randint(0, 4, 50)),
+                (random_indices(self.rng, self.shape, 0), 1)]
+        dense, sparse = self.filled(adds)
+        for axis in (0, 1, (0, 1), (0, 1, 3), (1, 3)):
+            np.testing.assert_array_equal(sparse.sum(axis), dense.sum(axis))
+        for doc_idx in range(self.shape[1]):
+            np.testing.assert_array_equal(sparse.document(doc_idx), dense.document(doc_idx))
+
+    def test_document_after_more_additions(self):
+        dense, sparse = self.filled([(random_indices(self.rng, self.shape, 100), 1)])
+        sparse.document(3)
+        more = random_indices(self.rng, self.shape, 100)
+        dense.add(more)
+        sparse.add(more)
+        for doc_idx in range(self.shape[1]):
+            np.testing.assert_array_equal(sparse.document(doc_idx), dense.document(doc_idx))
+
+    def test_empty_counts(self):
+        dense, sparse = self.filled([])
+        np.testing.assert_array_equal(sparse.sum((0, 1)), dense.sum((0, 1)))
+        np.testing.assert_array_equal(sparse.document(0), dense.document(0))
+
+    def test_make_counts(self):
+        annotators, documents = make_documents(self.rng, 10, ["a", "b", "c", "d"], ["X", "Y"])
+        self.assertIsInstance(agree.make_counts(6, documents, 2), agree.DenseCounts)
+        with mock.patch.object(agree, "DENSE_MAX_SIZE", 0):
+            with mock.patch.object(agree, "SPARSE_MAX_DENSITY", 1.1):
+                self.assertIsInstance(agree.make_counts(6, documents, 2), agree.SparseCounts)
+            with mock.patch.object(agree, "SPARSE_MAX_DENSITY", 0.0):
+                self.assertIsInstance(agree.make_counts(6, documents, 2), agree.DenseCounts)
+
+
+class F1AgreementTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.labels = ["X", "Y", "Z"]
+        self.annotators, self.documents = make_documents(rng, 30, ["a", "b", "c", "d", "e"], self.labels)
+
+    def agreement(self, document_counts = None):
+        # as computed by the IAA service
+        return agree.F1Agreement(self.annotators, self.documents, self.labels, eval_func = exact_match_token_evaluation,
+                                 token_func = tokenize, document_counts = document_counts)
+
+    def assert_same_report(self, expected, actual):
+        for method in ("mean_sd_per_label", "mean_sd_per_document", "mean_sd_total", "compute_total_f1_matrix"):
+            np.testing.assert_allclose(getattr(actual, method)(), getattr(expected, method)(), equal_nan = True)
+        self.assertEqual(actual.counts_per_document(), expected.counts_per_document())
+
+    def test_sparse_counts_give_the_same_report(self):
+        dense = self.agreement()
+        self.assertIsInstance(dense._pdcl, agree.DenseCounts)
+        with mock.patch.object(agree, "DENSE_MAX_SIZE", 0), mock.patch.object(agree, "SPARSE_MAX_DENSITY", 1.1):
+            sparse = self.agreement()
+        self.assertIsInstance(sparse._pdcl, agree.SparseCounts)
+        self.assert_same_report(dense, sparse)
+
+    def test_previous_document_counts_give_the_same_report(self):
+        full = self.agreement()
+        counts = full.counts_per_document()
+        # half of the documents are taken from the previous counts, the rest are evaluated again
+        previous = {doc_id: c for (i, (doc_id, c)) in enumerate(sorted(counts.items())) if i % 2 == 0}
+        self.assert_same_report(full, self.agreement(document_counts = previous))
+
+
+if __name__ == "__main__":
+    unittest.main()
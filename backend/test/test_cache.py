@@ -0,0 +1,83 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.data import cache
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_get_returns_value_until_ttl_expires(self):
+        c = cache.TTLCache(maxsize = 10, ttl = 30)
+        with mock.patch("time.monotonic", return_value = 100.0):
+            c.set("a", 1)
+        with mock.patch("time.monotonic", return_value = 129.0):
+            self.assertEqual(c.get("a"), 1)
+        with mock.patch("time.monotonic", return_value = 131.0):
+            self.assertIsNone(c.get("a"))
+            self.assertEqual(c.get("a", "default"), "default")
+        self.assertNotIn("a", c.data)
+
+    def test_maxsize_evicts_least_recently_used(self):
+        c = cache.TTLCache(maxsize = 2, ttl = 30)
+        c.set("a", 1)
+        c.set("b", 2)
+        self.assertEqual(c.get("a"), 1)  # b is now the least recently used
+        c.set("c", 3)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("c"), 3)
+
+    def test_disabled_cache_stores_nothing(self):
+        for (maxsize, ttl) in ((0, 30), (10, 0)):
+            c = cache.TTLCache(maxsize = maxsize, ttl = ttl)
+            c.set("a", 1)
+            self.assertIsNone(c.get("a"))
+
+    def test_invalidate_and_configure_drop_entries(self):
+        c = cache.TTLCache()
+        c.set("a", 1)
+        c.set("b", 2)
+        c.invalidate("a")
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.get("b"), 2)
+        c.configure(maxsize = 5, ttl = 5)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual((c.maxsize, c.ttl), (5, 5))
+
+
+class RequestMemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def test_memo_is_shared_within_a_request(self):
+        with self.app.test_request_context():
+            cache.request_memo("x")["a"] = 1
+            self.assertEqual(cache.request_memo("x"), {"a": 1})
+            self.assertEqual(cache.request_memo("y"), {})
+
+    def test_memo_does_not_outlive_the_request(self):
+        with self.app.test_request_context():
+            cache.request_memo("x")["a"] = 1
+        with self.app.test_request_context():
+            self.assertEqual(cache.request_memo("x"), {})
+
+    def test_nothing_is_memoized_outside_a_request(self):
+        memo = cache.request_memo("x")
+        memo["a"] = 1
+        self.assertEqual(cache.request_memo("x"), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
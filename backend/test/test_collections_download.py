@@ -0,0 +1,111 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import gzip
+import json
+import os
+import sys
+import unittest
+import zlib
+from unittest import mock
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.collections import bp
+
+HEADER = {"_id": "c1", "labels": ["PER"]}
+
+# as eve's documents_with_annotations streams them, with details=1 and versions=1
+DOCUMENTS = [
+    {"_id": "d1", "overlap": 0, "text": "Alice", "metadata": {"name": "one"}, "creator_id": "ada",
+     "annotations": [{"_id": "a1", "creator_id": "bob", "annotation": [[0, 5, "PER"]], "_version": 2}],
+     "annotation_versions": [
+         {"_id_document": "a1", "_version": 2, "creator_id": "bob", "annotation": [[0, 5, "PER"]]},
+         {"_id_document": "a1", "_version": 1, "creator_id": "bob", "annotation": []}
+     ]},
+    {"_id": "d2", "overlap": 1, "text": "Bob", "metadata": {}, "creator_id": "ada",
+     # saved before versioning was turned on
+     "annotations": [{"_id": "a2", "creator_id": "bob", "annotation": ["X"]}],
+     "annotation_versions": []},
+    {"_id": "d3", "overlap": 0, "text": "", "metadata": {}, "creator_id": "ada", "annotations": [],
+     "annotation_versions": []}
+]
+# with versions=0
+LATEST_DOCUMENTS = [
+    dict({key: value for key, value in d.items() if key != "annotation_versions"},
+         annotations = [{key: value for key, value in a.items() if key != "_version"} for a in d["annotations"]])
+    for d in DOCUMENTS
+]
+
+
+class DownloadCollectionNdjsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def download(self, documents, include_document_metadata = True, include_annotations = True,
+                 latest_version_only = True, compress = False):
+        with self.app.test_request_context(), \
+                mock.patch.object(bp.service, "iter_ndjson",
+                                  return_value = iter(json.loads(json.dumps(documents)))) as iter_ndjson:
+            resp = bp._download_collection_ndjson("c1", HEADER, include_document_metadata, True, include_annotations,
+                                                  latest_version_only, True, compress)
+            chunks = list(resp.response)
+        # one streamed request for the whole collection
+        iter_ndjson.assert_called_once_with(["collections", "c1", "documents_with_annotations"], mock.ANY)
+        return resp, iter_ndjson.call_args[0][1], b"".join(chunks)
+
+    def lines(self, body):
+        self.assertTrue(body.endswith(b"\n"))
+        return [json.loads(line) for line in body.split(b"\n")[:-1]]
+
+    def test_one_line_per_document_after_the_collection(self):
+        resp, params, body = self.download(LATEST_DOCUMENTS)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertEqual(resp.headers["Content-Disposition"], "attachment; filename=collection_c1.ndjson")
+        self.assertEqual(params, {"details": 1, "metadata": 1, "text": 1, "annotations": 1, "versions": 0})
+        lines = self.lines(body)
+        self.assertEqual(lines[0], HEADER)
+        self.assertEqual([line["_id"] for line in lines[1:]], ["d1", "d2", "d3"])
+        self.assertEqual(lines[1]["annotations"], [{"_id": "a1", "creator_id": "bob", "annotation": [[0, 5, "PER"]]}])
+        self.assertEqual(lines[1]["metadata"], {"name": "one"})
+        self.assertEqual(lines[3]["annotations"], [])
+
+    def test_full_history_comes_with_the_documents(self):
+        _, params, body = self.download(DOCUMENTS, latest_version_only = False)
+        self.assertEqual(params["versions"], 1)
+        lines = self.lines(body)
+        self.assertNotIn("annotation_versions", lines[1])
+        self.assertEqual(lines[1]["annotations"], [
+            {"_id": "a1", "creator_id": "bob", "annotation": [], "_version": 1, "_latest_version": 2},
+            {"_id": "a1", "creator_id": "bob", "annotation": [[0, 5, "PER"]], "_version": 2, "_latest_version": 2}
+        ])
+        self.assertEqual(lines[2]["annotations"], [
+            {"_id": "a2", "creator_id": "bob", "annotation": ["X"], "_version": 1, "_latest_version": 1}
+        ])
+
+    def test_without_metadata_or_annotations(self):
+        documents = [{"_id": d["_id"], "overlap": d["overlap"], "text": d["text"]} for d in DOCUMENTS]
+        _, params, body = self.download(documents, include_document_metadata = False, include_annotations = False)
+        self.assertEqual(params, {"details": 0, "metadata": 0, "text": 1, "annotations": 0, "versions": 0})
+        self.assertEqual(self.lines(body)[1:], [{"_id": d["_id"], "text": d["text"]} for d in DOCUMENTS])
+
+    def test_gzip_is_one_member_of_the_ndjson(self):
+        _, _, uncompressed = self.download(LATEST_DOCUMENTS)
+        resp, _, compressed = self.download(LATEST_DOCUMENTS, compress = True)
+        self.assertEqual(resp.mimetype, "application/gzip")
+        self.assertEqual(resp.headers["Content-Disposition"], "attachment; filename=collection_c1.ndjson.gz")
+        self.assertEqual(compressed[:2], b"\x1f\x8b")
+        decompressor = zlib.decompressobj(wbits = 16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(compressed), uncompressed)
+        self.assertTrue(decompressor.eof)
+        self.assertEqual(decompressor.unused_data, b"")
+        self.assertEqual(gzip.decompress(compressed), uncompressed)
+
+
+if __name__ == "__main__":
+    unittest.main()
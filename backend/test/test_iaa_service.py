@@ -0,0 +1,79 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.pineiaa.bratiaa import iaa_service
+
+
+def annotation(creator_id, updated, spans = ()):
+    return {"creator_id": creator_id, "_updated": updated, "annotation": list(spans)}
+
+
+class SignatureTest(unittest.TestCase):
+
+    def get_doc_annotations(self, annotations, exclude = None):
+        documents = [{"_id": "d1", "annotations": annotations}]
+        with mock.patch.object(iaa_service.service, "iter_ndjson", return_value = iter(documents)):
+            return iaa_service.get_doc_annotations("c1", exclude = exclude, include_text = False)["d1"]
+
+    def test_signature_does_not_depend_on_order(self):
+        a, b = annotation("a", "Mon, 01 Jan 2019 00:00:01 GMT"), annotation("b", "Mon, 01 Jan 2019 00:00:02 GMT")
+        self.assertEqual(iaa_service.annotations_signature([a, b]), iaa_service.annotations_signature([b, a]))
+
+    def test_signature_changes_when_annotation_is_replaced(self):
+        # same number of annotations and same latest update, but one annotator's annotation was swapped for another's
+        before = [annotation("a", "Mon, 01 Jan 2019 00:00:01 GMT"), annotation("b", "Mon, 01 Jan 2019 00:00:05 GMT")]
+        after = [annotation("c", "Mon, 01 Jan 2019 00:00:01 GMT"), annotation("b", "Mon, 01 Jan 2019 00:00:05 GMT")]
+        self.assertNotEqual(iaa_service.annotations_signature(before), iaa_service.annotations_signature(after))
+
+    def test_signature_changes_when_annotation_is_updated(self):
+        before = [annotation("a", "Mon, 01 Jan 2019 00:00:01 GMT"), annotation("b", "Mon, 01 Jan 2019 00:00:05 GMT")]
+        after = [annotation("a", "Mon, 01 Jan 2019 00:00:03 GMT"), annotation("b", "Mon, 01 Jan 2019 00:00:05 GMT")]
+        self.assertNotEqual(iaa_service.annotations_signature(before), iaa_service.annotations_signature(after))
+
+    def test_excluded_annotators_are_left_out(self):
+        annotations = [annotation("a", "1", [[0, 1, "X"]]), annotation("b", "2", [[0, 1, "Y"]])]
+        everyone = self.get_doc_annotations(annotations)
+        without_b = self.get_doc_annotations(annotations, exclude = {"b"})
+        self.assertEqual(sorted(everyone["annotations"]), ["a", "b"])
+        self.assertEqual(sorted(without_b["annotations"]), ["a"])
+        self.assertNotEqual(everyone["signature"], without_b["signature"])
+        self.assertEqual(without_b["signature"], iaa_service.annotations_signature([annotations[0]]))
+
+
+class SaveDocumentCountsTest(unittest.TestCase):
+
+    def test_only_new_and_changed_documents_are_written(self):
+        previous = {
+            "same": {"_id": "same", "_etag": "e1", "signature": "s1", "counts": []},
+            "changed": {"_id": "changed", "_etag": "e2", "signature": "s2", "counts": []}
+        }
+        counts = {
+            "same": {"signature": "s1", "counts": []},
+            "changed": {"signature": "s3", "counts": [["a", "b", "X", 1, 0, 0]]}
+        }
+        counts.update({"new%d" % i: {"signature": "s", "counts": []} for i in range(iaa_service.COUNTS_CHUNK_SIZE + 1)})
+        ok = mock.Mock(ok = True)
+        with mock.patch.object(iaa_service.service, "post", return_value = ok) as post, \
+                mock.patch.object(iaa_service.service, "put", return_value = ok) as put:
+            iaa_service.save_document_counts("c1", previous, counts)
+        put.assert_called_once_with(["iaa_document_counts", "changed"], headers = {"If-Match": "e2"},
+                                    json = {"collection_id": "c1", "signature": "s3",
+                                            "counts": [["a", "b", "X", 1, 0, 0]]})
+        # new documents are posted in chunks
+        self.assertEqual(post.call_count, 2)
+        posted = [item for call in post.call_args_list for item in call[1]["json"]]
+        self.assertEqual(sorted(item["_id"] for item in posted), sorted(d for d in counts if d.startswith("new")))
+        self.assertTrue(all(item["collection_id"] == "c1" for item in posted))
+
+
+if __name__ == "__main__":
+    unittest.main()
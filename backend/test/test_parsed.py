@@ -0,0 +1,63 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.data import parsed
+
+
+class GetTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["PARSED_CHUNK_SIZE"] = 2
+
+    def get_tokens(self, documents, items):
+        ok = mock.Mock(ok = True)
+        with self.app.app_context(), \
+                mock.patch.object(parsed, "_get_items", return_value = items), \
+                mock.patch.object(parsed.service, "post", return_value = ok) as post, \
+                mock.patch.object(parsed.service, "put", return_value = ok) as put:
+            tokens = parsed.get_tokens(documents, "whitespace")
+        return tokens, post, put
+
+    def test_new_documents_are_saved_in_chunks(self):
+        documents = [{"_id": "d%d" % i, "collection_id": "c1", "text": "some text %d" % i} for i in range(3)]
+        tokens, post, put = self.get_tokens(documents, {})
+        self.assertEqual(tokens["d0"], [(0, 4), (5, 9), (10, 11)])
+        self.assertEqual([len(call[1]["json"]) for call in post.call_args_list], [2, 1])
+        item = post.call_args_list[0][1]["json"][0]
+        self.assertEqual((item["_id"], item["collection_id"]), ("d0", "c1"))
+        self.assertEqual(item["text_hash"], parsed.text_hash("some text 0"))
+        self.assertEqual(parsed.decode_offsets(item["tokens"]["whitespace"]), tokens["d0"])
+        put.assert_not_called()
+
+    def test_saved_tokens_are_read_and_stale_ones_replaced(self):
+        documents = [{"_id": "same", "collection_id": "c1", "text": "same text"},
+                     {"_id": "changed", "collection_id": "c1", "text": "new text"}]
+        items = {
+            "same": {"_id": "same", "_etag": "e1", "text_hash": parsed.text_hash("same text"),
+                     "tokens": {"whitespace": parsed.encode_offsets([(0, 9)])}},
+            "changed": {"_id": "changed", "_etag": "e2", "text_hash": parsed.text_hash("old text"),
+                        "tokens": {"whitespace": parsed.encode_offsets([(0, 8)])}}
+        }
+        tokens, post, put = self.get_tokens(documents, items)
+        self.assertEqual(tokens, {"same": [(0, 9)], "changed": [(0, 3), (4, 8)]})
+        post.assert_not_called()
+        put.assert_called_once()
+        self.assertEqual(put.call_args[0][0], ["parsed", "changed"])
+        self.assertEqual(put.call_args[1]["headers"], {"If-Match": "e2"})
+        self.assertNotIn("_id", put.call_args[1]["json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the backend directory with
+#   pipenv run python -m unittest discover -s test
+
+import copy
+import os
+import random
+import sys
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.backend.pipelines import queues
+
+
+def old_remove(instance, user_id, document_id):
+    # what advancing a document did to the next_instances item in eve
+    if document_id in instance["overlap_document_ids"].get(user_id, []):
+        instance["overlap_document_ids"][user_id].remove(document_id)
+        return True
+    removed = False
+    for field in ("head_document_ids", "document_ids"):
+        if document_id in instance[field]:
+            instance[field].remove(document_id)
+            removed = True
+    return removed
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class NextInstanceQueuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r_conn = fakeredis.FakeStrictRedis(decode_responses = True)
+        self.queues = queues.NextInstanceQueues(self.r_conn)
+        self.instance = {
+            "_id": "n1",
+            "head_document_ids": ["d3", "d1"],
+            "document_ids": ["d3", "d1", "d4", "d0", "d2", "d5"],
+            "overlap_document_ids": {"u1": ["d5", "d2"], "u2": []}
+        }
+
+    def get_instance(self):
+        return copy.deepcopy(self.instance)
+
+    def assert_same_queues(self, instance):
+        (eve_id, data) = self.queues.snapshot("c1")
+        self.assertEqual(eve_id, instance["_id"])
+        self.assertEqual(data["head_document_ids"], instance["head_document_ids"])
+        self.assertEqual(data["document_ids"], instance["document_ids"])
+        self.assertEqual(data["overlap_document_ids"], instance["overlap_document_ids"])
+
+    def test_queues_are_loaded_on_first_use(self):
+        self.assertIsNone(self.queues.snapshot("c1"))
+        self.assertTrue(self.queues.remove("c1", "u1", "d4", self.get_instance))
+        old_remove(self.instance, "u1", "d4")
+        self.assert_same_queues(self.instance)
+        self.assertEqual(self.r_conn.smembers(queues.DIRTY_KEY), {"c1"})
+
+    def test_remove_matches_the_eve_item_updates(self):
+        self.queues.load("c1", self.get_instance())
+        expected = self.get_instance()
+        rng = random.Random(0)
+        for _ in range(20):
+            user_id = rng.choice(["u1", "u2", "u3"])
+            document_id = rng.choice(["d%d" % i for i in range(7)])
+            self.assertEqual(self.queues.remove("c1", user_id, document_id, self.fail),
+                             old_remove(expected, user_id, document_id))
+            self.assert_same_queues(expected)
+
+    def serve(self, peek, user_id):
+        served = []
+        document_id = peek()
+        while document_id is not None:
+            served.append(document_id)
+            self.queues.remove("c1", user_id, document_id, self.fail)
+            document_id = peek()
+        return served
+
+    def test_peek(self):
+        self.queues.load("c1", self.get_instance())
+        # every queue is served from its end, as the lists of the next_instances item were popped: the head first,
+        # then the rest of the ranking without the documents already served from the head
+        self.assertEqual(self.serve(lambda: self.queues.peek_overlap("c1", "u1"), "u1"), ["d2", "d5"])
+        self.assertIsNone(self.queues.peek_overlap("c1", "u2"))
+        self.assertEqual(self.serve(lambda: self.queues.peek("c1"), "u2"), ["d1", "d3", "d5", "d2", "d0", "d4"])
+
+    def test_overlap_users_are_added_once(self):
+        self.queues.load("c1", self.get_instance())
+        self.r_conn.delete(queues.DIRTY_KEY)
+        self.assertFalse(self.queues.has_overlap_user("c1", "u3"))
+        self.queues.add_overlap_user("c1", "u3", ["d1", "d0"])
+        self.queues.add_overlap_user("c1", "u3", ["d4"])
+        self.assertTrue(self.queues.has_overlap_user("c1", "u3"))
+        self.assertEqual(self.queues.snapshot("c1")[1]["overlap_document_ids"]["u3"], ["d1", "d0"])
+        self.assertEqual(self.r_conn.smembers(queues.DIRTY_KEY), {"c1"})
+
+
+if __name__ == "__main__":
+    unittest.main()
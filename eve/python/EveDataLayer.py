@@ -7,9 +7,13 @@ import xml.etree.ElementTree as ET
 import os
 import subprocess
 import tempfile
+from datetime import datetime
 
+from bson import ObjectId
+from bson.errors import InvalidId
 from eve import Eve
-from flask import jsonify, request, send_file
+from pymongo import ReturnDocument
+from flask import jsonify, request, send_file, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug import exceptions
 
@@ -52,6 +56,20 @@ def create_app():
     app = Eve(json_encoder=JHEDEncoder, validator=JHEDValidator)
     app.on_post_GET_documents += post_documents_get_callback
 
+    def keep_annotated_document_count_on_replace(document, original):
+        # the count is only changed by increment_annotated_document_count, whose $inc leaves the etag alone: a PUT
+        # from a stale GET would pass If-Match and overwrite it, so the stored value is kept instead
+        stored = app.data.driver.db["classifiers"].find_one({"_id": original["_id"]},
+                                                            projection = {"annotated_document_count": 1})
+        document["annotated_document_count"] = (stored or original).get("annotated_document_count", 0)
+
+    def keep_annotated_document_count_on_update(updates, original):
+        # a PATCH only sets the fields it sends, so leaving the count out is enough
+        updates.pop("annotated_document_count", None)
+
+    app.on_replace_classifiers += keep_annotated_document_count_on_replace
+    app.on_update_classifiers += keep_annotated_document_count_on_update
+
     @app.route("/system/export", methods = ["GET"])
     def system_export():
         db = app.data.driver.db
@@ -94,6 +112,92 @@ def create_app():
         finally:
             os.remove(filename)
 
+    def flag(name, default):
+        value = request.args.get(name)
+        return default if value is None else value.lower() in ("1", "true", "yes")
+
+    @app.route("/collections/<collection_id>/documents_with_annotations", methods = ["GET"])
+    def documents_with_annotations(collection_id):
+        # streams the collection's documents as NDJSON, one per line, with their annotations joined by mongo:
+        # {"_id", "overlap", "text", "metadata", "annotations": [{"_id", "creator_id", "annotation"}, ...]}
+        # query parameters: overlap=<n> for only the documents with that overlap, annotated=1 for only the documents
+        # with annotations, text=0, metadata=0 or annotations=0 to leave those out, updated=1 to add the
+        # annotations' _updated, details=1 to add the documents' other fields (all but collection_id), and versions=1
+        # to add the annotations' _version and all their stored versions, as "annotation_versions":
+        # [{"_id_document", "_version", "creator_id", "annotation"}, ...]
+        try:
+            _id = ObjectId(collection_id)
+        except (InvalidId, TypeError):
+            raise exceptions.NotFound()
+        match = {"collection_id": _id}
+        if "overlap" in request.args:
+            try:
+                match["overlap"] = int(request.args["overlap"])
+            except ValueError:
+                raise exceptions.BadRequest("Invalid overlap")
+        projection = {"_id": 1, "overlap": 1}
+        if flag("text", True):
+            projection["text"] = 1
+        if flag("metadata", True):
+            projection["metadata"] = 1
+        if flag("details", False):
+            projection.update({field: 1 for field in app.config["DOMAIN"]["documents"]["schema"]
+                               if field not in ("collection_id", "text", "metadata")})
+        pipeline = [{"$match": match}]
+        if flag("annotations", True) or flag("annotated", False):
+            pipeline.append({"$lookup": {"from": "annotations", "localField": "_id", "foreignField": "document_id",
+                                         "as": "annotations"}})
+            if flag("annotated", False):
+                pipeline.append({"$match": {"annotations.0": {"$exists": True}}})
+            if flag("annotations", True):
+                projection.update({"annotations._id": 1, "annotations.creator_id": 1, "annotations.annotation": 1})
+                if flag("updated", False):
+                    projection["annotations._updated"] = 1
+                if flag("versions", False):
+                    # eve's shadow copies of the annotations, see eve.versioning
+                    version, versioned_id = app.config["VERSION"], app.config["ID_FIELD"] + app.config["VERSION_ID_SUFFIX"]
+                    pipeline.append({"$lookup": {"from": "annotations" + app.config["VERSIONS"],
+                                                 "localField": "annotations._id", "foreignField": versioned_id,
+                                                 "as": "annotation_versions"}})
+                    projection.update({"annotations." + version: 1, "annotation_versions." + versioned_id: 1,
+                                       "annotation_versions." + version: 1, "annotation_versions.creator_id": 1,
+                                       "annotation_versions.annotation": 1})
+        pipeline.append({"$project": projection})
+        cursor = app.data.driver.db["documents"].aggregate(pipeline, allowDiskUse = True)
+
+        def lines():
+            # eve's encoder, so that ids and dates are rendered like in its other responses (dates in DATE_FORMAT,
+            # which it reads from the app's config: hence the request context kept for streaming)
+            try:
+                for document in cursor:
+                    yield json.dumps(document, cls = JHEDEncoder, separators = (",", ":")) + "\n"
+            finally:
+                cursor.close()
+        return Response(stream_with_context(lines()), mimetype = "application/x-ndjson")
+
+    @app.route("/classifiers/<classifier_id>/annotated_document_count", methods = ["POST"])
+    def increment_annotated_document_count(classifier_id):
+        # atomically increments the count and returns the new value, so that concurrent annotators each see a different
+        # one; the etag is left alone (and no new version of the classifier is stored), so that updates of the other
+        # fields, like the pipeline saving a new model's filename after training, don't conflict with the counting.
+        # PUTs and PATCHes of the classifier don't change the count, see keep_annotated_document_count_on_replace
+        try:
+            _id = ObjectId(classifier_id)
+        except (InvalidId, TypeError):
+            raise exceptions.NotFound()
+        classifier = app.data.driver.db["classifiers"].find_one_and_update(
+            {"_id": _id},
+            {"$inc": {"annotated_document_count": 1},
+             "$set": {"_updated": datetime.utcnow().replace(microsecond=0)}},
+            projection = {"annotated_document_count": 1, "train_every": 1},
+            return_document = ReturnDocument.AFTER)
+        if classifier is None:
+            raise exceptions.NotFound()
+        return jsonify({
+            "annotated_document_count": classifier["annotated_document_count"],
+            "train_every": classifier.get("train_every", 100)
+        })
+
     return app
 
 if __name__ == '__main__':
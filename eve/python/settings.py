@@ -48,6 +48,20 @@ iaa_reports = {
 
 }
 
+# the IAA counts of one document (with the document's _id) and the signature of the annotations they were computed from,
+# kept so that reports only evaluate the documents whose annotations changed
+iaa_document_counts = {
+    'schema': {
+        '_id': {'type': 'objectid', 'required': True},
+        'collection_id': {'type': 'objectid', 'required': True},
+        'signature': {'type': 'string'},
+        'counts': {'type': 'list'}
+    },
+    'mongo_indexes': {'iaa_counts_collection_id': [('collection_id', 1)]},
+    'item_methods': ['GET', 'PUT'],
+    'versioning': False
+}
+
 
 annotations = {
     'schema': {
@@ -113,11 +127,14 @@ metrics = {
         'classifier_db_version': {'type': 'integer'},
         'documents': {'type': 'list', 'required': True},
         'annotations': {'type': 'list', 'required': True},
+        'annotations_updated': {'type': 'list'},  # _updated of each of the trained annotations
         'folds': {'type': 'list'},
         'metrics': {'type': 'list'},
         'metric_averages' : {'type': 'dict'},
         'filename': {'type': 'string'},
-        'trained_classifier_db_version': {'type': 'integer'}
+        'trained_classifier_db_version': {'type': 'integer'},
+        'training_mode': {'type': 'string', 'allowed': ['full', 'warm_start']},
+        'increments_since_full_train': {'type': 'integer'}
     },
     'mongo_indexes':{'metrics_classifier_id': [('classifier_id', 1)], 'doc_collection_id':[('collection_id', 1)]},
     'item_methods':['GET', 'PUT', 'PATCH'],
@@ -128,6 +145,7 @@ next_instances = {
     'schema':{
         'classifier_id':{'type':'objectid', 'required':True},
         'document_ids':{'type':'list', 'required':True},
+        'head_document_ids':{'type':'list'},
         'overlap_document_ids':{'type':'dict', 'required':True}
     },
     'mongo_indexes':{'next_classifier_id': [('classifier_id', 1)]},
@@ -139,7 +157,10 @@ parsed = {
         'collection_id': {'type': 'objectid', 'required': True},
         '_id':{'type':'objectid', 'required':True},
         'text': {'type': 'string'},
-        'spacy':{'type':'string'}
+        'spacy':{'type':'string'},
+        # tokens of the document's text (with this hash) per tokenizer, see backend/pine/backend/data/parsed.py
+        'text_hash': {'type': 'string'},
+        'tokens': {'type': 'dict'}
     },
     'mongo_indexes':{'doc_collection_id':[('collection_id', 1)]},
     'item_methods':['GET', 'PUT', 'PATCH']
@@ -155,7 +176,8 @@ DOMAIN={
     'pipelines':pipelines,
     'next_instances':next_instances,
     'parsed':parsed,
-    'iaa_reports' : iaa_reports
+    'iaa_reports' : iaa_reports,
+    'iaa_document_counts': iaa_document_counts
 }
 
 
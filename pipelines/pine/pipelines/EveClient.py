@@ -63,16 +63,22 @@ class EveClient(object):
                     return r['_items'], None
         return [], None
 
+    # streams the collection's documents, with their annotations, from eve; params are passed on to it (see
+    # documents_with_annotations in eve's EveDataLayer.py)
+    def iter_documents_with_annotations(self, collection_id, **params):
+        url = 'http://%s/collections/%s/documents_with_annotations' % (self.entry_point, collection_id)
+        with requests.get(url, params=params, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception("Unable to get documents of collection {}: {}".format(collection_id, response.status_code))
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def get_documents(self, collection_id):
         # get documents
-        query = 'documents?where={"overlap":0,"collection_id":"%s"}' % (collection_id)
         doc_map = {}
-        while True:
-            items, query = self.get_items(query)
-            for d in items:
-                doc_map[d['_id']] = d['text']
-            if query is None:
-                break
+        for d in self.iter_documents_with_annotations(collection_id, overlap=0, metadata=0, annotations=0):
+            doc_map[d['_id']] = d['text']
 
         return doc_map
 
@@ -80,29 +86,52 @@ class EveClient(object):
         doc_ids = list()
         documents = []
         ann_ids = list()
+        ann_updated = list()
         labels = []
 
-        #get annotations and make data
-        query = 'annotations?where={"collection_id":"%s"}' % (collection_id)
-
-        while True:
-            items, query = self.get_items(query)
-
-            for a in items:
-                docid = a['document_id']
-                # remove overlaps
-                if docid not in doc_map:
-                    continue
+        #get annotations and make data; the text is in doc_map already
+        for d in self.iter_documents_with_annotations(collection_id, overlap=0, annotated=1, text=0, metadata=0,
+                                                      updated=1):
+            docid = d['_id']
+            # remove overlaps
+            if docid not in doc_map:
+                continue
+            for a in d['annotations']:
                 doc_ids.append(docid)
                 documents.append(doc_map[docid])
                 ann_ids.append(a["_id"])
+                ann_updated.append(a.get("_updated"))
                 labels.append(a["annotation"])
 
-            if query is None:
-                break
-
-        return documents, labels, doc_ids, ann_ids
+        return documents, labels, doc_ids, ann_ids, ann_updated
+
+    def get_parsed(self, doc_ids, chunk_size=100):
+        # the pre-tokenized documents (see parsed.py) by document id, without the items' other fields
+        items = dict()
+        url = 'http://%s/parsed' % self.entry_point
+        for start in range(0, len(doc_ids), chunk_size):
+            params = {'where': json.dumps({'_id': {'$in': doc_ids[start:start + chunk_size]}}),
+                      'projection': json.dumps({'text_hash': 1, 'tokens': 1})}
+            response = requests.get(url, params=params, headers=self.eve_headers)
+            if response.status_code != 200:
+                raise Exception("Unable to get parsed documents: {}".format(response.status_code))
+            for item in response.json()['_items']:
+                items[item['_id']] = item
+        return items
+
+    def add_all(self, resource, add_objects):
+        # one request for all of them; eve adds either all or none
+        r = requests.post('http://%s/%s' % (self.entry_point, resource), json.dumps(add_objects),
+                          headers=self.eve_headers)
+        return r.status_code == 201
+
+    def replace(self, resource, id, etag, replace_obj):
+        headers = {'Content-Type': 'application/json', 'If-Match': etag}
+        r = requests.put('http://%s/%s/%s' % (self.entry_point, resource, id), json.dumps(replace_obj), headers=headers)
+        return r.status_code == 200
 
+    # a PATCH, so that only the given fields are changed: a PUT of a classifier from an earlier GET would write back the
+    # annotated_document_count that the backend has incremented since (eve keeps the stored count for PUTs too)
     def update(self, resource, id, etag, update_obj):
         headers = {'Content-Type': 'application/json', 'If-Match': etag}
         r = requests.patch('http://%s/%s/%s' % (self.entry_point, resource, id),
@@ -1,8 +1,13 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
+import contextlib
 import logging
+import math
 import os
+import random
 import uuid
+from concurrent import futures
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pydash
 from skmultilearn.model_selection import IterativeStratification
@@ -10,14 +15,34 @@ from sklearn.preprocessing import MultiLabelBinarizer
 from itertools import chain
 
 from .EveClient import EveClient
+from . import jvm
 from . import RankingFunctions as rank
+from . import next_instances
+from . import parsed
 from .pmap_ner import NER
+from .model_cache import MODEL_CACHE
 from .shared.config import ConfigBuilder
 
 logger = logging.getLogger(__name__)
 config = ConfigBuilder.get_config()
 
 
+def _perform_fold(pipeline_name, train_data, test_data, pipeline_parameters, tokens=None):
+    # every fold trains its own model, so folds can run at the same time
+    model = NER(pipeline_name)
+    if tokens is not None:
+        model.set_tokens(tokens)
+    model.fit(train_data[0], train_data[1], pipeline_parameters)
+    return model.evaluate(test_data[0], test_data[1], range(0, len(test_data[0])))
+
+
+def _perform_fold_in_thread(*args):
+    try:
+        return _perform_fold(*args)
+    finally:
+        jvm.detach_thread()
+
+
 class ner_api(object):
 
     def __init__(self):
@@ -25,13 +50,20 @@ class ner_api(object):
         logger.info("Saving models to {}".format(self.model_dir))
         self.eve_client = EveClient()
 
-    def perform_fold(self, model, train_data, test_data, pipeline_parameters):
-        model.fit(train_data[0], train_data[1], pipeline_parameters)
-        results = model.evaluate(test_data[0], test_data[1], range(0, len(test_data[0])))
-
-        return results
-
-    def perform_five_fold(self, model, documents, annotations, doc_ids, pipeline_parameters):
+    # yields a pool of CV_WORKERS threads to run _perform_fold_in_thread on, and terminates the pool afterwards
+    # jobs run in the pipeline service's daemonic pool processes, which can't start processes of their own; the Java
+    # pipelines' folds share the process' JVM and their trainers release the GIL, spaCy's folds mostly take turns
+    @staticmethod
+    @contextlib.contextmanager
+    def fold_pool():
+        pool = ThreadPool(processes=max(1, config.CV_WORKERS))
+        try:
+            yield pool
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def perform_five_fold(self, pipeline_name, documents, annotations, doc_ids, pipeline_parameters, tokens=None):
         metrics = list()
         # store list of documents ids per fold
         folds = list()
@@ -57,26 +89,30 @@ class ner_api(object):
 
         total_metrics = {}
 
-        for train_index, test_index in skf.split(documents_np_array, multilabel_binarizer):
-            # get annotations train and test datasets
-            train_annotations = annotations_np_array[train_index]
-            test_annotations = annotations_np_array[test_index]
+        with self.fold_pool() as pool:
+            fold_results = []
+            for train_index, test_index in skf.split(documents_np_array, multilabel_binarizer):
+                # get annotations train and test datasets
+                train_annotations = annotations_np_array[train_index]
+                test_annotations = annotations_np_array[test_index]
 
-            # get documents train and test datasets
-            train_documents = documents_np_array[train_index]
-            test_documents = documents_np_array[test_index]
+                # get documents train and test datasets
+                train_documents = documents_np_array[train_index]
+                test_documents = documents_np_array[test_index]
 
-            fold_metrics = self.perform_fold(model, [train_documents.tolist(), train_annotations.tolist()],
-                                             [test_documents.tolist(), test_annotations.tolist()], pipeline_parameters)
+                fold_results.append(pool.apply_async(_perform_fold_in_thread, (pipeline_name,
+                                                                    [train_documents.tolist(), train_annotations.tolist()],
+                                                                    [test_documents.tolist(), test_annotations.tolist()],
+                                                                    pipeline_parameters, tokens)))
 
-            # saving docs used to train fold
-            fold_doc_ids = doc_ids_np_array[train_index]
-            folds.append(fold_doc_ids.tolist())
+                # saving docs used to train fold
+                fold_doc_ids = doc_ids_np_array[train_index]
+                folds.append(fold_doc_ids.tolist())
 
             # saving fold metrics
-            metrics.append(fold_metrics)
-
+            metrics = [fold_result.get() for fold_result in fold_results]
 
+        for fold_metrics in metrics:
             for key in fold_metrics.keys():
                 if key not in total_metrics:
                     total_metrics[key] = {"FN": 0, "FP": 0, "TP": 0, "TN": 0, "f1": 0, "precision": 0, "recall": 0, "acc": 0}
@@ -112,6 +148,23 @@ class ner_api(object):
 
         return metrics, folds, average_metrics
 
+    # gives the classifier the tokens of the documents from eve's "parsed" resource (see parsed.py), if its tokenization
+    # can be kept there; the ones that aren't there yet are computed by the classifier and saved
+    # returns {text: [(start offset, stop offset), ...]}, or None
+    def use_parsed_tokens(self, classifier, collection_id, doc_ids, texts):
+        tokenizer = classifier.tokenizer_name()
+        if tokenizer is None:
+            return None
+        try:
+            doc_tokens = parsed.get_tokens(self.eve_client, collection_id, doc_ids, texts, tokenizer, classifier.tokenize)
+        except Exception as e:
+            logger.warning("Unable to get the {} tokens of {} documents: {}".format(tokenizer, len(doc_ids), e))
+            return None
+        tokens = {text: doc_tokens[doc_id] for doc_id, text in zip(doc_ids, texts)}
+        classifier.set_tokens(tokens)
+        return tokens
+
+    # returns the RANKING_HEAD_SIZE top ranked documents, and a function returning the rest of the ranking
     def get_document_ranking(self, model, doc_map, doc_ids):
         # re rank documents
         documents_no_anns = []
@@ -122,8 +175,20 @@ class ner_api(object):
         # classifier.load_model(os.path.join(self.model_dir, filename))
         # ranks = classifier.next_example(documents_no_anns, ids_no_anns)
         results = model.predict_proba(documents_no_anns, ids_no_anns)
-        ranks = rank.least_confidence_squared(results)
-        return ranks
+        return rank.rank_top_k(results, 'lcs', config.RANKING_HEAD_SIZE)
+
+    # annotators are given the documents in head_document_ids first, so a new ranking is used as soon as its head is
+    # saved; document_ids (the rest of the ranking) is only rewritten after that
+    # both are served from their end, as the backend used to pop() them, so rankings are saved best last
+    # the backend serves them from redis once it loaded them there, and saves them to eve itself
+    def update_next_instances(self, classifier_id, field, document_ids):
+        if next_instances.save_ranking(classifier_id, field, document_ids):
+            return True
+        query = 'next_instances?where={"classifier_id":"%s"}' % classifier_id
+        next_instance_obj = self.eve_client.get_items(query)[0]
+        etag = next_instance_obj[0]['_etag']
+        id = next_instance_obj[0]['_id']
+        return self.eve_client.update('next_instances', id, etag, {field: document_ids})
 
     def get_classifier_pipeline_metrics_objs(self, classifier_id):
         classifier_obj = self.eve_client.get_obj('classifiers', classifier_id)
@@ -142,6 +207,62 @@ class ner_api(object):
 
         return classifier_obj, pipeline_obj, metrics_obj
 
+    def update_metrics(self, metrics_obj, classifier_obj, filename, doc_ids, ann_ids, ann_updated, training_mode,
+                       increments, cv_results=None):
+        metrics_updated_obj = {
+            'trained_classifier_db_version': classifier_obj['_version']+1,
+            'documents': list(set(doc_ids)),
+            'annotations': list(ann_ids),
+            'annotations_updated': list(ann_updated),
+            'filename': filename,
+            'training_mode': training_mode,
+            'increments_since_full_train': increments
+        }
+        if cv_results is not None:
+            metrics, folds, averages = cv_results
+            metrics_updated_obj.update({
+                'documents': list(set(chain.from_iterable(folds))),
+                'folds': list(folds),
+                'metrics': list(metrics),
+                'metric_averages': dict(averages)
+            })
+        elif training_mode == "full":
+            # CV was skipped; warm started models keep the CV metrics of the last full training
+            metrics_updated_obj.update({'folds': [], 'metrics': [], 'metric_averages': {}})
+        if not self.eve_client.update('metrics', metrics_obj["_id"], metrics_obj['_etag'], metrics_updated_obj):
+            raise Exception("Unable to update metrics for {}".format(filename))
+        logger.info("Saved classifier metrics for {}".format(filename))
+
+    # "warm_start" continues training the classifier's current model, "full" trains a new one from scratch; every
+    # WARM_START_FULL_RETRAIN_EVERY-th training is a full one
+    def get_training_mode(self, classifier, classifier_obj, metrics_obj):
+        if not config.WARM_START_ENABLED or not classifier.supports_warm_start():
+            return "full"
+        if not classifier_obj.get('filename') or not metrics_obj.get('annotations'):
+            return "full"
+        # trained before the annotations' _updated were kept, so edited annotations couldn't be told apart
+        if len(metrics_obj.get('annotations_updated') or []) != len(metrics_obj['annotations']):
+            return "full"
+        increments = pydash.get(metrics_obj, 'increments_since_full_train', 0) or 0
+        if increments + 1 >= config.WARM_START_FULL_RETRAIN_EVERY:
+            return "full"
+        return "warm_start"
+
+    # the annotations that are new or were edited since the last training, plus a random sample of
+    # WARM_START_REPLAY_RATIO old ones per new one, so the model doesn't forget what it learned from them
+    def get_warm_start_data(self, metrics_obj, documents, labels, ann_ids, ann_updated):
+        trained = set(zip(metrics_obj.get('annotations', []), metrics_obj.get('annotations_updated', [])))
+        is_trained = [version in trained for version in zip(ann_ids, ann_updated)]
+        new_indices = [i for i, old in enumerate(is_trained) if not old]
+        old_indices = [i for i, old in enumerate(is_trained) if old]
+        num_replay = min(len(old_indices), int(math.ceil(len(new_indices) * config.WARM_START_REPLAY_RATIO)))
+        indices = new_indices + random.sample(old_indices, num_replay)
+        logger.info("Warm start with {} new and {} replayed annotations".format(len(new_indices), num_replay))
+        return [documents[i] for i in indices], [labels[i] for i in indices]
+
+    # depending on CV_MODE, the 5-fold cross-validation metrics are computed while the new model trains ("sync"),
+    # after the new model and ranking are published ("async") or not at all ("skip"); models that are warm started
+    # aren't cross-validated
     def train_model(self, custom_filename, classifier_id, pipeline_name):
 
         # get classifier object
@@ -155,53 +276,81 @@ class ner_api(object):
         # get documents
         doc_map = self.eve_client.get_documents(collection_id)
         # get documents with its annotations
-        documents, labels, doc_ids, ann_ids = self.eve_client.get_docs_with_annotations(collection_id, doc_map)
+        documents, labels, doc_ids, ann_ids, ann_updated = self.eve_client.get_docs_with_annotations(collection_id,
+                                                                                                    doc_map)
 
         # instantiate model
         classifier = NER(pipeline_name)
 
-        # get folds information
-        metrics, folds, averages = self.perform_five_fold(classifier, documents, labels, doc_ids, pipeline_parameters)
-
-        logger.info("Starting to train classifier for {} pipeline".format(pipeline_name))
-        classifier.fit(documents, labels, pipeline_parameters)
-
-        logger.info("Trained classifier for {} pipeline".format(pipeline_name))
-
-        # save classifier
-        logger.info("Saving classifier model for {} pipeline".format(pipeline_name))
-        filename = custom_filename + "_" + str(uuid.uuid4())
-        model_filename = classifier.save_model(os.path.join(self.model_dir, pipeline_name, filename))
-
-        # update classifier on eve
-        if not self.eve_client.update('classifiers', classifier_id, classifier_obj['_etag'], {'filename': model_filename}):
-            return False
-
-        # update classifier metrics on eve
-        metrics_updated_obj = {
-            'trained_classifier_db_version': classifier_obj['_version']+1,
-            'documents': list(set(chain.from_iterable(folds))),
-            'annotations': list(ann_ids),
-            'folds': list(folds),
-            'metrics': list(metrics),
-            'metric_averages': dict(averages),
-            'filename': filename
-        }
-        if not self.eve_client.update('metrics', metrics_obj["_id"], metrics_obj['_etag'], metrics_updated_obj):
-            raise Exception("Unable to update metrics for {}".format(filename))
-        logger.info("Saved classifier metrics for {}".format(filename))
+        training_mode = self.get_training_mode(classifier, classifier_obj, metrics_obj)
+        if training_mode == "warm_start":
+            previous_filename = os.path.join(self.model_dir, pipeline_name, classifier_obj['filename'])
+            if os.path.exists(previous_filename):
+                classifier.load_model(previous_filename)
+            else:
+                logger.warning("Previous model {} not found, training from scratch".format(previous_filename))
+                training_mode = "full"
+        if training_mode == "warm_start":
+            increments = (pydash.get(metrics_obj, 'increments_since_full_train', 0) or 0) + 1
+            train_documents, train_labels = self.get_warm_start_data(metrics_obj, documents, labels, ann_ids, ann_updated)
+            cv_mode = None
+        else:
+            increments = 0
+            train_documents, train_labels = documents, labels
+            cv_mode = config.CV_MODE
+            if cv_mode not in ("sync", "async", "skip"):
+                logger.warning("Unknown CV_MODE {}, using sync".format(cv_mode))
+                cv_mode = "sync"
+        tokens = self.use_parsed_tokens(classifier, collection_id, list(doc_map.keys()), list(doc_map.values()))
+
+        with futures.ThreadPoolExecutor(max_workers=1) as cv_runner:
+            # get folds information, alongside the final fit
+            cv_future = None
+            if cv_mode == "sync":
+                cv_future = cv_runner.submit(self.perform_five_fold, pipeline_name, documents, labels, doc_ids, pipeline_parameters,
+                                             tokens)
+
+            logger.info("Starting to train classifier for {} pipeline ({})".format(pipeline_name, training_mode))
+            classifier.fit(train_documents, train_labels, pipeline_parameters)
+
+            logger.info("Trained classifier for {} pipeline".format(pipeline_name))
+
+            # save classifier
+            logger.info("Saving classifier model for {} pipeline".format(pipeline_name))
+            filename = custom_filename + "_" + str(uuid.uuid4())
+            model_filename = classifier.save_model(os.path.join(self.model_dir, pipeline_name, filename))
+
+            # update classifier on eve
+            if not self.eve_client.update('classifiers', classifier_id, classifier_obj['_etag'], {'filename': model_filename}):
+                return False
+
+            # update classifier metrics on eve
+            if cv_mode != "async":
+                self.update_metrics(metrics_obj, classifier_obj, filename, doc_ids, ann_ids, ann_updated, training_mode,
+                                    increments, cv_future.result() if cv_future is not None else None)
 
         # re rank documents
-        ranks = self.get_document_ranking(classifier, doc_map, doc_ids)
         logger.info("Performing document rankings")
+        head, rank_tail = self.get_document_ranking(classifier, doc_map, doc_ids)
 
-        # Save updates to eve
-        query = 'next_instances?where={"classifier_id":"%s"}' % classifier_id
-        next_instance_obj = self.eve_client.get_items(query)[0]
-        etag = next_instance_obj[0]['_etag']
-        id = next_instance_obj[0]['_id']
+        # Save updates to eve, the top of the ranking first
         logger.info("Updating next instances entry for current classifier")
-        return self.eve_client.update('next_instances', id, etag, {'document_ids': ranks})
+        updated = self.update_next_instances(classifier_id, 'head_document_ids', head[::-1])
+        if updated:
+            tail = rank_tail()
+            updated = self.update_next_instances(classifier_id, 'document_ids', tail[::-1])
+            logger.info("Saved ranking of {} + {} documents".format(len(head), len(tail)))
+
+        # the next predict will be for the model just trained; the collection's tokens aren't cached along with it
+        classifier.set_tokens({})
+        MODEL_CACHE.put(classifier_id, model_filename, classifier)
+
+        if cv_mode == "async":
+            # the new model is in use already, the metrics follow
+            cv_results = self.perform_five_fold(pipeline_name, documents, labels, doc_ids, pipeline_parameters, tokens)
+            self.update_metrics(metrics_obj, classifier_obj, filename, doc_ids, ann_ids, ann_updated, training_mode,
+                                increments, cv_results)
+        return updated
 
     def predict(self, classifier_id, pipeline_name, documents, document_ids):
 
@@ -218,11 +367,19 @@ class ner_api(object):
 
         if not os.path.exists(filename):
              raise FileNotFoundError("No model with {} filename has been created".format(filename))
-        classifier = NER(pipeline_name)
-        classifier.load_model(filename)
-        logger.info("Loaded classifier {}".format(classifier))
+        def load():
+            classifier = NER(pipeline_name)
+            classifier.load_model(filename)
+            logger.info("Loaded classifier {}".format(classifier))
+            return classifier
+        classifier = MODEL_CACHE.get_or_load(classifier_id, filename, load)
 
         if len(documents) == len(document_ids):
-            return classifier.predict(documents, document_ids)
+            self.use_parsed_tokens(classifier, classifier_obj.get('collection_id'), document_ids, documents)
+            try:
+                return classifier.predict(documents, document_ids)
+            finally:
+                # the model stays cached, the documents' tokens don't
+                classifier.set_tokens({})
         else:
             return None
@@ -1,207 +1,255 @@
 # (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
 
-import math, random
+import numpy as np
 
-def rank(results, metric):
-	'''
-	if metric == 'lc': return least_confidence(results)
-	if metric == 'ma': return largest_margin(results)
-	if metric == 'en': return entropy_rank(results)
-	if metric == 'lcs': return least_confidence_squared(results)
-	if metric == 'lce': return least_confidence_squared_by_entity(results)
-	if metric == 'ra': return random_rank(results)
-	if metric == 'mlp': return most_of_least_popular(results)
-	return -1
-
-	#Dictionary method is inefficient as it runs every method before returning one
-	'''
-	return {
-		'lc':least_confidence(results),
-		'ma':largest_margin(results),
-		'en':entropy_rank(results),
-		'lcs':least_confidence_squared(results),
-		'lce':least_confidence_squared_by_entity(results),
-		'ra':random_rank(results),
-		'mlp':most_of_least_popular(results)
-	}[metric]
-	
+#ASSUMED INPUT (predict_proba output)
+#results = {doc_id: [(start offset, stop offset, label, confidence), ...], ...}
+#or, with the probabilities of all possible labels per entity,
+#results = {doc_id: [(start offset, stop offset, [(label, probability), ...]), ...], ...}
+#
+#every ranking function takes either that dict or a PackedResults made from it (to share the packing between rankings)
+
+
+class PackedResults(object):
+	#predict_proba output packed into flat arrays, one entry per entity, with the entities of document i at
+	#[offsets[i], offsets[i + 1])
+	def __init__(self, results):
+		self.keys = list(results.keys())
+		self.label_names = []
+		label_codes = {}
+		counts = []
+		top_labels = []
+		top_probs = []
+		#all label probabilities of the entities that have them (alt_entities), alt_counts[j] of them for the j-th one
+		alt_entities = []
+		alt_probs = []
+		alt_counts = []
+		for key in self.keys:
+			ents = results[key]
+			counts.append(len(ents))
+			for ent in ents:
+				if type(ent[2]) is list:
+					probs = [alt[1] for alt in ent[2]]
+					best = int(np.argmax(probs)) if probs else 0
+					label, prob = ent[2][best] if probs else (None, 0.0)
+					alt_entities.append(len(top_probs))
+					alt_probs.extend(probs)
+					alt_counts.append(len(probs))
+				else:
+					label, prob = ent[2], ent[3]
+				if label not in label_codes:
+					label_codes[label] = len(self.label_names)
+					self.label_names.append(label)
+				top_labels.append(label_codes[label])
+				top_probs.append(prob)
+		self.key_array = np.empty(len(self.keys), dtype=object)
+		self.key_array[:] = self.keys
+		self.counts = np.array(counts, dtype=np.int64)
+		self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+		np.cumsum(self.counts, out=self.offsets[1:])
+		self.doc_index = np.repeat(np.arange(len(self.keys)), self.counts)
+		self.top_labels = np.array(top_labels, dtype=np.int64)
+		self.top_probs = np.array(top_probs, dtype=np.float64)
+		self.alt_entities = np.array(alt_entities, dtype=np.int64)
+		self.alt_probs = np.array(alt_probs, dtype=np.float64)
+		self.alt_counts = np.array(alt_counts, dtype=np.int64)
+
+	def sorted_alternatives(self):
+		#alt_probs sorted from most to least likely within every entity, the entity of each, and its position in that order
+		alt_index = np.repeat(np.arange(len(self.alt_counts)), self.alt_counts)
+		if len(self.alt_counts) > 0 and np.all(self.alt_counts == self.alt_counts[0]):
+			#usually every entity has the probabilities of all labels, so they can be sorted as rows
+			num_alts = int(self.alt_counts[0])
+			probs = -np.sort(-self.alt_probs.reshape(-1, num_alts), axis=1)
+			return probs.ravel(), alt_index, np.tile(np.arange(num_alts), len(self.alt_counts))
+		order = np.lexsort((-self.alt_probs, alt_index))
+		alt_starts = np.zeros(len(self.alt_counts), dtype=np.int64)
+		np.cumsum(self.alt_counts[:-1], out=alt_starts[1:])
+		position = np.arange(len(order)) - np.repeat(alt_starts, self.alt_counts)
+		return self.alt_probs[order], alt_index, position
+
+
+def pack(results):
+	return results if isinstance(results, PackedResults) else PackedResults(results)
+
+
+def _segment_sum(values, doc_index, num_docs):
+	#sum of values per document, where values are grouped by (sorted) doc_index
+	sums = np.zeros(num_docs, dtype=np.float64)
+	if len(values) == 0:
+		return sums
+	starts = np.flatnonzero(np.concatenate(([True], doc_index[1:] != doc_index[:-1])))
+	sums[doc_index[starts]] = np.add.reduceat(values, starts)
+	return sums
+
+
+def _segment_mean(values, doc_index, num_docs):
+	counts = np.bincount(doc_index, minlength=num_docs)
+	sums = _segment_sum(values, doc_index, num_docs)
+	return np.divide(sums, counts, out=np.zeros(num_docs, dtype=np.float64), where=counts > 0)
+
+
+def _format(packed, scores, order, keys_only=False):
+	#(doc_id, score) of the documents in order, or just their doc_ids
+	if keys_only:
+		return packed.key_array[order].tolist()
+	return list(zip(packed.key_array[order].tolist(), scores[order].tolist()))
+
+def _ranking(packed, scores, descending=False, keys_only=False):
+	#(doc_id, score) from lowest to highest score (or highest to lowest), ties keep the documents' order
+	order = np.argsort(-scores if descending else scores, kind='mergesort')
+	return _format(packed, scores, order, keys_only)
+
+
+def _least_confidence_scores(packed):
+	return _segment_mean(packed.top_probs, packed.doc_index, len(packed.keys))
 
 def least_confidence(results):
-	print('least confidence')
 	#returns average confidence in each document, ranked from lowest to highest
-	ranking = []
-	for key in results:
-		confidence = 0
-		numel = 0
-		for ent in results[key]:
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident
-				confidence += ent[2][0][1]
-			else:
-				confidence += ent[3]
-			numel += 1
-		if numel > 0:
-			confidence /= numel
-		#print(confidence)
-		ranking.append((key, confidence))
-	ranking.sort(key=lambda tup: tup[1])
-	return ranking
+	packed = pack(results)
+	return _ranking(packed, _least_confidence_scores(packed))
+
+def _least_confidence_squared_scores(packed):
+	return _segment_mean(np.square(packed.top_probs), packed.doc_index, len(packed.keys))
 
 def least_confidence_squared(results):
-	print('least confidence squared')
 	#returns average squared confidence in each document, ranked from lowest to highest (hopefully prioritizes consistently low confidence over spotty)
-	ranking = []
-	for key in results:
-		confidence = 0
-		numel = 0
-		for ent in results[key]:
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident prediction
-				confidence += math.pow(ent[2][0][1], 2)
-			else:
-				confidence += math.pow(ent[3], 2)
-			numel += 1
-		if numel > 0:
-			confidence /= numel
-		#print(confidence)
-		ranking.append((key, confidence))
-	ranking.sort(key=lambda tup: tup[1])
-	rank_res = [ranks[0] for ranks in ranking]
-	return rank_res
+	packed = pack(results)
+	return _ranking(packed, _least_confidence_squared_scores(packed), keys_only=True)
+
+def _least_confidence_squared_by_entity_scores(packed):
+	num_docs = len(packed.keys)
+	num_labels = max(1, len(packed.label_names))
+	#average confidence per (document, predicted label)
+	groups, group_index = np.unique(packed.doc_index * num_labels + packed.top_labels, return_inverse=True)
+	label_confidences = np.bincount(group_index, weights=packed.top_probs) / np.bincount(group_index)
+	group_docs = groups // num_labels
+	return _segment_mean(np.square(label_confidences), group_docs, num_docs)
 
 def least_confidence_squared_by_entity(results):
-	print('least confidence square by entity')
 	#returns average squared entity-confidence in each document (average confidence squared per entity), same idea as lcs but for individual entities
-	ranking = []
-	for key in results:
-		confidences = {}
-		numels = {}
-		for ent in results[key]:
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident prediction
-				pred_label = ent[2][0][0]
-				pred_prob = ent[2][0][1]
-			else:
-				pred_label = ent[2]
-				pred_prob = ent[3]
-			if pred_label not in confidences:
-				confidences[pred_label] = 0
-				numels[pred_label] = 0
-			confidences[pred_label] += pred_prob
-			numels[pred_label] += 1
-		confidence = 0
-		for label in confidences:
-			confidence += math.pow((confidences[label]/numels[label]), 2)
-		if len(confidences) > 0:
-			confidence /= len(confidences)
-		#print(confidence)
-		ranking.append((key, confidence))
-	ranking.sort(key=lambda tup: tup[1])
-	return ranking
+	packed = pack(results)
+	return _ranking(packed, _least_confidence_squared_by_entity_scores(packed))
+
+def _largest_margin_scores(packed):
+	num_docs = len(packed.keys)
+	#if only most confident prediction is provided, cannot calculate margin
+	probs, alt_index, position = packed.sorted_alternatives()
+	has_margin = packed.alt_counts >= 2
+	margins = np.zeros(len(packed.alt_counts), dtype=np.float64)
+	margins[alt_index[position == 0]] += probs[position == 0]
+	margins[alt_index[position == 1]] -= probs[position == 1]
+	entity_docs = packed.doc_index[packed.alt_entities]
+	return _segment_mean(margins[has_margin], entity_docs[has_margin], num_docs)
 
 #WARNING: REQUIRES PROBABLITIES FOR ALL POSSIBLE LABELS PER TOKEN INSTEAD OF JUST MOST LIKELY
 def largest_margin(results):
-	print('largest margin')
 	#returns average margin in each document, ranked from lowest to highest
-	ranking = []
-	for key in results:
-		margin = 0
-		numel = 0
-		for ent in results[key]:
-			#if only most confident prediction is provided, cannot calculate margin
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident prediction
-				margin += (ent[2][0][1] - ent[2][1][1])
-				numel += 1
-				
-		if numel > 0:
-			margin /= numel
-		#print(margin)
-		ranking.append((key, margin))
-	ranking.sort(key=lambda tup: tup[1])
-	return ranking
+	packed = pack(results)
+	return _ranking(packed, _largest_margin_scores(packed))
+
+def _entropy_scores(packed, N=None):
+	num_docs = len(packed.keys)
+	#if only most confident prediction is provided, cannot calculate entropy
+	if N is not None:
+		probs, alt_index, position = packed.sorted_alternatives()
+		used = position < N
+	else:
+		probs = packed.alt_probs
+		alt_index = np.repeat(np.arange(len(packed.alt_counts)), packed.alt_counts)
+		used = np.ones(len(probs), dtype=bool)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		terms = np.where(probs > 0, probs * np.log(probs), 0.0)
+	entropies = -np.bincount(alt_index[used], weights=terms[used], minlength=len(packed.alt_counts))
+	entity_docs = packed.doc_index[packed.alt_entities]
+	return _segment_mean(entropies, entity_docs, num_docs)
 
 #WARNING: REQUIRES PROBABLITIES FOR ALL POSSIBLE LABELS PER TOKEN INSTEAD OF JUST MOST LIKELY
 def entropy_rank(results, N=None):
-	print('entropy rank')
-	ranking = []
-	for key in results:
-		entropy = 0
-		numel = 0
-		#TODO: check to ensure N is not larger than number of possible labels
-		for ent in results[key]:
-			#print(ent[2])
-			#if only most confident prediction is provided, cannot calculate entropy
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident prediction
-				for i in range(0, N if N is not None else len(ent[2])):
-					#print(str(i))
-					prob = ent[2][i][1]
-					entropy += (prob*math.log(prob))
-				entropy *= -1
-				numel += 1
-		if numel > 0:
-			entropy = entropy/numel
-		#print(margin)
-		ranking.append((key, entropy))
-	ranking.sort(key=lambda tup: tup[1], reverse=True)
-	return ranking
+	#returns average entropy of the (N most likely) label probabilities of each entity in each document, ranked from highest to lowest
+	packed = pack(results)
+	return _ranking(packed, _entropy_scores(packed, N), descending=True)
 
 def random_rank(results):
-	print('random rank')
-	ranks = list(range(0, len(results)))
-	random.shuffle(ranks)
-	ranking = []
-	for i,key in enumerate(results):
-		ranking.append((key, ranks[i]))
-
-	ranking.sort(key=lambda tup: tup[1])
-	return ranking
+	packed = pack(results)
+	ranks = np.random.permutation(len(packed.keys))
+	order = np.argsort(ranks)
+	return list(zip(packed.key_array[order].tolist(), ranks[order].tolist()))
 
 def most_of_least_popular(results):
-	print('most of least popular')
-	doc_stats = []
-	ranking = []
-	popularity = {}
-	for key in results:
-		stats = {}
-		for ent in results[key]:
-			if type(ent[2]) is list:
-				ent[2].sort(key=lambda tup: tup[1], reverse=True) #sort from most to least confident prediction
-				predicted_label = ent[2][0][0]
-			else:
-				predicted_label = ent[2]
-			if predicted_label not in stats:
-				stats[predicted_label] = 0
-			stats[predicted_label] += 1
-
-		doc_stats.append((key, stats))
-		for label in stats:
-			if label not in popularity:
-				popularity[label] = 0
-			popularity[label] += stats[label]
-	if 'O' in popularity:
-		del popularity['O']
+	#for every label, starting with the least popular, ranks the documents not ranked yet that have predicted instances
+	#of it, from most to fewest instances
+	packed = pack(results)
+	num_docs = len(packed.keys)
+	num_labels = len(packed.label_names)
+	counts = np.zeros((num_docs, num_labels), dtype=np.int64)
+	np.add.at(counts, (packed.doc_index, packed.top_labels), 1)
+	popularity = counts.sum(axis=0)
 	#ignores labels with 0 predicted instances...
-	#for every label, starting with least popular
-	for l in sorted(popularity, key=popularity.__getitem__):
-		label_rank = []
-		for doc in doc_stats:
-			if l not in doc[1]:
-				doc[1][l] = 0
-			label_rank.append((doc[0], doc[1][l]))
-		#sort all documents by predicted instances of that label
-		label_rank.sort(key=lambda tup: tup[1], reverse=True)
-
-		#go through the ranking for individual label in order from most to least instances
-		for lp in range(0, len(label_rank)):
-			doc_label_stats = label_rank[lp] #(doc_id, label_instances)
-			#append any documents with nonzero predicted instances in their respective order
-			if doc_label_stats[1] > 0: 
-				ranking.append((doc_label_stats[0], [l, doc_label_stats[1]]))
-				#remove ranked document from pool
-				doc_stats = [d for d in doc_stats if d[0] != doc_label_stats[0]]
-			else:
-				break
-
-	return ranking
\ No newline at end of file
+	labels = [l for l in np.argsort(popularity, kind='mergesort') if packed.label_names[l] != 'O']
+	remaining = np.ones(num_docs, dtype=bool)
+	ranking = []
+	for l in labels:
+		docs = np.flatnonzero(remaining & (counts[:, l] > 0))
+		docs = docs[np.argsort(-counts[docs, l], kind='mergesort')]
+		label = packed.label_names[l]
+		ranking.extend((key, [label, count]) for key, count in zip(packed.key_array[docs].tolist(), counts[docs, l].tolist()))
+		#remove ranked documents from pool
+		remaining[docs] = False
+	return ranking
+
+
+#only the requested ranking is computed
+RANKING_FUNCTIONS = {
+	'lc': least_confidence,
+	'ma': largest_margin,
+	'en': entropy_rank,
+	'lcs': least_confidence_squared,
+	'lce': least_confidence_squared_by_entity,
+	'ra': random_rank,
+	'mlp': most_of_least_popular
+}
+
+#metrics that score every document on its own: (score function, whether higher scores rank first, whether the ranking
+#has just the doc_ids), so the first k documents can be selected without sorting all of them
+SCORE_FUNCTIONS = {
+	'lc': (_least_confidence_scores, False, False),
+	'ma': (_largest_margin_scores, False, False),
+	'en': (_entropy_scores, True, False),
+	'lcs': (_least_confidence_squared_scores, False, True),
+	'lce': (_least_confidence_squared_by_entity_scores, False, False)
+}
+
+def rank(results, metric):
+	if metric not in RANKING_FUNCTIONS:
+		return -1
+	return RANKING_FUNCTIONS[metric](results)
+
+def rank_top_k(results, metric, k):
+	#returns the first k entries of rank(results, metric), and a function returning the rest of that ranking, so the
+	#head can be used before the (much longer) tail is sorted
+	if metric not in RANKING_FUNCTIONS:
+		return -1, None
+	packed = pack(results)
+	if metric not in SCORE_FUNCTIONS:
+		ranking = rank(packed, metric)
+		return ranking[:k], lambda: ranking[k:]
+	score_function, descending, keys_only = SCORE_FUNCTIONS[metric]
+	scores = score_function(packed)
+	ordered = -scores if descending else scores
+	k = max(0, min(k, len(ordered)))
+	if k == 0 or k == len(ordered):
+		ranking = _ranking(packed, scores, descending, keys_only)
+		return ranking[:k], lambda: ranking[k:]
+	#the k lowest, and of those tied with the k-th the ones that come first, as the (stable) full ranking has them
+	threshold = ordered[np.argpartition(ordered, k - 1)[k - 1]]
+	below = np.flatnonzero(ordered < threshold)
+	head = np.concatenate((below, np.flatnonzero(ordered == threshold)[:k - len(below)]))
+	head = head[np.lexsort((head, ordered[head]))]
+	def rank_tail():
+		in_head = np.zeros(len(ordered), dtype=bool)
+		in_head[head] = True
+		tail = np.flatnonzero(~in_head)
+		tail = tail[np.argsort(ordered[tail], kind='mergesort')]
+		return _format(packed, scores, tail, keys_only)
+	return _format(packed, scores, head, keys_only), rank_tail
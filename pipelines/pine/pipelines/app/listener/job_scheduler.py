@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# **********************************************************************
+# Copyright (C) 2018 Johns Hopkins University Applied Physics Laboratory
+#
+# All Rights Reserved.
+# This material may only be used, modified, or reproduced by or for the
+# U.S. government pursuant to the license rights granted under FAR
+# clause 52.227-14 or DFARS clauses 252.227-7013/7014.
+# For any other permission, please contact the Legal Office at JHU/APL.
+# **********************************************************************
+import collections
+import logging
+import threading
+import time
+from concurrent import futures
+
+import pebble
+import pydash
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class JobMetrics(object):
+    """
+    Queue wait and run time statistics per job type.  They are kept in memory for this worker and, if a redis connection
+    is given, added up across all workers in a redis hash per job type at "<key_prefix><job_type>".
+    """
+
+    def __init__(self, r_conn=None, key_prefix=""):
+        """
+        :type r_conn: redis.StrictRedis | None
+        :type key_prefix: str
+        """
+        self.r_conn = r_conn
+        self.key_prefix = key_prefix
+        self.stats = dict()
+        self.lock = threading.Lock()
+
+    def record(self, job_type, queue_wait, run_time, succeeded):
+        """
+        :type job_type: str
+        :type queue_wait: float
+        :type run_time: float
+        :type succeeded: bool
+        """
+        job_type = str(job_type)
+        with self.lock:
+            stats = self.stats.setdefault(job_type, dict(count=0, failed=0, queue_wait_total=0.0, queue_wait_max=0.0,
+                                                         run_time_total=0.0, run_time_max=0.0))
+            stats["count"] += 1
+            stats["failed"] += 0 if succeeded else 1
+            stats["queue_wait_total"] += queue_wait
+            stats["queue_wait_max"] = max(stats["queue_wait_max"], queue_wait)
+            stats["run_time_total"] += run_time
+            stats["run_time_max"] = max(stats["run_time_max"], run_time)
+        logger.info("Job of type %s waited %.3fs in the queue and ran for %.3fs", job_type, queue_wait, run_time)
+        if self.r_conn is None:
+            return
+        key = self.key_prefix + job_type
+        try:
+            with self.r_conn.pipeline() as pipe:
+                pipe.hincrby(key, "count", 1)
+                pipe.hincrby(key, "failed", 0 if succeeded else 1)
+                pipe.hincrbyfloat(key, "queue_wait_total", queue_wait)
+                pipe.hincrbyfloat(key, "run_time_total", run_time)
+                pipe.hset(key, mapping=dict(queue_wait_last=queue_wait, run_time_last=run_time, updated=time.time()))
+                pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning("Unable to export job metrics to %s: %s", key, e)
+
+    def as_dict(self):
+        """
+        :rtype: dict[str, dict]
+        """
+        with self.lock:
+            metrics = dict()
+            for job_type, stats in self.stats.items():
+                metrics[job_type] = dict(stats,
+                                         queue_wait_mean=stats["queue_wait_total"] / stats["count"],
+                                         run_time_mean=stats["run_time_total"] / stats["count"])
+            return metrics
+
+
+class JobInterrupted(Exception):
+    """
+    Raised by the futures of jobs that were still running when the scheduler was stopped.
+    """
+
+
+class JobScheduler(object):
+    """
+    Runs jobs on process pools, with at most max_workers jobs at a time and optional limits on how many jobs of a given
+    type ("fit", "predict") or framework run at once.  Two jobs for the same classifier never run at the same time.
+    Jobs that can't start yet wait in order, but don't hold up jobs behind them that can.  Waiting jobs don't take up
+    worker slots; at most max_pending of them are taken on, so that blocked jobs are left on the queue to other workers.
+
+    Each framework gets its own long-lived pool, so its processes keep that framework's loaded models (and JVM) warm.
+    A framework's pool has as many processes as it may run jobs at once, min(max_workers, its framework limit), and
+    keeps them while idle, so without max_processes the ceiling is the sum of that over the frameworks used (plus the
+    processes of replaced pools still finishing their jobs).  With max_processes, idle pools are closed, least recently
+    used first, to make room for a new one, and jobs needing a new pool wait until it fits.
+    To contain memory leaks, a framework's pool can be replaced by a fresh one after a number of fits.
+    """
+
+    def __init__(self, function, max_workers, job_type_limits=None, framework_limits=None, timeout=None, metrics=None,
+                 restart_after_fits=None, max_pending=None, max_processes=None):
+        """
+        :param function: picklable function taking the job details and run in a pool process
+        :type function: callable
+        :type max_workers: int
+        :type job_type_limits: dict[str, int] | None
+        :type framework_limits: dict[str, int] | None
+        :type timeout: float | None
+        :type metrics: JobMetrics | None
+        :param restart_after_fits: per framework, how many fits its pool runs before it is replaced
+        :type restart_after_fits: dict[str, int] | None
+        :param max_pending: how many jobs may wait for their type, framework or classifier; defaults to max_workers
+        :type max_pending: int | None
+        :param max_processes: how many pool processes may be alive across all frameworks; at least max_workers, so that
+                              any pool fits once the others are closed; None for no limit
+        :type max_processes: int | None
+        """
+        self.function = function
+        self.max_workers = max(1, int(max_workers))
+        # a limit below one would keep those jobs waiting forever
+        self.job_type_limits = {key: max(1, int(value)) for key, value in dict(job_type_limits or {}).items()}
+        self.framework_limits = {key: max(1, int(value)) for key, value in dict(framework_limits or {}).items()}
+        self.timeout = timeout
+        self.restart_after_fits = {key: int(value) for key, value in dict(restart_after_fits or {}).items() if int(value) > 0}
+        self.max_pending = self.max_workers if max_pending is None else max(0, int(max_pending))
+        self.max_processes = None if max_processes is None else max(self.max_workers, int(max_processes))
+        self.metrics = metrics if metrics is not None else JobMetrics()
+        self.is_started = False
+        self.pools = collections.OrderedDict()  # framework -> pebble.ProcessPool, created on first use, least recently used first
+        self.pool_fits = collections.Counter()  # framework -> fits started on its current pool
+        self.retired_pools = list()  # (pool, number of processes, thread joining it) of closed pools finishing their jobs
+        self.pending = collections.deque()  # (job_details, future) waiting for a free slot, oldest first
+        self.num_running = 0
+        self.running_job_types = collections.Counter()
+        self.running_frameworks = collections.Counter()
+        self.running_classifiers = set()
+        self.running_futures = set()
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            self.is_started = True
+
+    def stop(self):
+        """
+        Cancels waiting jobs and terminates running ones, whose futures raise JobInterrupted.
+        :returns: the classifier ids of the jobs that were still running
+        :rtype: set[str]
+        """
+        with self.condition:
+            self.is_started = False
+            pools, self.pools = list(self.pools.values()), collections.OrderedDict()
+            retired_pools, self.retired_pools = self.retired_pools, list()
+            self.pool_fits.clear()
+            pending, self.pending = self.pending, collections.deque()
+            running_classifiers = set(self.running_classifiers)
+        for _, future in pending:
+            future.cancel()
+        for pool in pools + [pool for pool, _, _ in retired_pools]:
+            pool.stop()
+        for pool in pools:
+            pool.join()
+        # retired pools are joined by their own threads
+        for _, _, thread in retired_pools:
+            thread.join()
+        # pebble leaves the futures of terminated jobs pending
+        with self.condition:
+            running_futures, self.running_futures = self.running_futures, set()
+        for future in running_futures:
+            future.set_exception(JobInterrupted("The job was terminated when the scheduler stopped"))
+        return running_classifiers
+
+    def _has_capacity(self):
+        # jobs are started as soon as they can, so everything still pending is blocked by a limit and only counts
+        # against max_pending
+        return self.num_running < self.max_workers and len(self.pending) < self.max_pending
+
+    def has_capacity(self):
+        """
+        :returns: whether a worker slot is free and another job can be taken on without going over max_pending
+        :rtype: bool
+        """
+        with self.condition:
+            return self._has_capacity()
+
+    def wait_for_capacity(self, timeout=None):
+        """
+        :type timeout: float | None
+        :rtype: bool
+        """
+        with self.condition:
+            return self.condition.wait_for(self._has_capacity, timeout)
+
+    def submit(self, job_details):
+        """
+        :type job_details: dict
+        :returns: a future for the function's result, done when the job finished
+        :rtype: futures.Future
+        """
+        future = futures.Future()
+        with self.condition:
+            self.pending.append((job_details, future))
+            self._dispatch()
+        return future
+
+    def _can_start(self, job_details):
+        job_type = pydash.get(job_details, "type", None)
+        job_framework = pydash.get(job_details, "framework", None)
+        classifier_id = pydash.get(job_details, "classifier_id", None)
+        if self.num_running >= self.max_workers:
+            return False
+        if classifier_id is not None and classifier_id in self.running_classifiers:
+            return False
+        if job_type in self.job_type_limits and self.running_job_types[job_type] >= self.job_type_limits[job_type]:
+            return False
+        if job_framework in self.framework_limits and self.running_frameworks[job_framework] >= self.framework_limits[job_framework]:
+            return False
+        # checked last, since it may close idle pools
+        if job_framework not in self.pools and not self._make_room(self._pool_size(job_framework)):
+            return False
+        return True
+
+    def _pool_size(self, job_framework):
+        return min(self.max_workers, self.framework_limits.get(job_framework, self.max_workers))
+
+    def _make_room(self, num_processes):
+        # closes idle pools, least recently used first, until a new pool with that many processes fits under
+        # max_processes; the processes of closed pools count until they have exited
+        if self.max_processes is None:
+            return True
+        in_use = sum(self._pool_size(framework) for framework in self.pools)
+        idle = [framework for framework in self.pools if self.running_frameworks[framework] == 0]
+        while in_use + num_processes > self.max_processes and idle:
+            framework = idle.pop(0)
+            logger.info("Closing the idle %s worker processes to stay under %s processes", framework, self.max_processes)
+            in_use -= self._pool_size(framework)
+            self._retire_pool(framework)
+        exiting = sum(size for _, size, _ in self.retired_pools)
+        return in_use + exiting + num_processes <= self.max_processes
+
+    def _get_pool(self, job_framework):
+        if job_framework not in self.pools:
+            self.pools[job_framework] = pebble.ProcessPool(max_workers=self._pool_size(job_framework))
+        self.pools.move_to_end(job_framework)
+        return self.pools[job_framework]
+
+    def _retire_pool(self, job_framework):
+        # jobs already scheduled on the pool still finish, its processes exit after them
+        pool = self.pools.pop(job_framework)
+        pool.close()
+        thread = threading.Thread(target=self._join_retired_pool, args=(pool,), daemon=True)
+        self.retired_pools.append((pool, self._pool_size(job_framework), thread))
+        self.pool_fits[job_framework] = 0
+        thread.start()
+
+    def _join_retired_pool(self, pool):
+        # a closed pebble pool only stops its processes when joined
+        pool.join()
+        with self.condition:
+            self.retired_pools = [retired for retired in self.retired_pools if retired[0] is not pool]
+            # its processes no longer count against max_processes
+            self._dispatch()
+            self.condition.notify_all()
+
+    def _count_fit(self, job_framework):
+        self.pool_fits[job_framework] += 1
+        if self.pool_fits[job_framework] < self.restart_after_fits.get(job_framework, float("inf")):
+            return
+        logger.info("Replacing the %s worker processes after %s fits", job_framework, self.pool_fits[job_framework])
+        self._retire_pool(job_framework)
+
+    def _dispatch(self):
+        # must be called with the condition held; searches from the front every time since finishing jobs re-enter here
+        while self.is_started:
+            startable = next((entry for entry in self.pending if self._can_start(entry[0])), None)
+            if startable is None:
+                return
+            self.pending.remove(startable)
+            job_details, future = startable
+            if future.set_running_or_notify_cancel():
+                self._start(job_details, future)
+
+    def _start(self, job_details, future):
+        job_type = pydash.get(job_details, "type", None)
+        job_framework = pydash.get(job_details, "framework", None)
+        classifier_id = pydash.get(job_details, "classifier_id", None)
+        self.num_running += 1
+        self.running_job_types[job_type] += 1
+        self.running_frameworks[job_framework] += 1
+        if classifier_id is not None:
+            self.running_classifiers.add(classifier_id)
+        self.running_futures.add(future)
+        started_at = time.time()
+        try:
+            pool_future = self._get_pool(job_framework).schedule(self.function, args=[job_details], timeout=self.timeout)
+        except Exception as e:
+            self._finish(job_details, future, started_at)
+            future.set_exception(e)
+            return
+        if job_type == "fit":
+            self._count_fit(job_framework)
+        pool_future.add_done_callback(lambda f: self._on_done(job_details, future, f, started_at))
+
+    def _finish(self, job_details, future, started_at):
+        job_type = pydash.get(job_details, "type", None)
+        job_framework = pydash.get(job_details, "framework", None)
+        classifier_id = pydash.get(job_details, "classifier_id", None)
+        with self.condition:
+            self.num_running -= 1
+            self.running_job_types[job_type] -= 1
+            self.running_frameworks[job_framework] -= 1
+            self.running_classifiers.discard(classifier_id)
+            # stop() already failed the future of a job it terminated
+            owned = future in self.running_futures
+            self.running_futures.discard(future)
+            self._dispatch()
+            self.condition.notify_all()
+        queued_at = pydash.get(job_details, "queued_at", started_at)
+        return owned, job_type, max(0.0, started_at - queued_at), time.time() - started_at
+
+    def _on_done(self, job_details, future, pool_future, started_at):
+        owned, job_type, queue_wait, run_time = self._finish(job_details, future, started_at)
+        if not owned:
+            return
+        if not self.is_started and (pool_future.cancelled() or pool_future.exception() is not None):
+            # terminated by stop()
+            self.metrics.record(job_type, queue_wait, run_time, False)
+            future.set_exception(JobInterrupted("The job was terminated when the scheduler stopped"))
+            return
+        if pool_future.cancelled():
+            self.metrics.record(job_type, queue_wait, run_time, False)
+            future.set_exception(futures.CancelledError())
+            return
+        error = pool_future.exception()
+        self.metrics.record(job_type, queue_wait, run_time, error is None)
+        if error is not None:
+            if isinstance(error, futures.TimeoutError):
+                logger.error("Job %s timed out after %ss", pydash.get(job_details, "job_id", None), self.timeout)
+            else:
+                logger.error("Job %s failed, error: %s", pydash.get(job_details, "job_id", None), error)
+            future.set_exception(error)
+        else:
+            future.set_result(pool_future.result())
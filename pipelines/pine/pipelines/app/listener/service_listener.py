@@ -12,17 +12,17 @@
 import atexit
 import json
 import logging
+import socket
 import threading
+import time
 from datetime import timedelta
 
-import pebble
 import pydash
 import redis
-import time
-from pebble import concurrent
 
 from ...shared.config import ConfigBuilder
 from ...NER_API import ner_api
+from .job_scheduler import JobInterrupted, JobMetrics, JobScheduler
 
 config = ConfigBuilder.get_config()
 logger = logging.getLogger(__name__)
@@ -73,23 +73,64 @@ class ServiceListener(object):
     # Scheduled Keys
     processing_queue_key = config.REDIS_PREFIX + config.PIPELINE + "work-queue"
     processing_queue_key_timeout = timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT * 2)  # Timeout for queueing processing a job...
+    # In event-driven mode jobs are moved atomically from the work queue to this worker's in-progress list while they
+    # run, so that jobs of a crashed worker can be put back on the queue.  Workers keep a heartbeat key alive while they
+    # run; the in-progress lists without one (e.g. of a container that came back under another host name) are put back
+    # on the queue by the other workers.
+    consumer_name = config.SERVICE_CONSUMER_NAME or socket.gethostname()
+    processing_list_key_prefix = processing_queue_key + ":processing:"
+    processing_list_key = processing_list_key_prefix + consumer_name
+    heartbeat_key_prefix = processing_queue_key + ":heartbeat:"
+    heartbeat_key = heartbeat_key_prefix + consumer_name
+    heartbeat_key_timeout = registration_poll * 3
 
     # Mutexes Keys
-    processing_lock_key = config.REDIS_PREFIX + "locks:processing"
+    # jobs for the same classifier are mutually exclusive (across workers), jobs for different ones run concurrently
+    processing_lock_key_prefix = config.REDIS_PREFIX + "locks:processing:"
     processing_lock_key_timeout = timedelta(minutes=config.SERVICE_HANDLER_TIMEOUT)
-    preprocessing_lock_key = config.REDIS_PREFIX + "locks:preprocessing"
-    preprocessing_lock_key_timeout = int(timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT).total_seconds())
     preprocessing_worker_lock_key = config.REDIS_PREFIX + "locks:preprocessing_worker"
     preprocessing_worker_lock_key_timeout = int(timedelta(seconds=config.SERVICE_HANDLER_TIMEOUT).total_seconds())
 
+    # Metrics, one hash per job type
+    job_metrics_key_prefix = config.REDIS_PREFIX + config.PIPELINE + "job-metrics:"
+
     # Channels
     registration_channel = config.SERVICE_REGISTRATION_CHANNEL or "registration"
 
-    def __init__(self, services=None):
+    # Requests are queued by the backend's ServiceManager as a list of job ids at "job_queue", with each job's payload
+    # in a hash at "<job_queue>:job:<job_id>".  Claiming a job takes its hash and drops its id from the queue in one
+    # atomic step, so no lock or queue scan is needed and only one listener can get it.
+    job_key_infix = ":job:"
+    claim_job_script = r_conn.register_script("""
+        local job = redis.call('HGETALL', KEYS[2])
+        if #job == 0 then
+            return nil
+        end
+        redis.call('DEL', KEYS[2])
+        redis.call('LREM', KEYS[1], 1, ARGV[1])
+        return job
+    """)
+    # Puts the jobs of this worker's in-progress list back at the end of the work queue the jobs are consumed from
+    # (BRPOPLPUSH takes them from the right and pushes them on the left of the in-progress list), oldest at the end, in
+    # one atomic step.
+    recover_jobs_script = r_conn.register_script("""
+        local recovered = 0
+        local job = redis.call('LPOP', KEYS[1])
+        while job do
+            redis.call('RPUSH', KEYS[2], job)
+            recovered = recovered + 1
+            job = redis.call('LPOP', KEYS[1])
+        end
+        return recovered
+    """)
+
+    def __init__(self, services=None, event_driven=None):
         """
         :type services: list[ServiceRegistration]
+        :type event_driven: bool | None
         """
         self.is_running = False
+        self.event_driven = config.SERVICE_EVENT_DRIVEN if event_driven is None else event_driven
         self.registration_exit_event = threading.Event()
         self.channel_exit_event = threading.Event()
         self.listener_exit_event = threading.Event()
@@ -100,6 +141,14 @@ class ServiceListener(object):
         self.queue_processor_thread = None
         self.r_pubsub = self.r_conn.pubsub(ignore_subscribe_messages=True)
         self.services = services if isinstance(services, list) else list()
+        self.scheduler = JobScheduler(run_job, config.SERVICE_MAX_WORKERS,
+                                      job_type_limits=config.SERVICE_JOB_TYPE_CONCURRENCY,
+                                      framework_limits=config.SERVICE_FRAMEWORK_CONCURRENCY,
+                                      timeout=self.processing_limit.total_seconds(),
+                                      metrics=JobMetrics(self.r_conn, self.job_metrics_key_prefix),
+                                      restart_after_fits=config.SERVICE_FRAMEWORK_RESTART_AFTER_FITS,
+                                      max_pending=config.SERVICE_MAX_PENDING_JOBS,
+                                      max_processes=config.SERVICE_MAX_PROCESSES)
         # make sure things are stopped properly
         atexit.register(self.stop_workers)
 
@@ -140,6 +189,10 @@ class ServiceListener(object):
             self.listener_thread.start()
         if not is_queue_processor_alive:
             logger.info("Starting Queue Processor")
+            if self.event_driven:
+                self.send_heartbeat()
+                self.recover_processing_jobs()
+            self.scheduler.start()
             # Clear Exit Event
             self.queue_processor_exit_event.clear()
             # Start Queue Processor Thread
@@ -168,13 +221,69 @@ class ServiceListener(object):
             logger.info("Exiting Queue Processor")
             self.queue_processor_exit_event.set()
             self.queue_processor_thread.join()
-        # clear-out any redis-locks...
-        if self.r_conn.exists(self.processing_lock_key):
-            self.r_conn.delete(self.processing_lock_key)
-        if self.r_conn.exists(self.preprocessing_lock_key):
-            self.r_conn.delete(self.preprocessing_lock_key)
+        # terminate running jobs and clear-out their redis-locks...
+        for classifier_id in self.scheduler.stop():
+            self.r_conn.delete(self.processing_lock_key_prefix + classifier_id)
+        if self.event_driven:
+            # the jobs that were waiting or terminated are still in the in-progress list
+            self.recover_processing_jobs()
+            self.r_conn.delete(self.heartbeat_key)
         self.is_running = False
 
+    def get_job_metrics(self):
+        """
+        Queue wait and run time statistics of the jobs run by this worker, per job type.
+        :rtype: dict[str, dict]
+        """
+        return self.scheduler.metrics.as_dict()
+
+    def enqueue_job(self, job_details):
+        """
+        Adds a job to the back of the service work queue.
+        :type job_details: dict
+        """
+        job_details.setdefault("queued_at", time.time())
+        job_details_str = json.dumps(job_details, separators=(",", ":"))
+        with self.r_conn.pipeline() as pipe:
+            # event-driven mode consumes from the right (BRPOPLPUSH), polling mode from the left (LPOP)
+            if self.event_driven:
+                pipe.lpush(self.processing_queue_key, job_details_str)
+            else:
+                pipe.rpush(self.processing_queue_key, job_details_str)
+            pipe.expire(self.processing_queue_key, self.processing_queue_key_timeout)
+            pipe.execute()
+
+    def send_heartbeat(self):
+        """
+        Marks this worker's in-progress list as in use for the next heartbeat_key_timeout.
+        """
+        self.r_conn.set(self.heartbeat_key, time.time(), ex=self.heartbeat_key_timeout)
+
+    def recover_processing_jobs(self, abandoned_only=False):
+        """
+        Puts the jobs left in this worker's in-progress list (e.g. because the worker crashed or stopped while running
+        them) and in the lists of workers without a heartbeat back at the front of the work queue.
+        :param abandoned_only: leave this worker's list alone, for while its jobs are running
+        :type abandoned_only: bool
+        :rtype: int
+        """
+        processing_list_keys = [] if abandoned_only else [self.processing_list_key]
+        for processing_list_key in self.r_conn.scan_iter(match=self.processing_list_key_prefix + "*"):
+            consumer_name = processing_list_key[len(self.processing_list_key_prefix):]
+            if processing_list_key != self.processing_list_key and \
+                    not self.r_conn.exists(self.heartbeat_key_prefix + consumer_name):
+                processing_list_keys.append(processing_list_key)
+        recovered = 0
+        for processing_list_key in processing_list_keys:
+            # atomic, so two workers sweeping the same abandoned list don't both re-queue a job
+            count = self.recover_jobs_script(keys=[processing_list_key, self.processing_queue_key])
+            if count:
+                logger.warning("Recovered %s unfinished job(s) from %s", count, processing_list_key)
+            recovered += count
+        if recovered:
+            self.r_conn.expire(self.processing_queue_key, self.processing_queue_key_timeout)
+        return recovered
+
     def pre_process_message(self, message_channel, message_data):
         """
         :type message_channel: str
@@ -194,27 +303,17 @@ class ServiceListener(object):
             logger.warning("Invalid Processing Message")
             return False
 
-        with self.r_conn.lock(self.preprocessing_lock_key, timeout=self.preprocessing_lock_key_timeout):
-            logger.info("Received new job to process with id %s", publish_job_id)
-            queue_data = self.r_conn.lrange(publish_job_queue, 0, -1)
-            idx_found = None
-            for idx, data in enumerate(queue_data):
-                try:
-                    decoded_message = json.loads(data)
-                    job_id = pydash.get(decoded_message, "job_id", None)
-                    if job_id == publish_job_id:
-                        idx_found = idx
-                except (json.JSONDecodeError, TypeError):
-                    continue
-            if not isinstance(idx_found, int):
-                logger.warning("Unable to find message in the Queue")
-                return False
-            self.r_conn.lset(publish_job_queue, idx_found, b"TO_BE_DELETED")
-            self.r_conn.lrem(publish_job_queue, 1, b"TO_BE_DELETED")
-
-        final_job_data = queue_data[idx_found]
+        logger.info("Received new job to process with id %s", publish_job_id)
+        job_key = publish_job_queue + self.job_key_infix + publish_job_id
+        claimed_job = self.claim_job_script(keys=[publish_job_queue, job_key], args=[publish_job_id])
+        if not claimed_job:
+            logger.warning("Unable to find message in the Queue")
+            return False
+
+        # HGETALL's flat [field, value, field, value, ...] reply
+        decoded_message = dict(zip(claimed_job[::2], claimed_job[1::2]))
         try:
-            decoded_message = json.loads(final_job_data)
+            decoded_message["job_data"] = json.loads(decoded_message.get("job_data"))
         except (json.JSONDecodeError, TypeError):
             logger.warning("Invalid Processing Message in Queue")
             return False
@@ -229,54 +328,31 @@ class ServiceListener(object):
         job_data.update({"job_id": job_id, "job_channel": message_channel, "job_queue": publish_job_queue})  # making sure it has the proper Job ID
         return job_data
 
-    @staticmethod
-    @concurrent.process(timeout=processing_limit.seconds)
-    def process_message(job_details):
-        local_redis = redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT, charset="utf-8", decode_responses=True)
-        time_to_spend_trying_to_acquire_lock = max(1, ServiceListener.processing_lock_key_timeout.total_seconds() // 2)
-        try:
-            with local_redis.lock(ServiceListener.processing_lock_key,
-                                  timeout=ServiceListener.processing_lock_key_timeout.total_seconds(),
-                                  blocking_timeout=time_to_spend_trying_to_acquire_lock):
-                job_type = pydash.get(job_details, "type", None)
-                job_framework = pydash.get(job_details, "framework", None)
-                classifier_id = pydash.get(job_details, "classifier_id", None)
-
-                if job_type == "fit":
-                    model_name = pydash.get(job_details, "model_name", None)
-                    pipeline = ner_api()
-                    try:
-                        pipeline.train_model(model_name, classifier_id, job_framework)
-                    except Exception as e:
-                        logger.error("ERROR: Could not train classifier, error: {}".format(e))
-                        # TODO: return status to the front end, either by adding a redis listener or setting job status
-                        # as failed in the database
-                    logger.info('fit completed')
-
-                elif job_type == "predict":
-                    pipeline = ner_api()
-                    documents = pydash.get(job_details, "documents", [])
-                    doc_ids = pydash.get(job_details, "doc_ids", [])
-                    try:
-                        results = pipeline.predict(classifier_id, job_framework, documents, doc_ids)
-                    except Exception as e:
-                        logger.error("ERROR: Could not predict document annotations, error: {}".format(e))
-                        # TODO: return status, stating that were unable to execute a predict from the given parameters
-
-                    # TODO: return results through redis
-
-                else:
-                    logger.error("Service type, {}, unavailable".format(job_type))
-                    return
-        except redis.exceptions.LockError as e:
+    def process_message(self, job_details):
+        """
+        Hands a job to the scheduler, which runs it on the process pool as soon as the concurrency limits allow.
+        :type job_details: dict
+        :rtype: concurrent.futures.Future
+        """
+        future = self.scheduler.submit(job_details)
+        future.add_done_callback(lambda f: self._on_job_done(job_details, f))
+        return future
+
+    def _on_job_done(self, job_details, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if future.result() is False:
             logger.info("Unable to acquire lock in time, re-scheduling job...")
-            local_redis.rpush(ServiceListener.processing_queue_key, json.dumps(job_details, separators=(",", ":")))
+            self.enqueue_job(job_details)
 
     def _start_registration_task(self):
         while not self.registration_exit_event.is_set():
             for service in self.services:
                 registration_msg = json.dumps(service.to_registration_format(), separators=(",", ":"))
                 self.r_conn.publish(self.registration_channel, registration_msg)
+            if self.event_driven:
+                self.send_heartbeat()
+                self.recover_processing_jobs(abandoned_only=True)
             self.registration_exit_event.wait(self.registration_poll.seconds)
 
     def _start_channel_task(self):
@@ -296,18 +372,28 @@ class ServiceListener(object):
             if not self.r_pubsub.subscribed:
                 self.listener_exit_event.wait(self.listener_poll.seconds)
                 continue
-            msg = self.r_pubsub.get_message()
+            if self.event_driven:
+                # blocks until a message arrives, waking up every listener_poll to check for shutdown
+                msg = self.r_pubsub.get_message(timeout=self.listener_poll.total_seconds())
+            else:
+                msg = self.r_pubsub.get_message()
             valid_msg = msg and "type" in msg and "channel" in msg and "data" in msg
             if valid_msg and msg["type"] == "message":
                 job_details = self.pre_process_message(msg["channel"], msg["data"])
                 if job_details:
                     logger.info("Adding Job with ID %s to Service Queue", job_details["job_id"])
-                    self.r_conn.rpush(self.processing_queue_key, json.dumps(job_details, separators=(",", ":")))
-                    self.r_conn.expire(self.processing_queue_key, self.processing_queue_key_timeout)
-            self.listener_exit_event.wait(self.listener_poll.seconds)
+                    self.enqueue_job(job_details)
+            if not self.event_driven:
+                self.listener_exit_event.wait(self.listener_poll.seconds)
 
     def _start_queue_processor_task(self):
+        if self.event_driven:
+            self._start_event_driven_queue_processor_task()
+            return
         while not self.queue_processor_exit_event.is_set():
+            if not self.scheduler.has_capacity():
+                self.queue_processor_exit_event.wait(self.processor_poll.seconds)
+                continue
             msg_in_queue = self.r_conn.lpop(self.processing_queue_key)
             if not msg_in_queue:
                 self.queue_processor_exit_event.wait(self.processor_poll.seconds)
@@ -317,6 +403,91 @@ class ServiceListener(object):
             except (json.JSONDecodeError, TypeError):
                 logger.warning("Invalid Job Details Message")
                 continue
-            # will allow one processor at a time (due to internal locking)
-            self.process_message(job_details)  # type: pebble.ProcessFuture
+            self.process_message(job_details)
             self.queue_processor_exit_event.wait(self.processor_poll.seconds)
+
+    def _start_event_driven_queue_processor_task(self):
+        block_timeout = max(1, int(self.processor_poll.total_seconds()))
+        while not self.queue_processor_exit_event.is_set():
+            # only take jobs off the queue when they can be run soon, so other workers can pick up the rest
+            if not self.scheduler.wait_for_capacity(self.processor_poll.total_seconds()):
+                continue
+            self.claim_next_job(block_timeout)
+
+    def claim_next_job(self, block_timeout):
+        """
+        Atomically moves the oldest job of the work queue into this worker's in-progress list, waiting up to
+        block_timeout seconds for one, and hands it to the scheduler.
+        :type block_timeout: int
+        :rtype: concurrent.futures.Future | None
+        """
+        msg_in_queue = self.r_conn.brpoplpush(self.processing_queue_key, self.processing_list_key, timeout=block_timeout)
+        if not msg_in_queue:
+            return None
+        try:
+            job_details = json.loads(msg_in_queue)
+        except (json.JSONDecodeError, TypeError):
+            logger.warning("Invalid Job Details Message")
+            self.r_conn.lrem(self.processing_list_key, 1, msg_in_queue)
+            return None
+        try:
+            future = self.process_message(job_details)
+        except Exception:
+            self.r_conn.lrem(self.processing_list_key, 1, msg_in_queue)
+            raise
+        future.add_done_callback(lambda f: self._on_claimed_job_done(msg_in_queue, f))
+        return future
+
+    def _on_claimed_job_done(self, msg_in_queue, future):
+        # the job leaves the in-progress list once it finished, whatever the outcome; the ones stop_workers cancelled or
+        # terminated stay there to be put back on the queue
+        if future.cancelled() or isinstance(future.exception(), JobInterrupted):
+            return
+        self.r_conn.lrem(self.processing_list_key, 1, msg_in_queue)
+
+
+def run_job(job_details):
+    """
+    Runs a fit or predict job in a pool process, holding the lock of the job's classifier.
+    :type job_details: dict
+    :returns: False if the classifier's lock could not be acquired in time and the job should be re-scheduled
+    :rtype: bool
+    """
+    job_type = pydash.get(job_details, "type", None)
+    job_framework = pydash.get(job_details, "framework", None)
+    classifier_id = pydash.get(job_details, "classifier_id", None)
+    if job_type not in ("fit", "predict"):
+        logger.error("Service type, {}, unavailable".format(job_type))
+        return True
+
+    local_redis = redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT, charset="utf-8", decode_responses=True)
+    time_to_spend_trying_to_acquire_lock = max(1, ServiceListener.processing_lock_key_timeout.total_seconds() // 2)
+    try:
+        with local_redis.lock(ServiceListener.processing_lock_key_prefix + str(classifier_id),
+                              timeout=ServiceListener.processing_lock_key_timeout.total_seconds(),
+                              blocking_timeout=time_to_spend_trying_to_acquire_lock):
+            if job_type == "fit":
+                model_name = pydash.get(job_details, "model_name", None)
+                pipeline = ner_api()
+                try:
+                    pipeline.train_model(model_name, classifier_id, job_framework)
+                except Exception as e:
+                    logger.error("ERROR: Could not train classifier, error: {}".format(e))
+                    # TODO: return status to the front end, either by adding a redis listener or setting job status
+                    # as failed in the database
+                logger.info('fit completed')
+
+            elif job_type == "predict":
+                pipeline = ner_api()
+                documents = pydash.get(job_details, "documents", [])
+                doc_ids = pydash.get(job_details, "doc_ids", [])
+                try:
+                    results = pipeline.predict(classifier_id, job_framework, documents, doc_ids)
+                except Exception as e:
+                    logger.error("ERROR: Could not predict document annotations, error: {}".format(e))
+                    # TODO: return status, stating that were unable to execute a predict from the given parameters
+
+                # TODO: return results through redis
+    except redis.exceptions.LockError:
+        return False
+    return True
@@ -6,17 +6,24 @@ import logging
 import os
 from os.path import isfile, isdir, join
 import textwrap
+import shutil
+import tempfile
 import uuid
+import weakref
 
+from . import jvm
+from .evaluation import TokenEvaluation
 from .pipeline import Pipeline
+from .tokenization_cache import CORENLP_TOKENIZATION_CACHE
 from .shared.config import ConfigBuilder
 
 config = ConfigBuilder.get_config()
 logger = logging.getLogger(__name__)
 
 #also imports pyjnius after configuring java environment variables
+#the JVM is shared by all instances in a process (see jvm.py); its heap is set by CORENLP_JVM_MAX_HEAP
 #NOTE: jvm will run out of memory if you train too many times while it is running, cause of leak unknown
-#in the meantime if you must call fit a lot, destroy the object and create a new one to reset the jvm
+#in the meantime the pipeline service restarts its corenlp processes every SERVICE_FRAMEWORK_RESTART_AFTER_FITS fits
 
 class corenlp_NER(Pipeline):
     #Path variables
@@ -26,7 +33,6 @@ class corenlp_NER(Pipeline):
     #files output in the process of training model
     #id is so the output files are unique to each instantiation, otherwise weird things will happen if we decide to use query-by-committee
     #TODO: maybe don't use id if it isn't specified?
-    __train_file = ''
     __test_file = '' #TODO: only really needed for evaluate_orig, maybe remove?
     __model = ''
     __temp_dir = None
@@ -47,16 +53,16 @@ class corenlp_NER(Pipeline):
 
         if tmp_dir != None:
             self.__temp_dir = tmp_dir
+            if not isdir(self.__temp_dir):
+                os.makedirs(self.__temp_dir)
             #can choose to dictate where the model will store files so that it doesn't overwrite any,
-            #otherwise it will write to a new directory within the resources folder
+            #otherwise it will write to a new directory, removed along with this instance
         else:
-            self.__temp_dir = config.ROOT_DIR + '/tmp/' + str(self.__id)
-
-        if not isdir(self.__temp_dir):
-            os.makedirs(self.__temp_dir)
+            os.makedirs(config.ROOT_DIR + '/tmp', exist_ok=True)
+            self.__temp_dir = tempfile.mkdtemp(prefix='corenlp-', dir=config.ROOT_DIR + '/tmp')
+            weakref.finalize(self, shutil.rmtree, self.__temp_dir, ignore_errors=True)
         logger.info("Using temp dir {}".format(self.__temp_dir))
 
-        self.__train_file = join(self.__temp_dir, 'corenlp_training.tsv')
         self.__test_file = join(self.__temp_dir, 'corenlp_test_gold.tsv')
         self.__model = join(self.__temp_dir, 'corenlp-ner-model.ser.gz')
 
@@ -67,9 +73,7 @@ class corenlp_NER(Pipeline):
             self.__jdk_dir = java_dir
         else:
             self.__jdk_dir = '/usr/lib/jvm/java-1.8.0-openjdk-amd64' # self.__jdk_dir = '/usr/lib/jvm/java-8-oracle'
-        if isdir(self.__jdk_dir):
-            os.environ['JAVA_HOME'] = self.__jdk_dir
-        else:
+        if not isdir(self.__jdk_dir):
             raise ImportError("ERROR: JAVA installation not found")
 
 
@@ -78,21 +82,15 @@ class corenlp_NER(Pipeline):
             self.__jar = ner_path
         else:
             self.__jar = './resources/stanford-corenlp-full-2018-02-27/stanford-corenlp-3.9.1.jar'
-        if isfile(self.__jar):
-            os.environ['CLASSPATH'] = self.__jar
-        else:
+        if not isfile(self.__jar):
             raise ImportError("ERROR: Stanford NER Library not found")
 
         #if you get to this point, java and stanford ner library should be located
-        import jnius_config
-        if not jnius_config.vm_running:
-            print('Configured JVM')
-            jnius_config.add_options('-Xmx32g') #allocate enough memory to the JVM heap to run the classifier
-        else:
-            raise RuntimeWarning('WARNING: JVM already running. Cannot run core nlp')
+        #allocate enough memory to the JVM heap to run the classifier
+        jvm.start(self.__jdk_dir, self.__jar, config.CORENLP_JVM_MAX_HEAP)
 
         #import pyjnius to import required classes from JAVA/Stanford NER
-        from jnius import autoclass
+        autoclass = jvm.autoclass
 
         #General
         self.__java_String = autoclass("java.lang.String")
@@ -147,11 +145,7 @@ class corenlp_NER(Pipeline):
         except:
             raise Exception("ERROR: could not format input correctly")
 
-        with open(self.__train_file, 'w') as f:
-            for doc in train_data:
-                for ent in doc:
-                    f.write(ent[0] + '\t' + ent[1]  + '\n')
-                f.write('\n')
+        train_text = ''.join(''.join(ent[0] + '\t' + ent[1] + '\n' for ent in doc) + '\n' for doc in train_data)
         if params is not None:
             for key in default_params.keys():
                 if key in params:
@@ -162,8 +156,7 @@ class corenlp_NER(Pipeline):
                 prop_text = f.read()
         else:
             prop_text = textwrap.dedent(
-    """# location of the training file
-trainFile = """+ self.__train_file + """
+    """# the training file is set when training
 # location where you would like to save (serialize) your
 # classifier; adding .gz at the end automatically gzips the file,
 # making it smaller, and faster to load
@@ -209,14 +202,17 @@ wordShape=""" + default_params["word_shape"] + """
             self.__SCNLP.clearAnnotatorPool()
             del self.__crf #may clear up some memory, unclear how much of an effect it has
 
-        self.__crf = self.__java_CRFClassifier(self.__props)
+        #the training data only exists while training, in a (by default memory-backed) file CoreNLP reads it from
+        with jvm.data_file(train_text, '.tsv', config.JAVA_DATA_TMP_DIR) as train_file:
+            if self.__props.getProperty(self.__java_String("trainFile")) is None:
+                self.__props.setProperty(self.__java_String("trainFile"), self.__java_String(train_file))
+            self.__crf = self.__java_CRFClassifier(self.__props)
 
-        self.__crf.train()
+            self.__crf.train()
 
         #TODO: make this user optional? or just have them call save_model?
         modelPath = self.__props.getProperty(self.__java_String("serializeTo"))
         self.__crf.serializeClassifier(self.__java_String(modelPath))
-        os.remove(self.__train_file)
 
 
 
@@ -225,22 +221,28 @@ wordShape=""" + default_params["word_shape"] + """
     def predict(self, X, Xid):
         out = {}
         for doc, doc_id in zip(X, Xid):
-            doc_ents = []
-            test_text = self.__java_String(doc)
-            results = self.__crf.classify(test_text)
-
-            for s in range(results.size()):
-                for w in range(results.get(s).size()):
-                    word = results.get(s).get(w)
-                    start_char = word.beginPosition()
-                    end_char = word.endPosition()
-                    label = word.get(self.__java_AA)
-                    #print(str(start_char) + '-' + str(end_char) + ': ' + word.word() + '/' + label)
-                    if label != 'O':
-                        doc_ents.append((start_char, end_char, label))
-            out[doc_id] = doc_ents
+            out[doc_id] = self.__classify(doc)[0]
         return out
 
+    #returns the labeled entities of a document and the offsets of all of its tokens
+    def __classify(self, doc):
+        doc_ents = []
+        doc_tokens = []
+        test_text = self.__java_String(doc)
+        results = self.__crf.classify(test_text)
+
+        for s in range(results.size()):
+            for w in range(results.get(s).size()):
+                word = results.get(s).get(w)
+                start_char = word.beginPosition()
+                end_char = word.endPosition()
+                label = word.get(self.__java_AA)
+                #print(str(start_char) + '-' + str(end_char) + ': ' + word.word() + '/' + label)
+                doc_tokens.append((start_char, end_char))
+                if label != 'O':
+                    doc_ents.append((start_char, end_char, label))
+        return doc_ents, doc_tokens
+
     #predict_proba(X, Xid)
     #returns {text_id: [(offset_start, offset_end, label, score), ... []], ...}
     #can also return scores for all labels if get_all is True
@@ -328,6 +330,7 @@ wordShape=""" + default_params["word_shape"] + """
                     for w in words:
                         ent_extract.append((w,l))
             out.append(ent_extract)
+        CORENLP_TOKENIZATION_CACHE.log_stats()
         return out
 
     #saves model so that it can be loaded again later
@@ -353,7 +356,11 @@ wordShape=""" + default_params["word_shape"] + """
 
     #method for tokenizing text
     #TODO: currently this implementation of corenlp doesn't support more than one label per token
+    #texts are tokenized once per worker process (or once for all of them with a store), see tokenization_cache.py
     def tokenize(self, input_text):
+        return CORENLP_TOKENIZATION_CACHE.get_or_tokenize(input_text, self.__tokenize)
+
+    def __tokenize(self, input_text):
         #print(input_text)
         text = self.__java_String(input_text)
 
@@ -368,219 +375,16 @@ wordShape=""" + default_params["word_shape"] + """
 
         return tokens
 
-    #Calculates Precision, Recall, and F1 Score for model based on input test data
-    #WARNING: currently works for BioNLP data, no guarantees with other datasets
+    #Calculates Precision, Recall, and F1 Score for model based on input test data, per token (see evaluation.py)
     def evaluate(self, X, y, Xid, verbose=False):
+        evaluation = TokenEvaluation()
+        for doc, gold in zip(X, y):
+            guess, tokens = self.__classify(doc)
+            if verbose: print('GOLD: ' + str(gold) + '\nGUESS: ' + str(guess))
+            evaluation.add_document(tokens, gold, guess)
+        return evaluation.stats()
 
-        known_labels = set()
-        for anns in y:
-            for ann in anns:
-                known_labels.add(ann[2])
-
-        stats = {}
-
-        try:
-            train_data = self.format_data(X, y)
-            if len(train_data) == 0 or train_data is None:
-                raise Exception("ERROR: could not format input correctly")
-        except:
-            raise Exception("ERROR: could not format input correctly")
-        test_text = ''
-
-        for doc in X:
-            test_text = test_text + doc + '\n\n'
-        #rest of code tries to recreate calculations as this line, which can't be called more than once for some reason
-        #results = self.__crf.classifyAndWriteAnswers(self.__java_String(self.__test_file), True)
-        #print(test_text)
-        results = self.__crf.classify(self.__java_String(test_text))
-
-
-        #Calculate evaluation by iterating through answer key and matching tokens to classifier output
-        s = 0
-        w = 0
-        prev_gold = ''
-        prev_guess = ''
-        next_guess = None
-
-        for d, doc in enumerate(train_data):
-            for i, answer in enumerate(doc):
-                #Find corresponding token in gold and predicted
-                word = answer[0]
-                gold = answer[1]
-                if verbose: print('GOLD: ' + word + ',' + gold)
-
-                if word == '<xn>':
-                    if verbose: print('SKIP')
-                    continue
-
-                if next_guess != None:
-                    guess = next_guess
-                else:
-                    guess = (results.get(s).get(w).word(), results.get(s).get(w).get(self.__java_AA))
-
-                a = 1
-                votes = {guess[1]: 1}
-                next_guess = None
-                #if the tokens don't match, loop until they do
-                while word != guess[0]:
-
-                    if len(word) > len(guess[0]) and word[0:len(guess[0])] == guess[0]: #if the classifier has tokenized more finely than the answer, then keep adding the next tokens to the guessed token until it matches
-                        #since tokens sometime have to be concatenated, we use a voting system,
-                        #where the most popular label of all of the individual tokens is used
-                        to_add = (results.get(s).get(w+a).word(), results.get(s).get(w+a).get(self.__java_AA))
-                        if to_add[1] not in votes:
-                            votes[to_add[1]] = 1
-                        votes[to_add[1]] += 1
-                        #use the most popular label based on the individual tokens
-                        guess = (guess[0] + to_add[0], sorted(votes, key=votes.__getitem__, reverse=True)[0])
-                        a = a + 1
-                    elif len(word) < len(guess[0]) and word == guess[0][0:len(word)]: #if the guessed token is larger than the answer, break the rest off into the next guess
-                        next_guess = (guess[0][len(word):], guess[1])
-                        guess = (guess[0][0:len(word)], guess[1])
-                    else: #if the guess token does not match any part of the answer token, then move on to the next token without adding
-                        w = w + 1
-                        if w >= results.get(s).size():
-                            w = 0
-                            s = s + 1
-                        if s >= results.size():
-                            break
-                        guess = (results.get(s).get(w).word(), results.get(s).get(w).get(self.__java_AA))
-                        next_guess = None
-                        a = 1
-                        votes = {guess[1]: 1} #reset votes when concatenation is discarded
-                    if verbose: print(guess)
-
-                    #check what the next gold token is, if it matches with the current guess then just move on
-                    #(likely the current answer token doesn't exactly match the guess token, see `` vs '')
-                    if i+1 < len(doc):
-                        next_gold = doc[i+1]
-                    elif i >= len(doc) and d+1 < len(test_data):
-                        next_gold = test_data[d+1][0]
-                    else:
-                        next_gold = (None, None)
-                    if guess[0] == next_gold[0]: break
-                if word != guess[0]: continue
-
-                #if the code gets to here we are pretty confident the tokens match
-                if verbose: print('GUESS: ' + str(guess))
-
-                pred = guess[1]
-
-                known_labels.add(pred)
-
-                # Per token metriccs
-                for label in known_labels:
-                    if label not in stats:
-                        stats[label] = [0, 0, 0, 0]
-
-
-
-
-                if gold == pred and gold != 'O':
-                    stats[gold][0] = stats[gold][0] + 1
-                    for label in known_labels:
-                        if label != gold:
-                            stats[label][3] = stats[label][3] + 1
-                elif gold == 'O' and pred != 'O':
-                    stats[pred][1] = stats[pred][1] + 1
-                    for label in known_labels:
-                        if label != pred:
-                            stats[label][3] = stats[label][3] + 1
-                elif pred == 'O' and gold != 'O':
-                    stats[gold][2] = stats[gold][2] + 1
-                    for label in known_labels:
-                        if label != gold:
-                            stats[label][3] = stats[label][3] + 1
-                else:
-                    for label in known_labels:
-                        stats[label][3] = stats[label][3] + 1
-
-
-                # Per annotation metrics
-                # if gold not in stats:
-                #     stats[gold] = [0, 0, 0]
-                # if pred not in stats:
-                #     stats[pred] = [0, 0, 0]
-                # if gold == pred:
-                #     #TRUE POSITIVE
-                #     #Stanford NLP considers adjacent tokens with the same (non 'O') label to be one instance of that label
-                #     if gold != prev_gold or gold == 'O':
-                #         stats[gold][0] = stats[gold][0] + 1
-                #         if gold != 'O': stats['Totals'][0] = stats['Totals'][0] + votes[gold]
-                #     if verbose: print('TRUE POSITIVE')
-                # else:
-                #     #GOLD ADDS FALSE NEGATIVE
-                #     if gold != prev_gold or gold == 'O':
-                #         stats[gold][2] = stats[gold][2] + 1
-                #         if gold != 'O': stats['Totals'][2] = stats['Totals'][2] + 1
-                #     if verbose: print('FALSE NEGATIVE FOR ' + gold)
-                #     #pred ADDS FALSE POSITIVE
-                #     if pred != prev_guess or pred == 'O':
-                #         stats[pred][1] = stats[pred][1] + 1
-                #         if pred != 'O': stats['Totals'][1] = stats['Totals'][1] + (votes[pred] if pred in votes else 1)
-                #     if verbose: print('FALSE POSITIVE FOR ' + pred)
-                #
-                # #if tokens had to be concatenated and they were not all the same label
-                # if len(votes) > 1:
-                #     for label in sorted(votes, key=votes.__getitem__, reverse=True)[1:]:
-                #         if label not in stats:
-                #             stats[label] = [0, 0, 0]
-                #         stats[label][1] += votes[label] #add false positives to all the labels other than the most popular one as well
-                #         if verbose: print('FALSE POSITIVE FOR ' + label)
-                #
-                # prev_gold = gold
-                # prev_guess = pred
-
-        #removes stats for 'O' as we don't really care about that;
-        #ONLY USED FOR PER ANNOTATION METRICS
-        # del stats['O']
-
-        TP = 0
-        TN = 0
-        FP = 0
-        FN = 0
-        for key in stats:
-            TP = TP + stats[key][0]
-            FP = FP + stats[key][1]
-            FN = FN + stats[key][2]
-            TN = TN + stats[key][3]
-
-        stats['Totals'] = [TP, FP, FN, TN]
-
-
-
-        #print(test_data[-1])
-        for key in stats:
-            TP = stats[key][0]
-            FP = stats[key][1]
-            FN = stats[key][2]
-            # Only generated when using per token metrics
-            TN = stats[key][3]
-            if (TP+FN) != 0:
-                recall = TP/(TP+FN)
-            else:
-                recall = 1.0
-            if (TP+FP) != 0:
-                precision = TP/(TP+FP)
-            else:
-                precision = 0.0
-            if (precision + recall) != 0:
-                f1 = 2 * (precision * recall) / (precision + recall)
-            else:
-                f1 = 0
-            # Acc Only works when using per token metrics which generates TN
-            if (TP + FN + FP + TN) != 0:
-                acc = (TP + TN) / (TP + FN + FP + TN)
-            else:
-                acc = 0
-            #Used for annotation metrics
-            # stats[key] = {'precision': precision, 'recall': recall, 'f1': f1, 'TP': TP, 'FP': FP, 'FN': FN}
-            # Used for token metrics
-            stats[key] = {'precision': precision, 'recall': recall, 'f1': f1, 'TP': TP, 'FP': FP, 'FN': FN, 'TN': TN, 'acc': acc}
-
-        return stats
-
-            #Calculates Precision, Recall, and F1 Score for model based on input test data
+    #Calculates Precision, Recall, and F1 Score for model based on input test data
     #TODO: prints a whole lot to the command line, find a way to suppress?
     def evaluate_orig(self, X, y, Xid):
         try:
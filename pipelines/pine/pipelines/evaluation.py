@@ -0,0 +1,86 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import numpy as np
+
+#Token level evaluation shared by the pipelines: a token has a label in the gold annotations (or the predictions) if a
+#span with that label covers the whole token, and every (token, label) is counted as a true/false positive/negative.
+#ASSUMED INPUT
+#tokens = [(start offset, stop offset), ...] sorted by offset, not overlapping
+#spans = [(start offset, stop offset, label), ...]
+
+
+def token_label_masks(tokens, spans, label_index):
+    #returns a (number of tokens, number of labels) boolean array, True where a span with the label covers the token;
+    #label_index maps labels to columns, and spans with labels missing from it are ignored
+    masks = np.zeros((len(tokens), len(label_index)), dtype=bool)
+    spans = [span for span in spans if span[2] in label_index]
+    if len(tokens) == 0 or len(spans) == 0:
+        return masks
+    token_offsets = np.asarray(tokens, dtype=np.int64).reshape(-1, 2)
+    span_starts = np.array([span[0] for span in spans], dtype=np.int64)
+    span_ends = np.array([span[1] for span in spans], dtype=np.int64)
+    span_labels = np.array([label_index[span[2]] for span in spans], dtype=np.int64)
+    #covered tokens are the ones from the first starting at or after the span start up to the last ending at or before
+    #the span end
+    first = np.searchsorted(token_offsets[:, 0], span_starts, side='left')
+    last = np.searchsorted(token_offsets[:, 1], span_ends, side='right')
+    covers = first < last
+    #+1 where a label's tokens start and -1 after they end, so the running sum is positive on covered tokens
+    changes = np.zeros((len(tokens) + 1, len(label_index)), dtype=np.int64)
+    np.add.at(changes, (first[covers], span_labels[covers]), 1)
+    np.add.at(changes, (last[covers], span_labels[covers]), -1)
+    return np.cumsum(changes[:-1], axis=0) > 0
+
+
+def metrics(TP, FP, FN, TN):
+    if (TP + FN) != 0:
+        recall = TP / (TP + FN)
+    else:
+        recall = 1.0
+    if (TP + FP) != 0:
+        precision = TP / (TP + FP)
+    else:
+        precision = 0.0
+    if (precision + recall) != 0:
+        f1 = 2 * (precision * recall) / (precision + recall)
+    else:
+        f1 = 0
+    if (TP + FN + FP + TN) != 0:
+        acc = (TP + TN) / (TP + FN + FP + TN)
+    else:
+        acc = 0
+    return {'precision': precision, 'recall': recall, 'f1': f1, 'TP': TP, 'FP': FP, 'FN': FN, 'TN': TN, 'acc': acc}
+
+
+class TokenEvaluation(object):
+    #accumulates the counts of every label over documents; a label's true negatives are all the tokens that aren't one
+    #of its true/false positives/negatives, including the tokens of the documents before the label was first seen
+
+    def __init__(self):
+        self.label_index = dict()
+        self.num_tokens = 0
+        self.counts = np.zeros((0, 3), dtype=np.int64)  #(label, [TP, FP, FN])
+
+    def add_document(self, tokens, gold, guess):
+        #gold and guess are the spans of the document's annotations and predictions
+        for span in list(gold) + list(guess):
+            if span[2] not in self.label_index:
+                self.label_index[span[2]] = len(self.label_index)
+        if len(self.counts) < len(self.label_index):
+            self.counts = np.concatenate((self.counts, np.zeros((len(self.label_index) - len(self.counts), 3),
+                                                                 dtype=np.int64)))
+        gold_masks = token_label_masks(tokens, gold, self.label_index)
+        guess_masks = token_label_masks(tokens, guess, self.label_index)
+        self.counts[:, 0] += np.count_nonzero(gold_masks & guess_masks, axis=0)
+        self.counts[:, 1] += np.count_nonzero(~gold_masks & guess_masks, axis=0)
+        self.counts[:, 2] += np.count_nonzero(gold_masks & ~guess_masks, axis=0)
+        self.num_tokens += len(tokens)
+
+    def stats(self):
+        #returns {label: {'precision', 'recall', 'f1', 'TP', 'FP', 'FN', 'TN', 'acc'}, ..., 'Totals': {...}}
+        TN = self.num_tokens - self.counts.sum(axis=1)
+        stats = dict()
+        for label, index in self.label_index.items():
+            stats[label] = metrics(*[int(c) for c in self.counts[index]], int(TN[index]))
+        stats['Totals'] = metrics(*[int(c) for c in self.counts.sum(axis=0)], int(TN.sum()))
+        return stats
@@ -0,0 +1,160 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import contextlib
+import ctypes
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# pyjnius runs at most one JVM per process, and its classpath and heap can't be changed once it started.  Pipeline jobs
+# run in long-lived processes (one pool per framework), so the first Java pipeline created in a process starts the JVM
+# and the following ones reuse it, along with the classes and the (read-only) models it already loaded.
+
+_lock = threading.RLock()
+_classes = dict()
+_resident = dict()
+
+
+def start(java_home, classpath, max_heap=None):
+    """
+    Starts this process' JVM, or checks that the one already running has the given classpath.
+    :type java_home: str
+    :type classpath: str
+    :param max_heap: maximum JVM heap size, e.g. "8g"
+    :type max_heap: str | None
+    """
+    import jnius_config
+    with _lock:
+        if jnius_config.vm_running:
+            if os.environ.get("CLASSPATH") != classpath:
+                raise RuntimeWarning("WARNING: JVM already running with classpath {}".format(os.environ.get("CLASSPATH")))
+            return
+        os.environ["JAVA_HOME"] = java_home
+        os.environ["CLASSPATH"] = classpath
+        if max_heap and not any(option.startswith("-Xmx") for option in jnius_config.get_options()):
+            jnius_config.add_options("-Xmx" + max_heap)
+        logger.info("Configured JVM with classpath {} and options {}".format(classpath, jnius_config.get_options()))
+
+
+def autoclass(class_name):
+    """
+    jnius.autoclass, resolving every class only once per process.
+    :type class_name: str
+    """
+    with _lock:
+        if class_name not in _classes:
+            from jnius import autoclass as jnius_autoclass
+            _classes[class_name] = jnius_autoclass(class_name)
+        return _classes[class_name]
+
+
+def resident(key, create):
+    """
+    Returns the object kept under key, creating it the first time.  For objects that are expensive to load and not
+    changed by the pipelines, like tokenizer and sentence models.
+    :param key: hashable
+    :param create: called without arguments to create the object
+    :type create: callable
+    """
+    with _lock:
+        if key not in _resident:
+            _resident[key] = create()
+        return _resident[key]
+
+
+def detach_thread():
+    """
+    Detaches the calling thread from the JVM.  Threads other than the main one that used Java objects must call this
+    before they exit, or the JVM can't shut down.
+    """
+    if "jnius" in sys.modules:
+        import jnius
+        jnius.detach()
+
+
+def _memfd_create(name):
+    # os.memfd_create is only in Python 3.8+, older ones call glibc's (2.27+) directly; None if neither is available
+    if hasattr(os, "memfd_create"):
+        return os.memfd_create(name)
+    try:
+        libc_memfd_create = ctypes.CDLL(None, use_errno=True).memfd_create
+    except (AttributeError, OSError):
+        return None
+    fd = libc_memfd_create(name.encode("utf-8"), 1)  # MFD_CLOEXEC
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return fd
+
+
+def _write_memory(encoded, suffix):
+    # an anonymous in-memory file, read by the JVM (in this process) through /proc/self/fd; unlike /dev/shm, it isn't
+    # limited by the size of a tmpfs (64 MB in docker containers), only by memory
+    fd = _memfd_create("java-data" + suffix)
+    if fd is None:
+        return None, None
+    try:
+        view = memoryview(encoded)
+        while view:
+            view = view[os.write(fd, view):]
+    except OSError:
+        os.close(fd)
+        raise
+    return fd, "/proc/self/fd/{}".format(fd)
+
+
+def _write(encoded, suffix, directory):
+    (fd, path) = tempfile.mkstemp(suffix=suffix, dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(encoded)
+    except OSError:
+        os.remove(path)
+        raise
+    return path
+
+
+@contextlib.contextmanager
+def data_file(data, suffix, directory=None):
+    """
+    Puts data (e.g. training data) in a temporary file for a Java library that only reads files, and removes the file
+    when the block exits.  The file is kept in memory (a memfd) where the system supports it, and written to disk
+    otherwise.
+    :type data: str
+    :param suffix: file name suffix
+    :type suffix: str
+    :param directory: where to create the file if it can't be kept in memory; None for the system temp directory, which
+                      is also used when the file can't be written to directory (e.g. it is full)
+    :type directory: str | None
+    :returns: the file's path
+    """
+    start = time.time()
+    encoded = data.encode("utf-8")
+    fd, path = None, None
+    try:
+        fd, path = _write_memory(encoded, suffix)
+    except OSError as e:
+        logger.warning("Unable to keep {} bytes in memory, writing them to disk: {}".format(len(encoded), e))
+    if path is None:
+        try:
+            path = _write(encoded, suffix, directory)
+        except OSError as e:
+            if directory is None:
+                raise
+            logger.warning("Unable to write {} bytes to {}, using the system temp directory: {}".format(
+                len(encoded), directory, e))
+            path = _write(encoded, suffix, None)
+    logger.info("Wrote {} bytes to {} in {:.3f}s".format(len(encoded), "memory" if fd is not None else path,
+                                                         time.time() - start))
+    try:
+        yield path
+    finally:
+        if fd is not None:
+            os.close(fd)
+        else:
+            os.remove(path)
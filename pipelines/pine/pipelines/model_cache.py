@@ -0,0 +1,106 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import collections
+import logging
+import os
+import threading
+
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+
+def _get_rss():
+    # resident memory of this process in bytes, or None where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _get_disk_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class ModelCache(object):
+    """
+    LRU cache of loaded classifiers, keyed by (classifier_id, filename) and bounded by an estimate of the memory they
+    take.  It lives as long as the pipeline worker process, so predictions for a hot classifier don't reload its model.
+    A classifier has at most one cached model: caching a new filename for it (after a train) drops the old one.
+    """
+
+    def __init__(self, max_bytes, max_models):
+        """
+        :type max_bytes: int
+        :type max_models: int
+        """
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.models = collections.OrderedDict()  # (classifier_id, filename) -> (model, size estimate in bytes)
+        self.num_bytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        self.lock = threading.RLock()
+
+    def get_or_load(self, classifier_id, filename, load):
+        """
+        :type classifier_id: str
+        :type filename: str
+        :param load: called without arguments to load the model on a miss
+        :type load: callable
+        """
+        key = (classifier_id, filename)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.models[key][0]
+            self.stats["misses"] += 1
+            rss_before = _get_rss()
+            model = load()
+            rss_after = _get_rss()
+            loaded_bytes = rss_after - rss_before if rss_before is not None and rss_after is not None else 0
+            self.put(classifier_id, filename, model, loaded_bytes)
+            return model
+
+    def put(self, classifier_id, filename, model, size=0):
+        """
+        :type classifier_id: str
+        :type filename: str
+        :param size: how much memory the model takes in bytes, if known; at least its size on disk is assumed
+        :type size: int
+        """
+        size = max(size, _get_disk_size(filename))
+        with self.lock:
+            self.invalidate(classifier_id)
+            if self.max_models <= 0 or size > self.max_bytes:
+                logger.info("Not caching model %s of %s bytes", filename, size)
+                return
+            self.models[(classifier_id, filename)] = (model, size)
+            self.num_bytes += size
+            while len(self.models) > self.max_models or self.num_bytes > self.max_bytes:
+                (evicted_id, evicted_filename), (_, evicted_size) = self.models.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.stats["evictions"] += 1
+                logger.info("Evicted model %s of classifier %s from the cache", evicted_filename, evicted_id)
+
+    def invalidate(self, classifier_id):
+        """
+        Drops any cached model of the given classifier.
+        :type classifier_id: str
+        """
+        with self.lock:
+            for key in [key for key in self.models if key[0] == classifier_id]:
+                self.num_bytes -= self.models.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.num_bytes = 0
+
+
+# one per process; pipeline jobs run in long-lived pool processes (one pool per framework)
+MODEL_CACHE = ModelCache(config.MODEL_CACHE_MAX_MB * 1024 * 1024, config.MODEL_CACHE_MAX_MODELS)
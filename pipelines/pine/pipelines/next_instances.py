@@ -0,0 +1,78 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import logging
+import uuid
+
+import redis
+
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+# The backend keeps the documents annotators are given next in redis (see backend/pine/backend/pipelines/queues.py for
+# the key layout), and saves them to the classifier's next_instances item in eve from there.  Once a classifier's queues
+# are in redis, new rankings have to be written there; before that, eve is where the backend loads them from.
+
+KEY_PREFIX = config.REDIS_PREFIX + "next-instances:"
+DIRTY_KEY = KEY_PREFIX + "dirty"
+ZADD_CHUNK_SIZE = 10000
+
+# next_instances field -> queue
+QUEUES = {
+    "head_document_ids": "head",
+    "document_ids": "documents"
+}
+
+# KEYS: meta, new queue, queue, dirty; ARGV: classifier_id
+# replaces the queue with the new one if the classifier's queues are loaded, otherwise drops the new one
+REPLACE_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    redis.call("DEL", KEYS[2])
+    return 0
+end
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("RENAME", KEYS[2], KEYS[3])
+else
+    redis.call("DEL", KEYS[3])
+end
+redis.call("SADD", KEYS[4], ARGV[1])
+return 1
+"""
+
+_r_conn = None
+
+
+def _get_connection():
+    global _r_conn
+    if _r_conn is None:
+        _r_conn = redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT, charset="utf-8", decode_responses=True)
+    return _r_conn
+
+
+def save_ranking(classifier_id, field, document_ids):
+    """
+    Replaces one of the classifier's queues, if they are in redis.
+    :type classifier_id: str
+    :param field: "head_document_ids" or "document_ids"
+    :type field: str
+    :param document_ids: in the order of the next_instances item, served from the end
+    :type document_ids: list[str]
+    :returns: whether the queue was replaced; if not, the ranking must be saved to eve
+    :rtype: bool
+    """
+    r_conn = _get_connection()
+    classifier_key = KEY_PREFIX + classifier_id
+    new_key = "{}:{}:new:{}".format(classifier_key, QUEUES[field], uuid.uuid4())
+    try:
+        with r_conn.pipeline() as pipe:
+            for start in range(0, len(document_ids), ZADD_CHUNK_SIZE):
+                chunk = document_ids[start:start + ZADD_CHUNK_SIZE]
+                pipe.zadd(new_key, {document_id: start + i for i, document_id in enumerate(chunk)})
+            pipe.eval(REPLACE_SCRIPT, 4, classifier_key + ":meta", new_key, classifier_key + ":" + QUEUES[field], DIRTY_KEY,
+                      classifier_id)
+            return bool(pipe.execute()[-1])
+    except redis.exceptions.RedisError as e:
+        # the transaction wasn't applied, so the new queue wasn't created either
+        logger.warning("Unable to save ranking of classifier {} to redis: {}".format(classifier_id, e))
+        return False
@@ -6,10 +6,15 @@ import logging
 import os
 from os.path import isfile, isdir, exists, join
 import pydash
+import shutil
+import tempfile
 import uuid
+import weakref
 import sys
 import traceback
 
+from . import jvm
+from .evaluation import TokenEvaluation
 from .pipeline import Pipeline
 from .shared.config import ConfigBuilder
 
@@ -17,13 +22,13 @@ config = ConfigBuilder.get_config()
 logger = logging.getLogger(__name__)
 
 #also imports pyjnius after configuring java environment variables
+#the JVM is shared by all instances in a process (see jvm.py); its heap is set by OPENNLP_JVM_MAX_HEAP
 
 class opennlp_NER(Pipeline):
     #Path variables
     __jar = '' 
     __jdk_dir = ''
     __temp_dir = None
-    __train_file = ''
     __test_file = '' #TODO: only really needed for evaluate_orig, maybe remove?
 
     #Model variables
@@ -43,16 +48,16 @@ class opennlp_NER(Pipeline):
 
         if tmp_dir != None:
             self.__temp_dir = tmp_dir
-            #can choose to dictate where the model will store files so that it doesn't overwrite any, 
-            #otherwise it will write to a new directory within the resources folder
+            if not isdir(self.__temp_dir):
+                os.makedirs(self.__temp_dir)
+            #can choose to dictate where the model will store files so that it doesn't overwrite any,
+            #otherwise it will write to a new directory, removed along with this instance
         else:
-            self.__temp_dir = config.ROOT_DIR + '/tmp/' + str(self.__id)
-
-        if not isdir(self.__temp_dir):
-            os.makedirs(self.__temp_dir)
+            os.makedirs(config.ROOT_DIR + '/tmp', exist_ok=True)
+            self.__temp_dir = tempfile.mkdtemp(prefix='opennlp-', dir=config.ROOT_DIR + '/tmp')
+            weakref.finalize(self, shutil.rmtree, self.__temp_dir, ignore_errors=True)
         logger.info("Using temp dir {}".format(self.__temp_dir))
 
-        self.__train_file = join(self.__temp_dir, 'opennlp_ner.train')
         self.__test_file = join(self.__temp_dir, 'opennlp_ner.test')
 
         #TODO: set defaults for the following
@@ -61,9 +66,7 @@ class opennlp_NER(Pipeline):
             self.__jdk_dir = java_dir
         else:
             self.__jdk_dir = '/usr/lib/jvm/java-1.8.0-openjdk-amd64'
-        if isdir(self.__jdk_dir):
-            os.environ['JAVA_HOME'] = self.__jdk_dir
-        else:
+        if not isdir(self.__jdk_dir):
             raise ImportError("ERROR: JAVA installation not found")
 
         #Point to Location of OpenNLP Library Directory
@@ -72,22 +75,16 @@ class opennlp_NER(Pipeline):
         else:
             #self.__jar = 'resources/apache-opennlp-1.9.0/lib/'
             self.__ner_path= 'resources/apache-opennlp-1.9.0'
-        if exists(self.__ner_path):
-            os.environ['CLASSPATH'] = os.path.join(self.__ner_path, 'lib', '*')
-        else:
+        if not exists(self.__ner_path):
             raise ImportError("ERROR: OpenNLP Library not found")
 
 
         #if you get to this point, java and opennlp library should be located
-        import jnius_config
-        if not jnius_config.vm_running:
-            logger.info('Configured JVM')
-            jnius_config.add_options('-Xmx8g') #allocate enough memory to the JVM heap to run the classifier
-        else:
-            raise RuntimeWarning('WARNING: JVM already running. Cannot run open nlp')
+        #allocate enough memory to the JVM heap to run the classifier
+        jvm.start(self.__jdk_dir, os.path.join(self.__ner_path, 'lib', '*'), config.OPENNLP_JVM_MAX_HEAP)
 
         #import pyjnius to import required classes from JAVA/opennlp
-        from jnius import autoclass
+        autoclass = jvm.autoclass
 
         #General
         self.__java_String = autoclass("java.lang.String")
@@ -101,8 +98,14 @@ class opennlp_NER(Pipeline):
 
         #self.__sentenceDetector = self.__java_SentenceDetectorME(self.__java_SentenceModel(self.__java_File(self.__java_String("pipelines/resources/apache-opennlp-1.9.0/en-sent.bin"))))
         #self.__tokenizer = self.__java_TokenizerME(self.__java_TokenizerModel(self.__java_File(self.__java_String("pipelines/resources/apache-opennlp-1.9.0/en-token.bin"))))
-        self.__sentenceDetector = self.__java_SentenceDetectorME(self.__java_SentenceModel(self.__java_File(self.__java_String(os.path.join(self.__ner_path, 'en-sent.bin')))))
-        self.__tokenizer = self.__java_TokenizerME(self.__java_TokenizerModel(self.__java_File(self.__java_String(os.path.join(self.__ner_path, 'en-token.bin')))))
+        #the (thread-safe) models are loaded once per process and kept resident, the detector and tokenizer are not
+        #thread-safe so every instance gets its own
+        sentence_model_path = os.path.join(self.__ner_path, 'en-sent.bin')
+        token_model_path = os.path.join(self.__ner_path, 'en-token.bin')
+        self.__sentenceDetector = self.__java_SentenceDetectorME(jvm.resident(("opennlp-sentence-model", sentence_model_path),
+            lambda: self.__java_SentenceModel(self.__java_File(self.__java_String(sentence_model_path)))))
+        self.__tokenizer = self.__java_TokenizerME(jvm.resident(("opennlp-token-model", token_model_path),
+            lambda: self.__java_TokenizerModel(self.__java_File(self.__java_String(token_model_path)))))
 
         #TRAINING
         self.__java_PlainTextByLineStream = autoclass("opennlp.tools.util.PlainTextByLineStream")
@@ -133,11 +136,6 @@ class opennlp_NER(Pipeline):
         except:
             raise Exception("ERROR: could not format input correctly")
         #print(data)
-        with open(self.__train_file, 'w') as f:
-            f.write(data)
-        inputStreamFactory = self.__java_MarkableFileInputStreamFactory(self.__java_File(self.__java_String(self.__train_file)))
-        lineStream = self.__java_PlainTextByLineStream(inputStreamFactory, self.__java_String("utf-8"))
-        sampleStream = self.__java_NameSampleDataStream(lineStream)
         nameFinderFactory = self.__java_TokenNameFinderFactory()
 
 
@@ -159,43 +157,28 @@ class opennlp_NER(Pipeline):
 
             if not keyInParams:
                 trainParams = self.__java_TrainingParameters.defaultParams()
-        # The following call produces all of the loglikelihood output
-        self.__model = self.__java_NameFinderME.train(self.__java_String("en"), None, sampleStream, trainParams, nameFinderFactory)
+        #the training data only exists while training, in a (by default memory-backed) file OpenNLP reads it from
+        with jvm.data_file(data, '.train', config.JAVA_DATA_TMP_DIR) as train_file:
+            inputStreamFactory = self.__java_MarkableFileInputStreamFactory(self.__java_File(self.__java_String(train_file)))
+            lineStream = self.__java_PlainTextByLineStream(inputStreamFactory, self.__java_String("utf-8"))
+            sampleStream = self.__java_NameSampleDataStream(lineStream)
+            # The following call produces all of the loglikelihood output
+            self.__model = self.__java_NameFinderME.train(self.__java_String("en"), None, sampleStream, trainParams, nameFinderFactory)
+            sampleStream.close()
         self.__nameFinder = self.__java_NameFinderME(self.__model)
-        os.remove(self.__train_file)
 
     #predict(X, Xid)
-    #returns {text_id: [[offset_start, offset_end, label], ... []], ...}
+    #returns {text_id: ([[offset_start, offset_end, label], ... []], [(token_start, token_end), ...]), ...}
     def predict(self, X, Xid):
         out = {}
         #self.find_all_init()
         for doc, doc_id in zip(X, Xid):
             doc_ents = []
-            sentences = self.__sentenceDetector.sentPosDetect(self.__java_String(str(doc).encode('utf-8')))
-            for s in sentences:
-                s_start = s.getStart()
-                s_end = s.getEnd()
-                sent = self.__java_String(str(doc[s_start:s_end]).encode('utf-8'))
-                tokens = self.__tokenizer.tokenizePos(sent)
-                tok_string = []
-                doc_tokens = []
-                for t in tokens:
-
-                    t_start = t.getStart() + s_start
-                    t_end = t.getEnd() + s_start
-
-                    doc_tokens.append((t_start, t_end))
-                    tok_string.append(self.__java_String(str(doc[t_start:t_end]).encode('utf-8')))
-                ents = self.__nameFinder.find(tok_string)
-                # ents = self.find_all(tok_string)
-                for e in ents:
-                    start_token = tokens[e.getStart()]
-                    end_token = tokens[e.getEnd() - 1]
-                    doc_ents.append((start_token.getStart() + s_start, end_token.getEnd() + s_start, e.getType()))
-                # sequenceFinder = self.__model.getNameFinderSequenceModel()
-                # print(str(len(ents)) + ',' + str(len(tok_string)) + str(sequenceFinder.getOutcomes()))
-            #print(doc_id)
-            #print(doc_ents)
+            doc_tokens = []
+            for sentence in self.__tokenize_sentences(str(doc)):
+                doc_tokens.extend((t_start, t_end) for t_start, t_end, _ in sentence)
+                for e in self.__find(sentence):
+                    doc_ents.append((sentence[e.getStart()][0], sentence[e.getEnd() - 1][1], e.getType()))
             out[doc_id] = (doc_ents, doc_tokens)
             self.__nameFinder.clearAdaptiveData()
         return out
@@ -208,26 +191,38 @@ class opennlp_NER(Pipeline):
         out = {}
         for doc, doc_id in zip(X, Xid):
             doc_ents = []
-            sentences = self.__sentenceDetector.sentPosDetect(self.__java_String(str(doc).encode('utf-8')))
-            for s in sentences:
-                s_start = s.getStart()
-                s_end = s.getEnd()
-                sent = self.__java_String(str(doc[s_start:s_end]).encode('utf-8'))
-                tokens = self.__tokenizer.tokenizePos(sent)
-                tok_string = []
-                for t in tokens:
-                    t_start = t.getStart() + s_start
-                    t_end = t.getEnd() + s_start
-                    tok_string.append(self.__java_String(str(doc[t_start:t_end]).encode('utf-8')))
-                ents = self.__nameFinder.find(tok_string)
-                for e in ents:
-                    start_token = tokens[e.getStart()]
-                    end_token = tokens[e.getEnd() - 1]
-                    doc_ents.append((start_token.getStart() + s_start, end_token.getEnd() + s_start, e.getType(), e.getProb()))
+            for sentence in self.__tokenize_sentences(str(doc)):
+                for e in self.__find(sentence):
+                    doc_ents.append((sentence[e.getStart()][0], sentence[e.getEnd() - 1][1], e.getType(), e.getProb()))
             out[doc_id] = doc_ents
             self.__nameFinder.clearAdaptiveData()
         return out
 
+    #splits a document into sentences of (start offset, end offset, token) with document offsets
+    #the sentence detector and tokenizer are asked for strings, a single JNI call per document or sentence that returns
+    #a python list, instead of spans whose offsets take two calls per token; the strings are substrings of their input
+    #(that's how opennlp makes them from the spans), so their offsets are found on the python side
+    def __tokenize_sentences(self, doc):
+        sentences = []
+        s_start = 0
+        for sent in self.__sentenceDetector.sentDetect(doc):
+            s_start = doc.find(sent, s_start)
+            sentence = []
+            t_end = 0
+            for tok in self.__tokenizer.tokenize(sent):
+                t_start = sent.find(tok, t_end)
+                t_end = t_start + len(tok)
+                sentence.append((s_start + t_start, s_start + t_end, tok))
+            sentences.append(sentence)
+            s_start += len(sent)
+        return sentences
+
+    #name finder spans of a sentence from __tokenize_sentences, its tokens are passed as a single String[]
+    def __find(self, sentence):
+        if not sentence:
+            return []
+        return self.__nameFinder.find([tok for _, _, tok in sentence])
+
     # TODO: next_example(X, Xid)
     # Given model's current state evaluate the input (id, String) pairs and return a rank ordering of lowest->highest scores for instances (will need to discuss specifics of ranking)
     # Discussing rank is now a major project - see notes
@@ -302,18 +297,15 @@ class opennlp_NER(Pipeline):
             for doc, ann in zip(X, y):
                 #puts labeled entities in order within each document for next part
                 ann.sort(key=lambda tup: tup[0])
-                sentences = self.__sentenceDetector.sentPosDetect(self.__java_String(str(doc).encode('utf-8')))
+                try:
+                    sentences = self.__tokenize_sentences(str(doc))
+                except:
+                    raise Exception("Error tokenizing document string")
                 in_ann = False
                 a = 0
                 doc_done = False
-                for s in sentences:
-                    try:
-                        tokens = self.__tokenizer.tokenizePos(self.__java_String(doc[s.getStart():s.getEnd()]))
-                    except:
-                        raise Exception("Error tokenizing document string")
-                    for tok in tokens:
-                        start = s.getStart() + tok.getStart()
-                        end = s.getStart() + tok.getEnd()
+                for tokens in sentences:
+                    for start, end, _ in tokens:
                         if ann:
                             cur_ann = ann[a]
 
@@ -349,99 +341,13 @@ class opennlp_NER(Pipeline):
             logger.warning(e)
         return out
 
-    def convert_ann_collection_to_per_token(self, annotations, tokens):
-        labels_per_token = []
-        for tok in tokens:
-            labels = []
-            for ann in annotations:
-                if ann[0] <= tok[0] and ann[1] >= tok[1]:
-                    labels.append(ann[2])
-            labels_per_token.append(labels)
-        return labels_per_token
-
     def evaluate(self, X, y, Xid):
         predictions = self.predict(X, Xid)
-        stats = {'Totals': [0, 0, 0, 0]}
-
-
-        for doc_id in predictions:
-            guess = predictions[doc_id][0]
-            gold = y[Xid.index(doc_id)]
-
-            all_tokens = predictions[doc_id][1]
-
-
-            reformat_gold = [tuple(pydash.flatten(go)) for go in gold]
-            gold = reformat_gold
-
-            labels_in_gold = self.convert_ann_collection_to_per_token(gold, all_tokens)
-            labels_in_guess = self.convert_ann_collection_to_per_token(guess, all_tokens)
-
-            all_known_labels = set()
-
-            for ann in guess:
-                all_known_labels.add(ann[2])
-
-            for ann in gold:
-                all_known_labels.add(ann[2])
-
-            TP = []
-            FP = []
-            FN = []
-            TN = []
-
-            for index in range(0, len(all_tokens)):
-                for label in all_known_labels:
-                    if label in labels_in_gold[index]:
-                        if label in labels_in_guess[index]:
-                            TP.append(label)
-                        else:
-                            FN.append(label)
-                    elif label in labels_in_guess[index]:
-                        if label not in labels_in_gold[index]:
-                            FP.append(label)
-                    else:
-                        TN.append(label)
-            for label in all_known_labels:
-                if label not in stats:
-                    stats[label] = [0,0,0,0]
-            for label in TP:
-                stats[label][0] += 1
-                stats['Totals'][0] += 1
-            for label in FP:
-                stats[label][1] += 1
-                stats['Totals'][1] += 1
-            for label in FN:
-                stats[label][2] += 1
-                stats['Totals'][2] += 1
-            for label in TN:
-                stats[label][3] += 1
-                stats['Totals'][3] += 1
-
-        for key in stats:
-            TP = stats[key][0]
-            FP = stats[key][1]
-            FN = stats[key][2]
-            TN = stats[key][3]
-            if (TP + FN) != 0:
-                recall = TP / (TP + FN)
-            else:
-                recall = 1.0
-            if (TP + FP) != 0:
-                precision = TP / (TP + FP)
-            else:
-                precision = 0.0
-            if (precision + recall) != 0:
-                f1 = 2 * (precision * recall) / (precision + recall)
-            else:
-                f1 = 0
-            if (TP + FN + FP + TN) != 0:
-                acc = (TP + TN) / (TP + FN + FP + TN)
-            else:
-                acc = 0
-            stats[key] = {'precision': precision, 'recall': recall, 'f1': f1, 'TP': TP, 'FP': FP, 'FN': FN, "TN" : TN, "acc": acc}
-
-        return stats
+        evaluation = TokenEvaluation()
+        for doc_id, gold in zip(Xid, y):
+            guess, all_tokens = predictions[doc_id]
+            evaluation.add_document(all_tokens, [tuple(pydash.flatten(go)) for go in gold], guess)
+        return evaluation.stats()
 
     def evaluate_orig(self, X, y, Xid):
         try:
@@ -0,0 +1,78 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import base64
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Pre-tokenized documents in eve's "parsed" resource, shared with the backend (see backend/pine/backend/data/parsed.py):
+# one item per document (with the document's _id) with the hash of its text and, per tokenizer, the offsets of its
+# tokens as base64 of little-endian int32 [start, end, start, end, ...].  Pipelines whose tokenization doesn't depend on
+# a trained model keep theirs there too, so that training, cross-validation and predictions read the tokens of a text
+# instead of computing them again.
+
+CHUNK_SIZE = 100
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def encode_offsets(tokens):
+    return base64.b64encode(np.asarray(tokens, dtype="<i4").reshape(-1).tobytes()).decode("ascii")
+
+
+def decode_offsets(encoded):
+    offsets = np.frombuffer(base64.b64decode(encoded), dtype="<i4").reshape(-1, 2)
+    return [(int(start), int(end)) for (start, end) in offsets]
+
+
+def get_tokens(eve_client, collection_id, doc_ids, texts, tokenizer, tokenize):
+    """
+    Returns the token offsets of the documents, computing and saving the ones that aren't in eve or are stale.
+    :type eve_client: EveClient
+    :param collection_id: the collection of the documents, for the items that are added
+    :type doc_ids: list[str]
+    :param texts: the documents' texts, in the order of doc_ids
+    :type texts: list[str]
+    :param tokenizer: name of the tokenizer in the items
+    :type tokenizer: str
+    :param tokenize: called with a text, returns its (start, end) token offsets
+    :type tokenize: callable
+    :returns: document id -> list of (start, end) token offsets
+    :rtype: dict[str, list]
+    """
+    items = eve_client.get_parsed(list(doc_ids), CHUNK_SIZE)
+    tokens = dict()
+    new_items = list()
+    stale_items = list()
+    for doc_id, text in zip(doc_ids, texts):
+        item = items.get(doc_id)
+        digest = text_hash(text)
+        if item is not None and item.get("text_hash") == digest and tokenizer in item.get("tokens", {}):
+            tokens[doc_id] = decode_offsets(item["tokens"][tokenizer])
+            continue
+        tokens[doc_id] = list(tokenize(text))
+        item_tokens = dict(item.get("tokens", {})) if item is not None and item.get("text_hash") == digest else {}
+        item_tokens[tokenizer] = encode_offsets(tokens[doc_id])
+        new_item = {"collection_id": collection_id, "text_hash": digest, "tokens": item_tokens}
+        if item is None:
+            new_items.append(dict(new_item, _id=doc_id))
+        else:
+            stale_items.append((doc_id, item["_etag"], new_item))
+    # new items are added in chunks, each a single request; stale ones (whose text changed, or that don't have this
+    # tokenizer's tokens yet) are replaced one by one
+    for start in range(0, len(new_items), CHUNK_SIZE):
+        if not eve_client.add_all("parsed", new_items[start:start + CHUNK_SIZE]):
+            # another job saved some of them first; they're recomputed next time
+            logger.warning("Unable to save the %s tokens of %d documents", tokenizer,
+                           len(new_items[start:start + CHUNK_SIZE]))
+    for doc_id, etag, item in stale_items:
+        if not eve_client.replace("parsed", doc_id, etag, item):
+            logger.warning("Unable to save the %s tokens of document %s", tokenizer, doc_id)
+    computed = len(new_items) + len(stale_items)
+    logger.info("Read the %s tokens of %d documents, computed %d", tokenizer, len(tokens) - computed, computed)
+    return tokens
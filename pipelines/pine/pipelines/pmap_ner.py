@@ -72,6 +72,31 @@ class NER(Pipeline):
         #may want to program it here instead of one level down, as the ranking function might not change with the pipeline used
         return self.pipeline.next_example(X, Xid)
 
+    #supports_warm_start()
+    #returns whether fit continues training a loaded model (instead of training a new one from scratch)
+    def supports_warm_start(self):
+        return getattr(self.pipeline, 'supports_warm_start', False)
+
+    #tokenizer_name()
+    #returns the name the pipeline's tokens are kept under in eve's "parsed" resource (see parsed.py), or None if its
+    #tokenization can't be computed ahead of time (e.g. it depends on the trained model)
+    def tokenizer_name(self):
+        name = getattr(self.pipeline, 'tokenizer_name', None)
+        return name() if callable(name) else name
+
+    #tokenize(text)
+    #returns [(offset_start, offset_end), ...], the tokens the pipeline would make of the text
+    def tokenize(self, text):
+        return self.pipeline.tokenize(text)
+
+    #set_tokens(tokens)
+    #tokens = {text: [(offset_start, offset_end), ...]}, used instead of tokenizing those texts; ignored by pipelines that
+    #don't take tokens
+    def set_tokens(self, tokens):
+        set_tokens = getattr(self.pipeline, 'set_tokens', None)
+        if callable(set_tokens):
+            set_tokens(tokens)
+
     #saves model so that it can be loaded again later
     #models must be saved with extension ".ser.gz"
     # save_model(path)
@@ -67,6 +67,14 @@ class BaseConfig(object):
     SERVICE_REGISTRATION_FREQUENCY = 60  # unit: seconds
     SERVICE_LISTENING_FREQUENCY = 1  # unit: seconds
     SERVICE_HANDLER_TIMEOUT = 60  # unit: seconds
+    SERVICE_EVENT_DRIVEN = True  # block on redis (BRPOPLPUSH / pubsub) instead of polling every SERVICE_LISTENING_FREQUENCY
+    SERVICE_CONSUMER_NAME = None  # names this worker's in-progress job list; defaults to the host name (lists left without a heartbeat are recovered by other workers)
+    SERVICE_MAX_WORKERS = 4  # max running jobs; each framework's pool has min(this, its SERVICE_FRAMEWORK_CONCURRENCY) processes, kept while idle
+    SERVICE_MAX_PROCESSES = 8  # max pool processes across frameworks, idle pools are closed to stay under it; None: sum of the frameworks' pools (4 + 4 + 1 for spacy, opennlp and corenlp), plus replaced pools finishing their jobs
+    SERVICE_JOB_TYPE_CONCURRENCY = dict(fit=1, predict=4)  # max running jobs per job type; others only limited by SERVICE_MAX_WORKERS
+    SERVICE_MAX_PENDING_JOBS = None  # jobs taken on that wait for their type/framework limit; None: SERVICE_MAX_WORKERS
+    SERVICE_FRAMEWORK_CONCURRENCY = dict(corenlp=1)  # max running jobs per framework; each CoreNLP JVM may use CORENLP_JVM_MAX_HEAP
+    SERVICE_FRAMEWORK_RESTART_AFTER_FITS = dict(corenlp=10)  # replace a framework's worker processes after this many fits
     SERVICE_LIST = [
         dict(
             name="corenlp",
@@ -98,8 +106,33 @@ class BaseConfig(object):
     ]
 
 
+    # Java pipelines (one JVM per worker process)
+    CORENLP_JVM_MAX_HEAP = "32g"
+    OPENNLP_JVM_MAX_HEAP = "8g"
+    JAVA_DATA_TMP_DIR = None  # training data files when they can't be kept in memory (no memfd support); None: system temp dir
+    CORENLP_TOKENIZATION_CACHE_MAX_ENTRIES = 200000  # tokenized texts kept in memory per worker process (0: none)
+    CORENLP_TOKENIZATION_CACHE_STORE = None  # sqlite file shared by the worker processes, e.g. ROOT_DIR + "/tmp/tokens.db"
+
+    # spaCy inference (nlp.pipe)
+    SPACY_PIPE_BATCH_SIZE = 64
+    SPACY_PIPE_N_PROCESS = 1
+
+    # Cross-validation of new models
+    CV_WORKERS = 5  # folds trained at the same time
+    CV_MODE = "sync"  # "sync": alongside the final fit, "async": after the new model is published, "skip": no CV
+
+    # Retraining (frameworks that support it continue training the previous model on new annotations)
+    WARM_START_ENABLED = True
+    WARM_START_FULL_RETRAIN_EVERY = 5  # every n-th training trains from scratch (and is cross-validated)
+    WARM_START_REPLAY_RATIO = 1.0  # previously trained annotations replayed per new one
+
+    # Document ranking after a train
+    RANKING_HEAD_SIZE = 100  # top ranked documents published first; the rest of the ranking follows
+
     # Models
     MODELS_DIR = ROOT_DIR + r"/models"
+    MODEL_CACHE_MAX_MB = 2048  # memory for loaded models kept between predict jobs, per worker process
+    MODEL_CACHE_MAX_MODELS = 8  # max loaded models kept per worker process (0 disables the cache)
 
     def __init__(self, root_dir=None):
 
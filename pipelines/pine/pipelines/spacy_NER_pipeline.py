@@ -9,19 +9,44 @@ For more details, see the documentation:
 Compatible with: spaCy v2.0.0+
 """
 
+import logging
 import random
+import time
 import spacy
 from spacy.scorer import Scorer
 from spacy.gold import GoldParse
+from spacy.tokens import Doc
+from spacy.util import minibatch, compounding
 from collections import defaultdict
 
+from .evaluation import TokenEvaluation
 from .pipeline import Pipeline
+from .shared.config import ConfigBuilder
+
+config = ConfigBuilder.get_config()
+logger = logging.getLogger(__name__)
+
+
+# Passed as the optimizer to nlp.update to get the loss on held-out data without training on it: the gradients are
+# thrown away (and zeroed, like the real optimizer does, so they don't leak into the next update)
+class _DiscardGradients(object):
+	def __init__(self, optimizer):
+		# nlp.update reads these from the optimizer
+		self.alpha = optimizer.alpha
+		self.b1 = optimizer.b1
+		self.b2 = optimizer.b2
+
+	def __call__(self, weights, gradient, lr_scale=1.0, key=None):
+		gradient.fill(0)
 
 
 class spacy_NER(Pipeline):
+	# fit continues training a loaded model
+	supports_warm_start = True
 	__nlp = []
 	__ner = []
 	__optimizer = []
+	__tokens = {}
 
 	# init()
 	# set tunable parameters
@@ -51,11 +76,26 @@ class spacy_NER(Pipeline):
 
 	# fit(X, y)
 	# internal state is changed
+	# params:
+	#   n_iter: max number of epochs
+	#   dropout: dropout rate
+	#   batch_size_start, batch_size_stop, batch_size_compound: batch sizes start at batch_size_start and are
+	#     multiplied by batch_size_compound after every batch, up to batch_size_stop (spacy.util.compounding)
+	#   validation_split: fraction of the documents held out to decide how many epochs to train for (0 disables early
+	#     stopping); the model is then trained again from where it started, on all the documents, for that many epochs
+	#   early_stopping_patience: stop after this many epochs without the held-out loss improving by min_delta
+	#   min_delta: smallest decrease of the held-out loss that counts as an improvement
 	def fit(self, X, y, params=None):
 		#setting up params
 		default_params = {
 			"n_iter":100,
-			"dropout":0.5
+			"dropout":0.5,
+			"batch_size_start":4.0,
+			"batch_size_stop":32.0,
+			"batch_size_compound":1.001,
+			"validation_split":0.1,
+			"early_stopping_patience":5,
+			"min_delta":0.0
 		}
 		if params is not None:
 			for key in default_params.keys():
@@ -69,118 +109,81 @@ class spacy_NER(Pipeline):
 			for ent in annotations.get('entities'):
 				self.__ner.add_label(ent[2])
 
+		# hold out documents to find the epoch after which the loss on them stops improving
+		random.shuffle(train_data)
+		num_held_out = int(len(train_data) * default_params["validation_split"])
+		held_out_data = train_data[:num_held_out] if 0 < num_held_out < len(train_data) else []
+		if not held_out_data:
+			self.__train(train_data, [], default_params)
+			return
+
+		initial_state = self.__nlp.to_bytes()
+		num_epochs = self.__train(train_data[len(held_out_data):], held_out_data, default_params)
+		# no document is left out of the final model: start over and train on all of them for the best number of epochs
+		logger.info("Training again on all {} documents for {} epochs".format(len(train_data), num_epochs))
+		self.__nlp.from_bytes(initial_state)
+		self.__train(train_data, [], dict(default_params, n_iter=num_epochs))
+
+	# trains for up to n_iter epochs, stopping once the loss on held_out_data (if any) stops improving
+	# returns the number of epochs up to the one with the lowest held-out loss
+	def __train(self, train_data, held_out_data, params):
+		patience = params["early_stopping_patience"] if held_out_data else 0
+		num_epochs = params["n_iter"]
 		# get names of other pipes to disable them during training (only needed if user loads own model as we aren't sure what's in it)
 		other_pipes = [pipe for pipe in self.__nlp.pipe_names if pipe != 'ner']
 		with self.__nlp.disable_pipes(*other_pipes):  # only train NER
 			self.__optimizer = self.__nlp.entity.create_optimizer()
 			# begin_training() zeros out existing entity types so we just create another optimizer instead to account for training new entity types
 			# NOTE: be sure to include examples of both existing and new entity types when fitting otherwise spacy will overfit to the new data
-			for itn in range(default_params["n_iter"]):
+			best_held_out_loss = None
+			epochs_without_improvement = 0
+			for itn in range(params["n_iter"]):
+				epoch_start = time.time()
 				random.shuffle(train_data)
 				losses = {}
-				for text, annotations in train_data:
+				batches = minibatch(train_data, size=compounding(params["batch_size_start"],
+																 params["batch_size_stop"],
+																 params["batch_size_compound"]))
+				for batch in batches:
+					texts, annotations = zip(*batch)
 					self.__nlp.update(
-						[text],  # batch of texts
-						[annotations],  # batch of annotations
-						drop=default_params["dropout"],  # dropout - make it harder to memorise data
+						[self.__make_doc(text) for text in texts],  # batch of texts
+						annotations,  # batch of annotations
+						drop=params["dropout"],  # dropout - make it harder to memorise data
 						sgd=self.__optimizer,  # callable to update weights
 						losses=losses)
-				print(losses)
-
-	def evaluate(self, X, y, Xid):
-		train_data = self.format_data(X, y)
-		all_labels = set()
-		metrics = dict()
-		# get all labels
-		for text, annot in train_data:
-			for ent in annot['entities']:
-				all_labels.add(ent[2])
-		all_labels = list(all_labels)
-		stats = {}
-
-		for text, annots in train_data:
-			pred_doc = self.__nlp(text)
-			gold_doc = self.__nlp.make_doc(text)
-			gold_labels = []
-
-			stats['Totals'] = [0,0,0,0]
-			for label in all_labels:
-				stats[label] = [0,0,0,0]
-
-			for token in pred_doc:
-				gold_labels.append(set())
-
-			for label in all_labels:
-				annotations_for_label = []
-				for annot in annots['entities']:
-					if label in annot:
-						annotations_for_label.append(annot)
-
-				goldParse = GoldParse(gold_doc, entities=annotations_for_label)
-				for index, annotation in enumerate(goldParse.ner):
-
-					if annotation != 'O':
-						gold_labels[index].add(annotation[2:])
-
-
-			for index, pred_token in enumerate(pred_doc):
-				pred_label = pred_token.ent_type_
-				if pred_label != '':
-					for label in all_labels:
-						if label == pred_label:
-							if label in gold_labels[index]:
-								#TP
-								stats[label][0] += 1
-								stats['Totals'][0] += 1
-							else:
-								#FP
-								stats[label][1] += 1
-								stats['Totals'][1] += 1
-
-						else:
-							#All other labels are true negative because the model can only predict one label per token
-							#TN
-
-							stats[label][3] += 1
-							stats['Totals'][3] += 1
-
-
+				if not held_out_data:
+					logger.info("Epoch {}: loss {}, {:.2f}s".format(itn, losses.get('ner'), time.time() - epoch_start))
+					continue
+
+				held_out_losses = {}
+				for batch in minibatch(held_out_data, size=int(params["batch_size_stop"])):
+					texts, annotations = zip(*batch)
+					self.__nlp.update([self.__make_doc(text) for text in texts], annotations, drop=0.0, sgd=_DiscardGradients(self.__optimizer), losses=held_out_losses)
+				held_out_loss = held_out_losses.get('ner', 0.0)
+				logger.info("Epoch {}: loss {}, held-out loss {}, {:.2f}s".format(itn, losses.get('ner'), held_out_loss, time.time() - epoch_start))
+				if best_held_out_loss is None or held_out_loss < best_held_out_loss - params["min_delta"]:
+					best_held_out_loss = held_out_loss
+					num_epochs = itn + 1
+					epochs_without_improvement = 0
 				else:
-					for label in all_labels:
-						if label in gold_labels[index]:
-							#FN
-							stats[label][2] += 1
-							stats['Totals'][2] += 1
-
-						else:
-							#TN
-							stats[label][3] += 1
-							stats['Totals'][3] += 1
-
-		for key in stats:
-			TP = stats[key][0]
-			FP = stats[key][1]
-			FN = stats[key][2]
-			TN = stats[key][3]
-			if (TP + FN) != 0:
-				recall = TP / (TP + FN)
-			else:
-				recall = 1.0
-			if (TP + FP) != 0:
-				precision = TP / (TP + FP)
-			else:
-				precision = 0.0
-			if (precision + recall) != 0:
-				f1 = 2 * (precision * recall) / (precision + recall)
-			else:
-				f1 = 0
-			if (TP + FN + FP + TN) != 0:
-				acc = (TP + TN) / (TP + FN + FP + TN)
-			else:
-				acc = 0
-			metrics[key] = {'precision': precision, 'recall': recall, 'f1': f1, 'TP': TP, 'FP': FP, 'FN': FN, "TN": TN,
-						  "acc": acc}
-		return metrics
+					epochs_without_improvement += 1
+					if patience and epochs_without_improvement >= patience:
+						logger.info("Stopping early after epoch {}, held-out loss did not improve for {} epochs".format(itn, patience))
+						break
+		return num_epochs
+
+	def evaluate(self, X, y, Xid, batch_size=None):
+		# per token (see evaluation.py), with the predicted docs' tokens
+		batch_size = batch_size or config.SPACY_PIPE_BATCH_SIZE
+		train_data = self.format_data(X, y)
+		evaluation = TokenEvaluation()
+		pred_docs = self.__pipe([text for text, _ in train_data], batch_size)
+		for (text, annots), pred_doc in zip(train_data, pred_docs):
+			tokens = [(token.idx, token.idx + len(token)) for token in pred_doc]
+			guess = [(ent.start_char, ent.end_char, ent.label_) for ent in pred_doc.ents]
+			evaluation.add_document(tokens, annots['entities'], guess)
+		return evaluation.stats()
 
 
 		# for each label get the score
@@ -238,17 +241,23 @@ class spacy_NER(Pipeline):
 		#
 		# return metrics
 
-	def predict(self, X, Xid):
+	# predict(X, Xid)
+	# texts are processed in batches of batch_size, by n_process processes (n_process > 1 doesn't work in the daemonic
+	# processes the pipeline service runs jobs in, and tokenizes the texts in those processes instead of using the
+	# tokens given to set_tokens)
+	def predict(self, X, Xid, batch_size=None, n_process=None):
+		batch_size = batch_size or config.SPACY_PIPE_BATCH_SIZE
+		n_process = n_process or config.SPACY_PIPE_N_PROCESS
 		out = {}
-		for text, text_id in zip(X, Xid):
-			pred = self.__nlp(text)
-			print('Entities', [(ent.start_char, ent.end_char, ent.label_, ent.text) for ent in pred.ents])
+		preds = self.__nlp.pipe(X, batch_size=batch_size, n_process=n_process) if n_process > 1 else self.__pipe(X, batch_size)
+		for pred, text_id in zip(preds, Xid):
 			out[text_id] = [(ent.start_char, ent.end_char, ent.label_) for ent in pred.ents]
 		return out
 
 	# predict_proba(X, Xid)
 	# returns {text_id: [[offset_start, offset_end, label, score], ... []], ...}
-	def predict_proba(self, X, Xid):
+	def predict_proba(self, X, Xid, batch_size=None):
+		batch_size = batch_size or config.SPACY_PIPE_BATCH_SIZE
 		out = {}
 		# Score is confidence of classifier for this prediction, though this implementation is weird/potentially unreliable
 		# since spacy does not directly supply the NER confidence data
@@ -259,67 +268,35 @@ class spacy_NER(Pipeline):
 		# This clips solutions at each step. We multiply the score of the top-ranked action by this value, and use the result as a threshold. This prevents the parser from exploring options that look very unlikely, saving a bit of efficiency. Accuracy may also improve, because we've trained on greedy objective.
 		beam_density = 0.0001
 
-		for text, text_id in zip(X, Xid):
-			doc = self.__nlp(text)
-			# print('TEXT: ' + text)
-			"""
-			print ('--- Tokens ---')
-			#DEBUGGING: Print all tokens present in text
-			for tok in doc:
-				print (tok.i, tok)
-			print ('')
-			"""
-			# DEBUGGING: Print entities detected with NER (denoted by start/end char)
-			print('--- Entities (detected with standard NER) ---')
-			# Store detected entities in dict
-			ner_selected_entity_scores = defaultdict(float)
-
-			for ent in doc.ents:
-				print('%d to %d: %s (%s)' % (ent.start_char, ent.end_char, ent.label_, ent.text))
-				ner_selected_entity_scores[(ent.start_char, ent.end_char, ent.label_)] = 0.0
-			print('')
-			# Begin beam search for confidences
-			# notice these 2 lines - if they're not here, standard NER
-			# will be used and all scores will be 1.0
+		for batch in minibatch(zip(X, Xid), size=batch_size):
+			texts, text_ids = zip(*batch)
+			# Each text is tokenized (and run through the other pipes) once.  The beam search has to run on docs
+			# without entities - if they're already set, standard NER will be used and all scores will be 1.0 - so
+			# it runs first, then the ner pipe sets the entities on the same docs.
 			with self.__nlp.disable_pipes('ner'):
-				doc_b = self.__nlp(text)
-				
-			beams = self.__nlp.entity.beam_parse([doc_b], beam_width=16, beam_density=0.0001)
+				docs = list(self.__pipe(texts, batch_size))
+			beams = self.__ner.beam_parse(docs, beam_width=beam_width, beam_density=beam_density)
+			docs = list(self.__ner.pipe(docs, batch_size=batch_size))
 
-			all_entity_scores = defaultdict(float)
+			for doc, beam, text_id in zip(docs, beams, text_ids):
+				# Store entities detected with NER (denoted by start/end char)
+				ner_selected_entity_scores = defaultdict(float)
+				for ent in doc.ents:
+					ner_selected_entity_scores[(ent.start_char, ent.end_char, ent.label_)] = 0.0
 
-			for beam in beams:
-				for score, ents in self.__nlp.entity.moves.get_beam_parses(beam):
+				for score, ents in self.__ner.moves.get_beam_parses(beam):
 					for start, end, label in ents:
 						# calculate start and end char of entity
 						start_char = doc[start].idx
 						end_char = doc[end - 1].idx + len(doc[end - 1])
-						# store score in dictionary
-						all_entity_scores[(start_char, end_char, label)] += score
 						# update ner dictionary with score if matching
+						# WARNING: this is due to the scores requiring beam search, if beam search doesn't find the same ones some scores could be 0
 						if (start_char, end_char, label) in ner_selected_entity_scores:
 							ner_selected_entity_scores[(start_char, end_char, label)] += score
-			# DEBUGGING: print scores for entities whose keys match those found from the original NER
-			# WARNING: this is due to the scores requiring beam search, if beam search doesn't find the same ones some scores could be 0
-			print('--- Relevant Entities and scores (detected with beam search) ---')
-			for key in ner_selected_entity_scores:
-				start, end, label = key
-				print('%d to %d: %s (%f)' % (start, end, label, ner_selected_entity_scores[key]))
-
-			print('')
-			"""
-			#DEBUGGING: print all scores for all possible entities found by beam search
-			print ('--- All Entities and scores ---')
-			for key in all_entity_scores:
-				start, end, label = key
-				print ('%d to %d: %s (%f)' % (start, end, label, all_entity_scores[key]))
-			print('')
-			"""
-			# output directly from NER pipe
-			# out[(text_id, text)] =  [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents]
-			# output from NER score dictionary
-			out[text_id] = [(key[0], key[1], key[2], ner_selected_entity_scores[key]) for key in
-							ner_selected_entity_scores]
+
+				# output from NER score dictionary
+				out[text_id] = [(key[0], key[1], key[2], ner_selected_entity_scores[key]) for key in
+								ner_selected_entity_scores]
 		return out
 
 	# TODO: next_example(X, Xid)
@@ -338,6 +315,38 @@ class spacy_NER(Pipeline):
 			out.append((text, {'entities': [(labels) for labels in y[i]]}))
 		return out
 
+	# the name of the tokens of make_doc in eve's "parsed" resource (see parsed.py): they only depend on the language
+	# (and spaCy's version), not on the trained model
+	def tokenizer_name(self):
+		return 'spacy-{}-{}'.format(self.__nlp.lang, spacy.__version__)
+
+	# returns the (start offset, stop offset) of the tokens make_doc makes of the text
+	def tokenize(self, text):
+		return [(token.idx, token.idx + len(token)) for token in self.__nlp.make_doc(text)]
+
+	# tokens = {text: [(start offset, stop offset), ...]}, made by tokenize; docs of these texts are made from them
+	# instead of tokenizing the texts again
+	def set_tokens(self, tokens):
+		self.__tokens = tokens
+
+	def __make_doc(self, text):
+		offsets = self.__tokens.get(text)
+		if not offsets:
+			return self.__nlp.make_doc(text)
+		# a token is followed by at most one space, other whitespace is in tokens of its own
+		next_starts = [start for start, _ in offsets[1:]] + [len(text)]
+		words = [text[start:end] for start, end in offsets]
+		spaces = [next_start > end for (_, end), next_start in zip(offsets, next_starts)]
+		doc = Doc(self.__nlp.vocab, words=words, spaces=spaces)
+		return doc if doc.text == text else self.__nlp.make_doc(text)
+
+	# like nlp.pipe (which only takes texts), with the docs made by __make_doc
+	def __pipe(self, texts, batch_size):
+		docs = (self.__make_doc(text) for text in texts)
+		for _, proc in self.__nlp.pipeline:
+			docs = proc.pipe(docs, batch_size=batch_size) if hasattr(proc, 'pipe') else map(proc, docs)
+		return docs
+
 	# Adds a label to the ner pipe
 	def add_label(self, entity):
 		self.__ner.add_label(entity)
@@ -0,0 +1,132 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from .shared.config import ConfigBuilder
+
+logger = logging.getLogger(__name__)
+config = ConfigBuilder.get_config()
+
+
+class TokenizationCache(object):
+    """
+    LRU cache of tokenized texts, keyed by a hash of the text, with an optional sqlite store behind it.  The same texts
+    are tokenized by every cross-validation fold and every retrain of a collection; the in-memory part is shared by the
+    jobs of a worker process, and the store by all worker processes and their restarts.
+    """
+
+    def __init__(self, name, max_entries, store_path=None):
+        """
+        :param name: identifies the tokenizer, so that several can share a store
+        :type name: str
+        :type max_entries: int
+        :param store_path: sqlite file of the store, or None for memory only
+        :type store_path: str | None
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.store_path = store_path
+        self.tokens = collections.OrderedDict()  # text hash -> tuple of tokens
+        self.stats = dict(hits=0, store_hits=0, misses=0)
+        self.lock = threading.RLock()
+        self._store = None
+        self._store_pid = None
+
+    def _key(self, text):
+        return hashlib.sha1((self.name + "\0" + text).encode("utf-8")).hexdigest()
+
+    def _get_store(self):
+        # connections can't be shared with forked processes
+        if self.store_path is None:
+            return None
+        if self._store is None or self._store_pid != os.getpid():
+            self._store = sqlite3.connect(self.store_path, timeout=30, check_same_thread=False)
+            self._store.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT NOT NULL)")
+            self._store_pid = os.getpid()
+        return self._store
+
+    def get_or_tokenize(self, text, tokenize):
+        """
+        :type text: str
+        :param tokenize: called with the text on a miss, returns its tokens
+        :type tokenize: callable
+        :rtype: list
+        """
+        key = self._key(text)
+        with self.lock:
+            if key in self.tokens:
+                self.tokens.move_to_end(key)
+                self.stats["hits"] += 1
+                return list(self.tokens[key])
+            tokens = self._load(key)
+            if tokens is not None:
+                self.stats["store_hits"] += 1
+                self._put(key, tokens)
+                return list(tokens)
+            self.stats["misses"] += 1
+        # tokenized without the lock, so that other threads (e.g. CV folds) aren't held up; if two threads miss the same
+        # text at once, both tokenize it and the second result replaces the (equal) first one
+        tokens = tokenize(text)
+        with self.lock:
+            self._save(key, tokens)
+            self._put(key, tokens)
+        return list(tokens)
+
+    def _put(self, key, tokens):
+        if self.max_entries <= 0:
+            return
+        self.tokens[key] = tuple(tokens)
+        self.tokens.move_to_end(key)
+        while len(self.tokens) > self.max_entries:
+            self.tokens.popitem(last=False)
+
+    def _load(self, key):
+        try:
+            store = self._get_store()
+            if store is None:
+                return None
+            row = store.execute("SELECT tokens FROM tokens WHERE key = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row is not None else None
+        except sqlite3.Error as e:
+            logger.warning("Unable to read tokenization cache %s: %s", self.store_path, e)
+            return None
+
+    def _save(self, key, tokens):
+        try:
+            store = self._get_store()
+            if store is not None:
+                with store:
+                    store.execute("INSERT OR IGNORE INTO tokens (key, tokens) VALUES (?, ?)", (key, json.dumps(tokens)))
+        except sqlite3.Error as e:
+            logger.warning("Unable to write tokenization cache %s: %s", self.store_path, e)
+
+    def hit_rate(self):
+        """
+        Fraction of the lookups so far that didn't need the tokenizer, or None before the first one.
+        :rtype: float | None
+        """
+        with self.lock:
+            total = self.stats["hits"] + self.stats["store_hits"] + self.stats["misses"]
+            return (self.stats["hits"] + self.stats["store_hits"]) / total if total else None
+
+    def log_stats(self):
+        with self.lock:
+            hit_rate = self.hit_rate()
+            logger.info("Tokenization cache %s: %d hits, %d store hits, %d misses (hit rate %s), %d texts in memory",
+                        self.name, self.stats["hits"], self.stats["store_hits"], self.stats["misses"],
+                        "n/a" if hit_rate is None else "{:.1%}".format(hit_rate), len(self.tokens))
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+
+
+# one per process, like the model cache; pipeline jobs run in long-lived pool processes (one pool per framework)
+CORENLP_TOKENIZATION_CACHE = TokenizationCache("corenlp-ptb", config.CORENLP_TOKENIZATION_CACHE_MAX_ENTRIES,
+                                               config.CORENLP_TOKENIZATION_CACHE_STORE)
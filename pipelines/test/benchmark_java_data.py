@@ -0,0 +1,51 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Times handing a CV fold's training data to the Java pipelines through jvm.data_file: kept in memory (memfd) against
+# written to a file on disk, each read back once as OpenNLP and CoreNLP do.  Run from the pipelines directory with
+#   pipenv run python test/benchmark_java_data.py [--docs N] [--folds N] [--dir DIR]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORDS = ["the", "patient", "was", "given", "aspirin", "in", "Baltimore", "on", "Monday", "."]
+
+def make_fold(num_docs):
+    # CoreNLP-style token<TAB>label lines
+    lines = []
+    for _ in range(num_docs):
+        for _ in range(random.randint(50, 500)):
+            lines.append("{}\t{}".format(random.choice(WORDS), random.choice(["O", "O", "O", "DRUG", "LOC"])))
+        lines.append("")
+    return "\n".join(lines)
+
+def hand_over(jvm, data, directory):
+    start = time.time()
+    with jvm.data_file(data, ".tsv", directory) as path:
+        with open(path, "rb") as f:
+            while f.read(1 << 20):
+                pass
+    return time.time() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Java training data benchmark")
+    parser.add_argument("--docs", type=int, default=2000, help="Number of documents per fold")
+    parser.add_argument("--folds", type=int, default=5, help="Number of folds")
+    parser.add_argument("--dir", default=tempfile.gettempdir(), help="Directory of the on-disk files")
+    args = parser.parse_args()
+
+    from pine.pipelines import jvm
+
+    for fold in range(args.folds):
+        data = make_fold(args.docs)
+        memory = hand_over(jvm, data, args.dir)
+        with mock.patch.object(jvm, "_memfd_create", return_value=None):
+            disk = hand_over(jvm, data, args.dir)
+        print("fold {}: {} bytes, memory {:.3f}s, disk {:.3f}s, saved {:.3f}s".format(
+            fold, len(data.encode("utf-8")), memory, disk, disk - memory))
@@ -0,0 +1,70 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Measures enqueue-to-start latency of the pipeline ServiceListener work queue, in polling mode (LPOP + sleep) and in
+# event-driven mode (BRPOPLPUSH).  Needs a running redis; run from the pipelines directory with
+#   pipenv run python test/benchmark_queue_latency.py [--jobs N] [--redis-host HOST] [--redis-port PORT]
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def run(event_driven, num_jobs, max_gap):
+    from pine.pipelines.app.listener.service_listener import ServiceListener
+
+    listener = ServiceListener(event_driven=event_driven)
+    listener.processing_queue_key = "AL:benchmark:work-queue"
+    listener.processing_list_key = listener.processing_queue_key + ":processing:benchmark"
+    listener.r_conn.delete(listener.processing_queue_key, listener.processing_list_key)
+
+    latencies = []
+    all_started = threading.Event()
+
+    def fake_process_message(job_details):
+        latencies.append(time.time() - job_details["enqueued_at"])
+        if len(latencies) >= num_jobs:
+            all_started.set()
+        future = Future()
+        future.set_result(None)
+        return future
+
+    listener.process_message = fake_process_message
+    listener.queue_processor_exit_event.clear()
+    worker = threading.Thread(target=listener._start_queue_processor_task, daemon=True)
+    worker.start()
+
+    for i in range(num_jobs):
+        # jobs arrive one at a time, as they do from annotators
+        time.sleep(random.uniform(0, max_gap))
+        listener.enqueue_job({"job_id": str(i), "enqueued_at": time.time()})
+
+    all_started.wait()
+    listener.queue_processor_exit_event.set()
+    worker.join()
+    listener.r_conn.delete(listener.processing_queue_key, listener.processing_list_key)
+    return latencies
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    print("{:>14}: n={} mean={:.4f}s median={:.4f}s p95={:.4f}s max={:.4f}s".format(
+        name, len(latencies), statistics.mean(latencies), statistics.median(latencies),
+        latencies[int(0.95 * (len(latencies) - 1))], latencies[-1]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ServiceListener enqueue-to-start latency benchmark")
+    parser.add_argument("--jobs", type=int, default=50, help="Number of jobs to enqueue per mode")
+    parser.add_argument("--max-gap", type=float, default=0.5, help="Maximum seconds between two enqueued jobs")
+    parser.add_argument("--redis-host", type=str, default=None, help="Redis host (defaults to AL_REDIS_HOST)")
+    parser.add_argument("--redis-port", type=int, default=None, help="Redis port (defaults to AL_REDIS_PORT)")
+    args = parser.parse_args()
+    if args.redis_host: os.environ["AL_REDIS_HOST"] = args.redis_host
+    if args.redis_port: os.environ["AL_REDIS_PORT"] = str(args.redis_port)
+
+    report("polling", run(False, args.jobs, args.max_gap))
+    report("event-driven", run(True, args.jobs, args.max_gap))
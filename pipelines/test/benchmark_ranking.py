@@ -0,0 +1,71 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Times the document ranking functions on synthetic predict_proba output.  Run from the pipelines directory with
+#   pipenv run python test/benchmark_ranking.py [--docs N] [--entities N] [--labels N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def make_results(num_docs, max_entities, num_labels, all_labels):
+    labels = ["LABEL{}".format(i) for i in range(num_labels)] + ["O"]
+    results = {}
+    for doc in range(num_docs):
+        ents = []
+        for i in range(random.randint(0, max_entities)):
+            if all_labels:
+                probs = [random.random() for _ in labels]
+                total = sum(probs)
+                ents.append((i * 10, i * 10 + 5, [(label, prob / total) for label, prob in zip(labels, probs)]))
+            else:
+                ents.append((i * 10, i * 10 + 5, random.choice(labels), random.random()))
+        results["doc{}".format(doc)] = ents
+    return results
+
+def python_least_confidence_squared(results):
+    # the per-entity loop the ranking used to run, for comparison
+    ranking = []
+    for key in results:
+        confidence = 0
+        numel = 0
+        for ent in results[key]:
+            confidence += ent[3] ** 2
+            numel += 1
+        if numel > 0:
+            confidence /= numel
+        ranking.append((key, confidence))
+    ranking.sort(key=lambda tup: tup[1])
+    return [ranks[0] for ranks in ranking]
+
+def timed(name, function, *args):
+    start = time.time()
+    function(*args)
+    print("{:>36}: {:.3f}s".format(name, time.time() - start))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Document ranking benchmark")
+    parser.add_argument("--docs", type=int, default=100000, help="Number of documents")
+    parser.add_argument("--entities", type=int, default=20, help="Maximum number of entities per document")
+    parser.add_argument("--labels", type=int, default=8, help="Number of labels")
+    args = parser.parse_args()
+
+    from pine.pipelines import RankingFunctions as rank
+
+    results = make_results(args.docs, args.entities, args.labels, False)
+    timed("python lcs", python_least_confidence_squared, results)
+    timed("pack", rank.PackedResults, results)
+    for metric in ("lc", "lcs", "lce", "mlp", "ra"):
+        timed(metric, rank.rank, results, metric)
+    packed = rank.PackedResults(results)
+    for metric in ("lc", "lcs", "lce", "mlp"):
+        timed(metric + " (packed)", rank.rank, packed, metric)
+    timed("lcs top 100 (packed)", rank.rank_top_k, packed, "lcs", 100)
+
+    results = make_results(args.docs, args.entities, args.labels, True)
+    packed = rank.PackedResults(results)
+    for metric in ("ma", "en"):
+        timed(metric + " (all labels, packed)", rank.rank, packed, metric)
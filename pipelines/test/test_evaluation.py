@@ -0,0 +1,103 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import evaluation
+
+LABELS = ["PER", "ORG", "LOC"]
+
+
+def old_evaluate(documents):
+    # the per-token loops the pipelines' evaluate methods had, with the counts of every label kept across documents
+    stats = {'Totals': [0, 0, 0, 0]}
+    for tokens, gold, guess in documents:
+        labels_in_gold = [[ann[2] for ann in gold if ann[0] <= tok[0] and ann[1] >= tok[1]] for tok in tokens]
+        labels_in_guess = [[ann[2] for ann in guess if ann[0] <= tok[0] and ann[1] >= tok[1]] for tok in tokens]
+        all_known_labels = set(ann[2] for ann in list(gold) + list(guess))
+        for label in all_known_labels:
+            stats.setdefault(label, [0, 0, 0, 0])
+        for index in range(len(tokens)):
+            for label in all_known_labels:
+                if label in labels_in_gold[index]:
+                    column = 0 if label in labels_in_guess[index] else 2
+                elif label in labels_in_guess[index]:
+                    column = 1
+                else:
+                    column = 3
+                stats[label][column] += 1
+                stats['Totals'][column] += 1
+    return {label: evaluation.metrics(*counts) for label, counts in stats.items()}
+
+
+def random_document(rng, all_labels):
+    tokens, start = [], 0
+    for _ in range(rng.randint(0, 30)):
+        start += rng.randint(0, 2)
+        end = start + rng.randint(1, 6)
+        tokens.append((start, end))
+        start = end
+    def spans():
+        spans = []
+        for _ in range(rng.randint(0, 6)):
+            if not tokens:
+                break
+            first = rng.randrange(len(tokens))
+            last = rng.randrange(first, min(first + 4, len(tokens)))
+            # spans don't always start or end on token boundaries
+            spans.append((tokens[first][0] + rng.randint(0, 1), tokens[last][1] - rng.randint(0, 1), rng.choice(LABELS)))
+        return spans
+    gold, guess = spans(), spans()
+    if all_labels:
+        gold += [(0, 0, label) for label in LABELS]
+    return tokens, gold, guess
+
+
+class TokenEvaluationTest(unittest.TestCase):
+
+    def evaluate(self, documents):
+        token_evaluation = evaluation.TokenEvaluation()
+        for tokens, gold, guess in documents:
+            token_evaluation.add_document(tokens, gold, guess)
+        return token_evaluation.stats()
+
+    def test_masks(self):
+        tokens = [(0, 3), (4, 9), (10, 12), (13, 20)]
+        masks = evaluation.token_label_masks(tokens, [(4, 12, "PER"), (0, 2, "ORG"), (10, 20, "ORG"), (0, 3, "X")],
+                                             {"PER": 0, "ORG": 1})
+        self.assertEqual(masks.tolist(), [[False, False], [True, False], [True, True], [False, True]])
+
+    def test_counts_match_per_token_loop(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            documents = [random_document(rng, False) for _ in range(rng.randint(1, 5))]
+            expected, stats = old_evaluate(documents), self.evaluate(documents)
+            self.assertEqual(sorted(stats), sorted(expected))
+            for label in expected:
+                for key in ('TP', 'FP', 'FN', 'precision', 'recall', 'f1'):
+                    self.assertEqual(stats[label][key], expected[label][key], (label, key))
+
+    def test_same_as_per_token_loop_when_every_document_has_every_label(self):
+        # true negatives are counted for every label seen in the data, where the loop only counted the document's
+        rng = random.Random(1)
+        for _ in range(50):
+            documents = [random_document(rng, True) for _ in range(rng.randint(1, 5))]
+            self.assertEqual(self.evaluate(documents), old_evaluate(documents))
+
+    def test_true_negatives_of_labels_seen_later(self):
+        documents = [([(0, 1), (2, 3)], [(0, 1, "PER")], []), ([(0, 1)], [], [(0, 1, "ORG")])]
+        stats = self.evaluate(documents)
+        self.assertEqual((stats["PER"]["FN"], stats["PER"]["TN"]), (1, 2))
+        self.assertEqual((stats["ORG"]["FP"], stats["ORG"]["TN"]), (1, 2))
+        self.assertEqual(stats["Totals"]["TN"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
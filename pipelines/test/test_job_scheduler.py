@@ -0,0 +1,218 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent import futures
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines.app.listener import job_scheduler
+
+
+class FakePool(object):
+    """
+    Stands in for pebble.ProcessPool: scheduled jobs run when the test finishes them, and like pebble's, joining a
+    closed pool waits for its jobs.
+    """
+
+    instances = list()
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.scheduled = list()  # (job_details, future)
+        self.active = True
+        self.closed = False
+        self.condition = threading.Condition()
+        FakePool.instances.append(self)
+
+    def notify(self, *args):
+        with self.condition:
+            self.condition.notify_all()
+
+    def schedule(self, function, args=None, timeout=None):
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        self.scheduled.append((args[0], future))
+        future.add_done_callback(self.notify)
+        return future
+
+    def close(self):
+        self.closed = True
+
+    def stop(self):
+        self.active = False
+        self.notify()
+
+    def join(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.active or all(future.done() for _, future in self.scheduled))
+        self.active = False
+
+
+def job(job_id, job_type, framework, classifier_id=None):
+    return dict(job_id=job_id, type=job_type, framework=framework, classifier_id=classifier_id or job_id)
+
+
+class JobSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        FakePool.instances = list()
+        patcher = mock.patch.object(job_scheduler.pebble, "ProcessPool", FakePool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_scheduler(self, **kwargs):
+        scheduler = job_scheduler.JobScheduler(lambda job_details: job_details["job_id"], **kwargs)
+        scheduler.start()
+        return scheduler
+
+    def running_ids(self):
+        return sorted(job_details["job_id"] for pool in FakePool.instances
+                      for job_details, future in pool.scheduled if not future.done())
+
+    def finish(self, job_id):
+        for pool in FakePool.instances:
+            for job_details, future in pool.scheduled:
+                if job_details["job_id"] == job_id:
+                    future.set_result(job_id)
+                    return
+        self.fail("job %s was not scheduled" % job_id)
+
+    def wait_for_start(self, job_id, timeout=1):
+        # for jobs started by the thread joining a retired pool
+        deadline = time.time() + timeout
+        while job_id not in self.running_ids() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn(job_id, self.running_ids())
+
+    def test_jobs_start_up_to_max_workers(self):
+        scheduler = self.make_scheduler(max_workers=2)
+        results = [scheduler.submit(job(str(i), "predict", "spacy")) for i in range(3)]
+        self.assertEqual(self.running_ids(), ["0", "1"])
+        self.assertFalse(scheduler.has_capacity())
+        self.finish("0")
+        self.assertEqual(results[0].result(timeout=1), "0")
+        self.assertEqual(self.running_ids(), ["1", "2"])
+
+    def test_blocked_jobs_do_not_take_worker_slots(self):
+        # one fit running and fits waiting behind it must not keep predicts from being taken on
+        scheduler = self.make_scheduler(max_workers=4, job_type_limits=dict(fit=1))
+        for i in range(4):
+            scheduler.submit(job("fit%d" % i, "fit", "spacy"))
+        self.assertEqual(self.running_ids(), ["fit0"])
+        self.assertEqual(len(scheduler.pending), 3)
+        self.assertTrue(scheduler.has_capacity())
+        scheduler.submit(job("predict", "predict", "spacy"))
+        self.assertEqual(self.running_ids(), ["fit0", "predict"])
+
+    def test_blocked_jobs_are_bounded_by_max_pending(self):
+        scheduler = self.make_scheduler(max_workers=4, job_type_limits=dict(fit=1), max_pending=2)
+        for i in range(3):
+            scheduler.submit(job("fit%d" % i, "fit", "spacy"))
+        self.assertFalse(scheduler.has_capacity())
+        self.assertFalse(scheduler.wait_for_capacity(0.01))
+        self.finish("fit0")
+        self.assertEqual(self.running_ids(), ["fit1"])
+        self.assertTrue(scheduler.wait_for_capacity(0.01))
+
+    def test_waiting_jobs_do_not_hold_up_later_ones(self):
+        scheduler = self.make_scheduler(max_workers=3, framework_limits=dict(corenlp=1))
+        scheduler.submit(job("a", "predict", "corenlp"))
+        scheduler.submit(job("b", "predict", "corenlp"))
+        scheduler.submit(job("c", "predict", "spacy"))
+        self.assertEqual(self.running_ids(), ["a", "c"])
+        self.finish("a")
+        self.assertEqual(self.running_ids(), ["b", "c"])
+
+    def test_same_classifier_never_runs_twice_at_once(self):
+        scheduler = self.make_scheduler(max_workers=4)
+        scheduler.submit(job("fit", "fit", "spacy", classifier_id="c1"))
+        scheduler.submit(job("predict", "predict", "spacy", classifier_id="c1"))
+        self.assertEqual(self.running_ids(), ["fit"])
+        self.finish("fit")
+        self.assertEqual(self.running_ids(), ["predict"])
+
+    def test_failed_job_sets_exception_and_frees_slot(self):
+        scheduler = self.make_scheduler(max_workers=1)
+        result = scheduler.submit(job("a", "predict", "spacy"))
+        scheduler.submit(job("b", "predict", "spacy"))
+        FakePool.instances[0].scheduled[0][1].set_exception(ValueError("boom"))
+        with self.assertRaises(ValueError):
+            result.result(timeout=1)
+        self.assertEqual(self.running_ids(), ["b"])
+        self.assertEqual(scheduler.metrics.as_dict()["predict"]["failed"], 1)
+
+    def test_pool_is_replaced_after_fits(self):
+        scheduler = self.make_scheduler(max_workers=2, restart_after_fits=dict(corenlp=2))
+        scheduler.submit(job("fit0", "fit", "corenlp"))
+        first_pool = FakePool.instances[0]
+        self.assertFalse(first_pool.closed)
+        scheduler.submit(job("fit1", "fit", "corenlp"))
+        # the second fit retires the pool, but still runs on it
+        self.assertTrue(first_pool.closed)
+        self.assertEqual([pool for pool, _, _ in scheduler.retired_pools], [first_pool])
+        self.assertNotIn("corenlp", scheduler.pools)
+        self.assertEqual(len(first_pool.scheduled), 2)
+        self.finish("fit0")
+        scheduler.submit(job("fit2", "fit", "corenlp"))
+        self.assertEqual(len(FakePool.instances), 2)
+        self.assertEqual(FakePool.instances[1].scheduled[0][0]["job_id"], "fit2")
+        # the retired pool is joined, so its processes exit, once its jobs are done
+        self.finish("fit1")
+        scheduler.retired_pools[0][2].join(1)
+        self.assertFalse(first_pool.active)
+        self.assertEqual(scheduler.retired_pools, [])
+
+    def test_idle_pools_are_closed_to_stay_under_max_processes(self):
+        scheduler = self.make_scheduler(max_workers=2, framework_limits=dict(corenlp=1), max_processes=3)
+        scheduler.submit(job("spacy", "predict", "spacy"))
+        scheduler.submit(job("corenlp", "predict", "corenlp"))
+        self.finish("spacy")
+        self.finish("corenlp")
+        spacy_pool, corenlp_pool = FakePool.instances
+        # corenlp's pool was used last
+        scheduler.submit(job("opennlp", "predict", "opennlp"))
+        self.assertTrue(spacy_pool.closed)
+        self.assertFalse(corenlp_pool.closed)
+        # it starts once the closed pool's processes have exited
+        self.wait_for_start("opennlp")
+        self.assertFalse(spacy_pool.active)
+        self.assertEqual(list(scheduler.pools), ["corenlp", "opennlp"])
+
+    def test_jobs_needing_a_new_pool_wait_for_busy_pools(self):
+        scheduler = self.make_scheduler(max_workers=2, max_processes=2)
+        scheduler.submit(job("spacy", "predict", "spacy"))
+        opennlp = scheduler.submit(job("opennlp", "predict", "opennlp"))
+        self.assertEqual(self.running_ids(), ["spacy"])
+        self.assertEqual(len(FakePool.instances), 1)
+        # once the spacy pool is idle it is closed, and the job starts when its processes have exited
+        self.finish("spacy")
+        self.assertTrue(FakePool.instances[0].closed)
+        self.wait_for_start("opennlp")
+        self.finish("opennlp")
+        self.assertEqual(opennlp.result(timeout=1), "opennlp")
+        self.assertFalse(FakePool.instances[0].active)
+
+    def test_predicts_do_not_count_towards_restart(self):
+        scheduler = self.make_scheduler(max_workers=2, restart_after_fits=dict(corenlp=1))
+        scheduler.submit(job("predict", "predict", "corenlp"))
+        self.assertFalse(FakePool.instances[0].closed)
+
+    def test_stop_cancels_pending_and_returns_running_classifiers(self):
+        scheduler = self.make_scheduler(max_workers=1)
+        scheduler.submit(job("a", "predict", "spacy"))
+        waiting = scheduler.submit(job("b", "predict", "spacy"))
+        self.assertEqual(scheduler.stop(), {"a"})
+        self.assertTrue(waiting.cancelled())
+        self.assertFalse(FakePool.instances[0].active)
+
+
+if __name__ == "__main__":
+    unittest.main()
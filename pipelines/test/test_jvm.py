@@ -0,0 +1,165 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import jvm
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "memfds are only supported on Linux")
+class MemoryDataFileTest(unittest.TestCase):
+
+    def test_data_is_kept_in_memory(self):
+        data = "a bé\n" * 100000
+        with jvm.data_file(data, ".train", tempfile.gettempdir()) as path:
+            self.assertTrue(path.startswith("/proc/self/fd/"))
+            # read from the start every time it is opened, like OpenNLP's MarkableFileInputStreamFactory does
+            for _ in range(2):
+                with open(path, encoding="utf-8") as f:
+                    self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(path))
+
+    def test_falls_back_to_disk(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        with mock.patch.object(jvm, "_memfd_create", side_effect=OSError(24, "Too many open files")):
+            with jvm.data_file("data", ".tsv", directory) as path:
+                self.assertEqual(os.path.dirname(path), directory)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_memfd_without_os_memfd_create(self):
+        # Python before 3.8
+        with mock.patch.dict(jvm.os.__dict__):
+            del jvm.os.memfd_create
+            fd = jvm._memfd_create("test")
+        self.addCleanup(os.close, fd)
+        os.write(fd, b"data")
+        with open("/proc/self/fd/{}".format(fd), "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+
+class DataFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        # where memfds aren't supported
+        patcher = mock.patch.object(jvm, "_memfd_create", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_writes_data_and_removes_file(self):
+        with jvm.data_file("a bé\n", ".train", self.directory) as path:
+            self.assertEqual(os.path.dirname(path), self.directory)
+            self.assertTrue(path.endswith(".train"))
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "a bé\n")
+        self.assertFalse(os.path.exists(path))
+
+    def test_removes_file_when_block_raises(self):
+        with self.assertRaises(ValueError):
+            with jvm.data_file("data", ".tsv", self.directory) as path:
+                raise ValueError()
+        self.assertFalse(os.path.exists(path))
+
+    def test_falls_back_to_system_temp_dir_when_directory_is_full(self):
+        real_write = jvm._write
+
+        def write(encoded, suffix, directory):
+            if directory is not None:
+                raise OSError(28, "No space left on device")
+            return real_write(encoded, suffix, directory)
+
+        with mock.patch.object(jvm, "_write", side_effect=write):
+            with jvm.data_file("data", ".tsv", self.directory) as path:
+                self.assertEqual(os.path.dirname(path), tempfile.gettempdir())
+                with open(path) as f:
+                    self.assertEqual(f.read(), "data")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_failed_write_leaves_no_file(self):
+        with mock.patch("os.fdopen", side_effect=OSError(28, "No space left on device")):
+            with self.assertRaises(OSError):
+                jvm._write(b"data", ".tsv", self.directory)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class FakeJniusConfig(object):
+
+    def __init__(self):
+        self.vm_running = False
+        self.options = []
+
+    def get_options(self):
+        return list(self.options)
+
+    def add_options(self, *options):
+        self.options.extend(options)
+
+
+class SharedJvmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.jnius_config = FakeJniusConfig()
+        self.autoclass = mock.Mock(side_effect=lambda class_name: object())
+        patchers = [mock.patch.dict(sys.modules, {"jnius_config": self.jnius_config,
+                                                  "jnius": types.SimpleNamespace(autoclass=self.autoclass)}),
+                    mock.patch.dict(os.environ),
+                    mock.patch.object(jvm, "_classes", dict()),
+                    mock.patch.object(jvm, "_resident", dict())]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_start_configures_jvm_once(self):
+        jvm.start("/jdk", "/lib/*", "2g")
+        self.assertEqual((os.environ["JAVA_HOME"], os.environ["CLASSPATH"]), ("/jdk", "/lib/*"))
+        self.assertEqual(self.jnius_config.options, ["-Xmx2g"])
+        # the options of a JVM that isn't running yet are only added once
+        jvm.start("/jdk", "/lib/*", "4g")
+        self.assertEqual(self.jnius_config.options, ["-Xmx2g"])
+
+    def test_running_jvm_is_reused_with_the_same_classpath(self):
+        jvm.start("/jdk", "/lib/*")
+        self.jnius_config.vm_running = True
+        jvm.start("/jdk", "/lib/*")
+        with self.assertRaises(RuntimeWarning):
+            jvm.start("/jdk", "/other/lib/*")
+
+    def test_classes_are_resolved_once(self):
+        first = jvm.autoclass("java.io.File")
+        self.assertIs(jvm.autoclass("java.io.File"), first)
+        jvm.autoclass("java.lang.String")
+        self.assertEqual([call[0][0] for call in self.autoclass.call_args_list], ["java.io.File", "java.lang.String"])
+
+    def test_resident_objects_are_created_once(self):
+        create = mock.Mock(side_effect=lambda: object())
+        results = []
+
+        def load():
+            results.append(jvm.resident(("model", "path"), create))
+
+        threads = [threading.Thread(target=load) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(create.call_count, 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertIsNot(jvm.resident(("model", "other path"), create), results[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import model_cache
+from pine.pipelines.model_cache import ModelCache
+
+
+class ModelCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def model_file(self, name, size=0):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path
+
+    def test_loads_each_model_once(self):
+        cache = ModelCache(1000, 2)
+        path = self.model_file("m1")
+        load = mock.Mock(return_value="model")
+        self.assertEqual(cache.get_or_load("c1", path, load), "model")
+        self.assertEqual(cache.get_or_load("c1", path, load), "model")
+        load.assert_called_once_with()
+        self.assertEqual(cache.stats, dict(hits=1, misses=1, evictions=0))
+
+    def test_evicts_least_recently_used(self):
+        cache = ModelCache(1000, 2)
+        paths = [self.model_file("m%d" % i) for i in range(3)]
+        cache.put("c0", paths[0], "model 0")
+        cache.put("c1", paths[1], "model 1")
+        cache.get_or_load("c0", paths[0], self.fail)
+        cache.put("c2", paths[2], "model 2")
+        self.assertEqual(list(cache.models), [("c0", paths[0]), ("c2", paths[2])])
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    def test_evicts_to_stay_under_max_bytes(self):
+        cache = ModelCache(250, 10)
+        cache.put("c0", self.model_file("m0", 100), "model 0")
+        cache.put("c1", self.model_file("m1", 100), "model 1")
+        cache.put("c2", self.model_file("m2", 100), "model 2")
+        self.assertEqual([key[0] for key in cache.models], ["c1", "c2"])
+        self.assertEqual(cache.num_bytes, 200)
+
+    def test_new_model_replaces_classifiers_old_one(self):
+        cache = ModelCache(1000, 10)
+        old, new = self.model_file("old", 100), self.model_file("new", 50)
+        cache.put("c1", old, "old model")
+        cache.put("c1", new, "new model")
+        self.assertEqual(list(cache.models), [("c1", new)])
+        self.assertEqual(cache.num_bytes, 50)
+        self.assertEqual(cache.stats["evictions"], 0)
+        cache.invalidate("c1")
+        self.assertEqual((len(cache.models), cache.num_bytes), (0, 0))
+
+    def test_size_is_memory_loaded_or_at_least_size_on_disk(self):
+        cache = ModelCache(10000, 10)
+        directory = os.path.join(self.directory, "spacy-model")
+        os.makedirs(os.path.join(directory, "ner"))
+        for name, size in (("meta.json", 10), (os.path.join("ner", "model"), 90)):
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(b"x" * size)
+        with mock.patch.object(model_cache, "_get_rss", side_effect=[1000, 3000]):
+            cache.get_or_load("c1", self.model_file("m1", 100), lambda: "model 1")
+        # a directory's files are added up
+        with mock.patch.object(model_cache, "_get_rss", side_effect=[1000, 1010]):
+            cache.get_or_load("c2", directory, lambda: "model 2")
+        self.assertEqual([size for _, size in cache.models.values()], [2000, 100])
+        self.assertEqual(cache.num_bytes, 2100)
+
+    def test_models_too_large_or_disabled_cache_are_not_kept(self):
+        cache = ModelCache(50, 10)
+        cache.put("c1", self.model_file("m1", 100), "model 1")
+        self.assertEqual((len(cache.models), cache.num_bytes), (0, 0))
+        disabled = ModelCache(1000, 0)
+        load = mock.Mock(return_value="model")
+        path = self.model_file("m2")
+        disabled.get_or_load("c1", path, load)
+        disabled.get_or_load("c1", path, load)
+        self.assertEqual(load.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
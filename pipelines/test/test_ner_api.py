@@ -0,0 +1,94 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import multiprocessing
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import NER_API
+
+
+class WarmStartTest(unittest.TestCase):
+
+    def setUp(self):
+        # the methods tested don't use eve
+        self.api = NER_API.ner_api.__new__(NER_API.ner_api)
+        self.classifier = mock.Mock()
+        self.classifier.supports_warm_start.return_value = True
+        patcher = mock.patch.multiple(NER_API.config, WARM_START_ENABLED=True, WARM_START_FULL_RETRAIN_EVERY=5,
+                                      WARM_START_REPLAY_RATIO=1.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_new_and_edited_annotations_are_trained(self):
+        metrics = {'annotations': ['a1', 'a2', 'a3', 'a4'], 'annotations_updated': ['t1', 't1', 't1', 't1']}
+        documents = ['d1', 'd2', 'd3', 'd4', 'd5']
+        labels = ['l1', 'l2', 'l3', 'l4', 'l5']
+        # a2 was edited in place (same id, newer _updated), a5 is new
+        ann_ids = ['a1', 'a2', 'a3', 'a4', 'a5']
+        ann_updated = ['t1', 't2', 't1', 't1', 't1']
+        train_documents, train_labels = self.api.get_warm_start_data(metrics, documents, labels, ann_ids, ann_updated)
+        self.assertEqual(train_documents[:2], ['d2', 'd5'])
+        self.assertEqual(train_labels[:2], ['l2', 'l5'])
+        # as many unchanged ones replayed
+        self.assertEqual(len(train_documents), 4)
+        self.assertTrue(set(train_documents[2:]) <= {'d1', 'd3', 'd4'})
+
+    def test_training_mode(self):
+        classifier_obj = {'filename': 'model'}
+        metrics = {'annotations': ['a1'], 'annotations_updated': ['t1'], 'increments_since_full_train': 1}
+        self.assertEqual(self.api.get_training_mode(self.classifier, classifier_obj, metrics), 'warm_start')
+        self.assertEqual(self.api.get_training_mode(self.classifier, {}, metrics), 'full')
+        # every WARM_START_FULL_RETRAIN_EVERY-th training
+        self.assertEqual(self.api.get_training_mode(self.classifier, classifier_obj,
+                                                    dict(metrics, increments_since_full_train=4)), 'full')
+        # metrics saved without the annotations' _updated
+        self.assertEqual(self.api.get_training_mode(self.classifier, classifier_obj, {'annotations': ['a1']}), 'full')
+        self.classifier.supports_warm_start.return_value = False
+        self.assertEqual(self.api.get_training_mode(self.classifier, classifier_obj, metrics), 'full')
+
+
+class PredictTest(unittest.TestCase):
+
+    def test_cached_model_does_not_keep_tokens(self):
+        api = NER_API.ner_api.__new__(NER_API.ner_api)
+        api.model_dir = "models"
+        api.eve_client = mock.Mock()
+        classifier = mock.Mock()
+        classifier.tokenizer_name.return_value = "test"
+        classifier.predict.return_value = {"d1": []}
+        with mock.patch.object(api, "get_classifier_pipeline_metrics_objs",
+                               return_value=({"filename": "m1", "collection_id": "c1"}, {}, {})), \
+                mock.patch.object(NER_API.os.path, "exists", return_value=True), \
+                mock.patch.object(NER_API.MODEL_CACHE, "get_or_load", return_value=classifier), \
+                mock.patch.object(NER_API.parsed, "get_tokens", return_value={"d1": [(0, 4)]}):
+            self.assertEqual(api.predict("c1", "spacy", ["text"], ["d1"]), {"d1": []})
+        self.assertEqual(classifier.set_tokens.call_args_list, [mock.call({"text": [(0, 4)]}), mock.call({})])
+
+
+def _fold_worker_pids(results):
+    with NER_API.ner_api.fold_pool() as pool:
+        fold_pid = pool.apply(os.getpid)
+    results.put((os.getpid(), fold_pid))
+
+
+class FoldPoolTest(unittest.TestCase):
+
+    def test_folds_run_in_daemonic_workers(self):
+        # like a job in one of the pipeline service's (daemonic) pool processes
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_fold_worker_pids, args=(results,), daemon=True)
+        process.start()
+        job_pid, fold_pid = results.get(timeout=60)
+        process.join(60)
+        self.assertEqual(fold_pid, job_pid)
+
+
+if __name__ == "__main__":
+    unittest.main()
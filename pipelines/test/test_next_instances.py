@@ -0,0 +1,56 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import next_instances
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class SaveRankingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r_conn = fakeredis.FakeStrictRedis(decode_responses=True)
+        patcher = mock.patch.object(next_instances, "_get_connection", return_value=self.r_conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def key(self, *parts):
+        return ":".join([next_instances.KEY_PREFIX + "c1"] + list(parts))
+
+    def test_ranking_replaces_loaded_queue(self):
+        self.r_conn.hset(self.key("meta"), "eve_id", "n1")
+        self.r_conn.zadd(self.key("documents"), {"old": 0})
+        ranking = ["d%d" % i for i in range(next_instances.ZADD_CHUNK_SIZE + 5)]
+        self.assertTrue(next_instances.save_ranking("c1", "document_ids", ranking))
+        # in the order of the list saved to eve, which the backend serves from its end
+        self.assertEqual(self.r_conn.zrange(self.key("documents"), 0, -1), ranking)
+        self.assertEqual(self.r_conn.smembers(next_instances.DIRTY_KEY), {"c1"})
+        self.assertEqual(self.r_conn.keys(self.key("documents", "new", "*")), [])
+
+    def test_empty_ranking_empties_queue(self):
+        self.r_conn.hset(self.key("meta"), "eve_id", "n1")
+        self.r_conn.zadd(self.key("head"), {"d1": 0})
+        self.assertTrue(next_instances.save_ranking("c1", "head_document_ids", []))
+        self.assertFalse(self.r_conn.exists(self.key("head")))
+
+    def test_ranking_is_dropped_if_queues_are_not_loaded(self):
+        # to be saved to eve, where the backend loads the queues from
+        self.assertFalse(next_instances.save_ranking("c1", "document_ids", ["d1", "d2"]))
+        self.assertEqual(self.r_conn.keys("*"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines.opennlp_NER_pipeline import opennlp_NER
+
+DOCUMENTS = [
+    "Alice met Bob in Paris.  Yes. Yes.\nThen Bob left, Bob's car too!",
+    "  Leading spaces... and  double  spaces? Zoë went to Zürich.",
+    "",
+    "no sentence end"
+]
+
+
+class FakeSpan(object):
+
+    def __init__(self, start, end, type=None, prob=None):
+        self.start, self.end, self.type, self.prob = start, end, type, prob
+
+    def getStart(self):
+        return self.start
+
+    def getEnd(self):
+        return self.end
+
+    def getType(self):
+        return self.type
+
+    def getProb(self):
+        return self.prob
+
+
+class FakeSentenceDetector(object):
+    # like OpenNLP's, sentDetect returns the substrings at sentPosDetect's spans
+
+    def sentPosDetect(self, doc):
+        return [FakeSpan(m.start(), m.end()) for m in re.finditer(r"[^\s.!?][^.!?]*[.!?]*", doc)]
+
+    def sentDetect(self, doc):
+        return [doc[s.getStart():s.getEnd()] for s in self.sentPosDetect(doc)]
+
+
+class FakeTokenizer(object):
+
+    def tokenizePos(self, sent):
+        return [FakeSpan(m.start(), m.end()) for m in re.finditer(r"\w+|[^\w\s]", sent)]
+
+    def tokenize(self, sent):
+        return [sent[t.getStart():t.getEnd()] for t in self.tokenizePos(sent)]
+
+
+class FakeNameFinder(object):
+    # every capitalized token is a name
+
+    def __init__(self):
+        self.calls = []
+
+    def find(self, tokens):
+        self.calls.append(list(tokens))
+        return [FakeSpan(i, i + 1, "NAME", 0.5) for i, tok in enumerate(tokens) if tok[:1].isupper()]
+
+    def clearAdaptiveData(self):
+        pass
+
+
+def old_tokenize(doc):
+    # the sentence and token spans predict and format_data used, with the offsets taken from the span objects
+    sentences = []
+    for s in FakeSentenceDetector().sentPosDetect(doc):
+        tokens = FakeTokenizer().tokenizePos(doc[s.getStart():s.getEnd()])
+        sentences.append([(s.getStart() + t.getStart(), s.getStart() + t.getEnd()) for t in tokens])
+    return sentences
+
+
+class TokenizeSentencesTest(unittest.TestCase):
+
+    def setUp(self):
+        # the methods tested don't use the JVM
+        self.pipeline = opennlp_NER.__new__(opennlp_NER)
+        self.pipeline._opennlp_NER__sentenceDetector = FakeSentenceDetector()
+        self.pipeline._opennlp_NER__tokenizer = FakeTokenizer()
+        self.name_finder = FakeNameFinder()
+        self.pipeline._opennlp_NER__nameFinder = self.name_finder
+
+    def test_offsets_match_spans(self):
+        for doc in DOCUMENTS:
+            sentences = self.pipeline._opennlp_NER__tokenize_sentences(doc)
+            self.assertEqual([[(start, end) for start, end, _ in sentence] for sentence in sentences], old_tokenize(doc))
+            for sentence in sentences:
+                for start, end, tok in sentence:
+                    self.assertEqual(doc[start:end], tok)
+
+    def test_predict_returns_tokens_of_every_sentence(self):
+        doc_ids = ["d%d" % i for i in range(len(DOCUMENTS))]
+        predictions = self.pipeline.predict(DOCUMENTS, doc_ids)
+        for doc, doc_id in zip(DOCUMENTS, doc_ids):
+            tokens = [token for sentence in old_tokenize(doc) for token in sentence]
+            self.assertEqual(predictions[doc_id][1], tokens)
+            names = [(start, end, "NAME") for start, end in tokens if doc[start].isupper()]
+            self.assertEqual(predictions[doc_id][0], names)
+        # one call per sentence, none for empty documents
+        self.assertEqual(len(self.name_finder.calls), sum(len(old_tokenize(doc)) for doc in DOCUMENTS))
+
+    def test_predict_proba(self):
+        predictions = self.pipeline.predict_proba(DOCUMENTS[:1], ["d0"])
+        self.assertEqual(predictions["d0"][:2], [(0, 5, "NAME", 0.5), (10, 13, "NAME", 0.5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
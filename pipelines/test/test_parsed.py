@@ -0,0 +1,91 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import parsed
+
+
+def tokenize(text):
+    offsets, start = [], 0
+    for word in text.split(" "):
+        offsets.append((start, start + len(word)))
+        start += len(word) + 1
+    return offsets
+
+
+class FakeEveClient(object):
+
+    def __init__(self, items=None):
+        self.items = dict(items or {})
+        self.added = list()
+        self.replaced = list()
+
+    def get_parsed(self, doc_ids, chunk_size=100):
+        return {doc_id: self.items[doc_id] for doc_id in doc_ids if doc_id in self.items}
+
+    def add_all(self, resource, add_objects):
+        self.added.append(list(add_objects))
+        return True
+
+    def replace(self, resource, id, etag, replace_obj):
+        self.replaced.append((id, etag, replace_obj))
+        return True
+
+
+class ParsedTest(unittest.TestCase):
+
+    def test_offsets_round_trip(self):
+        tokens = [(0, 3), (4, 10), (11, 2 ** 20)]
+        self.assertEqual(parsed.decode_offsets(parsed.encode_offsets(tokens)), tokens)
+        self.assertEqual(parsed.decode_offsets(parsed.encode_offsets([])), [])
+
+    def test_reads_saved_tokens(self):
+        text = "a saved text"
+        eve_client = FakeEveClient({"d1": {"_id": "d1", "_etag": "e", "text_hash": parsed.text_hash(text),
+                                           "tokens": {"test": parsed.encode_offsets([(0, 12)])}}})
+        tokens = parsed.get_tokens(eve_client, "c1", ["d1"], [text], "test",
+                                   lambda text: self.fail("tokenized again"))
+        self.assertEqual(tokens, {"d1": [(0, 12)]})
+        self.assertEqual((eve_client.added, eve_client.replaced), ([], []))
+
+    def test_new_documents_are_added_in_chunks(self):
+        eve_client = FakeEveClient()
+        doc_ids = ["d%d" % i for i in range(parsed.CHUNK_SIZE + 1)]
+        texts = ["text number %d" % i for i in range(len(doc_ids))]
+        tokens = parsed.get_tokens(eve_client, "c1", doc_ids, texts, "test", tokenize)
+        self.assertEqual(tokens["d3"], [(0, 4), (5, 11), (12, 13)])
+        self.assertEqual([len(chunk) for chunk in eve_client.added], [parsed.CHUNK_SIZE, 1])
+        item = eve_client.added[0][3]
+        self.assertEqual(item["_id"], "d3")
+        self.assertEqual(item["collection_id"], "c1")
+        self.assertEqual(item["text_hash"], parsed.text_hash(texts[3]))
+        self.assertEqual(parsed.decode_offsets(item["tokens"]["test"]), tokens["d3"])
+
+    def test_stale_and_incomplete_items_are_replaced(self):
+        eve_client = FakeEveClient({
+            # the text changed: the other tokenizer's tokens are gone too
+            "changed": {"_id": "changed", "_etag": "e1", "text_hash": parsed.text_hash("old text"),
+                        "tokens": {"other": "x", "test": "y"}},
+            # added by the backend, without this tokenizer's tokens
+            "other": {"_id": "other", "_etag": "e2", "text_hash": parsed.text_hash("other text"),
+                      "tokens": {"whitespace": "z"}}
+        })
+        parsed.get_tokens(eve_client, "c1", ["changed", "other"], ["new text", "other text"], "test", tokenize)
+        self.assertEqual(eve_client.added, [])
+        replaced = {doc_id: (etag, item) for doc_id, etag, item in eve_client.replaced}
+        self.assertEqual(replaced["changed"][0], "e1")
+        self.assertEqual(sorted(replaced["changed"][1]["tokens"]), ["test"])
+        self.assertEqual(replaced["other"][0], "e2")
+        self.assertEqual(sorted(replaced["other"][1]["tokens"]), ["test", "whitespace"])
+        self.assertEqual(replaced["other"][1]["tokens"]["whitespace"], "z")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines import RankingFunctions as rank
+
+LABELS = ["PER", "ORG", "LOC", "O"]
+
+
+def make_results(rng, num_docs, all_labels):
+    # probabilities are multiples of 1/8, so that sums are exact whatever their order and many documents tie
+    results = {}
+    for doc in range(num_docs):
+        ents = []
+        for i in range(rng.randint(0, 4)):
+            if all_labels:
+                probs = sorted([rng.randint(0, 8) for _ in LABELS], reverse=True)
+                ents.append((i * 10, i * 10 + 5, [(label, prob / 8) for label, prob in zip(LABELS, probs)]))
+            else:
+                ents.append((i * 10, i * 10 + 5, rng.choice(LABELS), rng.randint(0, 8) / 8))
+        results["doc{}".format(doc)] = ents
+    return results
+
+
+def old_least_confidence(results, square):
+    # the per-entity loop of least_confidence and least_confidence_squared before they were vectorized
+    ranking = []
+    for key in results:
+        confidence = 0
+        numel = 0
+        for ent in results[key]:
+            prob = max(alt[1] for alt in ent[2]) if type(ent[2]) is list else ent[3]
+            confidence += prob ** 2 if square else prob
+            numel += 1
+        if numel > 0:
+            confidence /= numel
+        ranking.append((key, confidence))
+    ranking.sort(key=lambda tup: tup[1])
+    return ranking
+
+
+class RankingTest(unittest.TestCase):
+
+    def test_least_confidence_matches_old_loop(self):
+        rng = random.Random(0)
+        for all_labels in (False, True):
+            results = make_results(rng, 200, all_labels)
+            self.assertEqual(rank.rank(results, 'lc'), old_least_confidence(results, False))
+            self.assertEqual(rank.rank(results, 'lcs'), [key for key, _ in old_least_confidence(results, True)])
+
+    def test_top_k_matches_full_ranking(self):
+        rng = random.Random(1)
+        for all_labels in (False, True):
+            results = make_results(rng, 200, all_labels)
+            packed = rank.pack(results)
+            metrics = ['lc', 'lcs', 'lce', 'mlp'] + (['ma', 'en'] if all_labels else [])
+            for metric in metrics:
+                ranking = rank.rank(packed, metric)
+                for k in (0, 1, 7, 50, 199, 200, 500):
+                    head, rank_tail = rank.rank_top_k(results, metric, k)
+                    self.assertEqual(head, ranking[:k], (metric, k))
+                    self.assertEqual(rank_tail(), ranking[k:], (metric, k))
+
+    def test_top_k_of_unknown_metric(self):
+        self.assertEqual(rank.rank_top_k({}, 'unknown', 10), (-1, None))
+        self.assertEqual(rank.rank_top_k({}, 'lc', 10)[0], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import json
+import os
+import sys
+import unittest
+from concurrent import futures
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines.app.listener import job_scheduler
+from pine.pipelines.app.listener.service_listener import ServiceListener
+
+QUEUE = "test:registration:work-queue:pipeline"
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ClaimJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r_conn = fakeredis.FakeStrictRedis(decode_responses=True)
+        # the methods tested only use redis
+        self.listener = ServiceListener.__new__(ServiceListener)
+        self.listener.r_conn = self.r_conn
+        self.listener.claim_job_script = self.r_conn.register_script(ServiceListener.claim_job_script.script)
+
+    def queue_job(self, job_id, job_data):
+        # as the backend's ServiceManager.send_service_request does
+        self.r_conn.hset(QUEUE + ServiceListener.job_key_infix + job_id,
+                         mapping={"job_id": job_id, "job_type": "request", "job_queue": QUEUE,
+                                  "job_data": json.dumps(job_data)})
+        self.r_conn.rpush(QUEUE, job_id)
+
+    def publish(self, job_id):
+        return self.listener.pre_process_message("channel", json.dumps({"job_id": job_id, "job_type": "request",
+                                                                        "job_queue": QUEUE}))
+
+    def test_claim_takes_the_job_out_of_the_queue(self):
+        self.queue_job("j1", {"type": "fit", "framework": "spacy"})
+        self.queue_job("j2", {"type": "predict", "framework": "spacy"})
+        job_data = self.publish("j2")
+        # what the LRANGE scan under the preprocessing lock returned
+        self.assertEqual(job_data, {"type": "predict", "framework": "spacy", "job_id": "j2", "job_channel": "channel",
+                                    "job_queue": QUEUE})
+        self.assertEqual(self.r_conn.lrange(QUEUE, 0, -1), ["j1"])
+        self.assertFalse(self.r_conn.exists(QUEUE + ServiceListener.job_key_infix + "j2"))
+        self.assertEqual(self.publish("j1")["job_id"], "j1")
+        self.assertEqual(self.r_conn.lrange(QUEUE, 0, -1), [])
+
+    def test_a_job_is_claimed_once(self):
+        self.queue_job("j1", {"type": "fit"})
+        self.assertTrue(self.publish("j1"))
+        self.assertFalse(self.publish("j1"))
+
+    def test_unknown_and_invalid_jobs_are_not_claimed(self):
+        self.queue_job("j1", {"type": "fit"})
+        self.assertFalse(self.publish("j2"))
+        self.assertFalse(self.listener.pre_process_message("channel", "not json"))
+        self.assertFalse(self.listener.pre_process_message("channel", json.dumps({"job_id": "j1", "job_type": "other",
+                                                                                  "job_queue": QUEUE})))
+        self.assertEqual(self.r_conn.lrange(QUEUE, 0, -1), ["j1"])
+
+    def test_job_id_must_match(self):
+        # a payload for another job under this job's key is dropped, as when the scan found a mismatching entry
+        self.queue_job("j1", {"type": "fit"})
+        self.r_conn.hset(QUEUE + ServiceListener.job_key_infix + "j1", "job_id", "j2")
+        self.assertFalse(self.publish("j1"))
+
+
+class FakePool(object):
+    """
+    Stands in for pebble.ProcessPool: scheduled jobs run when the test finishes them, and like pebble's, stopping the
+    pool leaves the futures of the jobs it terminated pending.
+    """
+
+    def __init__(self, max_workers):
+        self.scheduled = dict()  # job_id -> future
+
+    def schedule(self, function, args=None, timeout=None):
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        self.scheduled[args[0]["job_id"]] = future
+        return future
+
+    def close(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RecoverJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r_conn = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.listener = ServiceListener.__new__(ServiceListener)
+        self.listener.r_conn = self.r_conn
+        self.listener.event_driven = True
+        self.listener.recover_jobs_script = self.r_conn.register_script(ServiceListener.recover_jobs_script.script)
+        for thread in ("registration_thread", "channel_thread", "listener_thread", "queue_processor_thread"):
+            setattr(self.listener, thread, None)
+        patcher = mock.patch.object(job_scheduler.pebble, "ProcessPool", FakePool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.listener.scheduler = job_scheduler.JobScheduler(lambda job_details: True, 1, max_pending=2)
+        self.listener.scheduler.start()
+
+    def queued_ids(self):
+        # in the order they are consumed in
+        return [json.loads(job)["job_id"] for job in reversed(self.r_conn.lrange(ServiceListener.processing_queue_key, 0, -1))]
+
+    def test_stop_puts_waiting_and_running_jobs_back(self):
+        queue, processing = ServiceListener.processing_queue_key, ServiceListener.processing_list_key
+        for job in ("j1", "j2", "j3", "j4"):
+            self.listener.enqueue_job({"job_id": job, "type": "fit", "framework": "spacy", "classifier_id": job})
+        done = self.listener.claim_next_job(1)
+        pool = self.listener.scheduler.pools["spacy"]
+        pool.scheduled["j1"].set_result(True)
+        self.assertTrue(done.done())
+        failed = self.listener.claim_next_job(1)
+        pool.scheduled["j2"].set_exception(ValueError())
+        self.assertIsInstance(failed.exception(), ValueError)
+        running = self.listener.claim_next_job(1)
+        waiting = self.listener.claim_next_job(1)
+        # finished jobs left the in-progress list, whatever their outcome
+        self.assertEqual(self.r_conn.llen(processing), 2)
+        self.listener.stop_workers()
+        self.assertTrue(waiting.cancelled())
+        self.assertIsInstance(running.exception(), job_scheduler.JobInterrupted)
+        self.assertEqual(self.r_conn.llen(processing), 0)
+        self.assertEqual(self.queued_ids(), ["j3", "j4"])
+        self.assertFalse(self.r_conn.exists(ServiceListener.heartbeat_key))
+
+    def test_abandoned_lists_are_recovered(self):
+        queue = ServiceListener.processing_queue_key
+        prefix = ServiceListener.processing_list_key_prefix
+        self.r_conn.rpush(prefix + "crashed", json.dumps({"job_id": "j1"}))
+        self.r_conn.rpush(prefix + "alive", json.dumps({"job_id": "j2"}))
+        self.r_conn.set(ServiceListener.heartbeat_key_prefix + "alive", 1)
+        self.r_conn.rpush(ServiceListener.processing_list_key, json.dumps({"job_id": "j3"}))
+        self.listener.send_heartbeat()
+        self.assertEqual(self.listener.recover_processing_jobs(abandoned_only=True), 1)
+        self.assertEqual(self.queued_ids(), ["j1"])
+        self.assertEqual(self.r_conn.llen(prefix + "alive"), 1)
+        self.assertEqual(self.r_conn.llen(ServiceListener.processing_list_key), 1)
+        self.assertGreater(self.r_conn.ttl(ServiceListener.heartbeat_key), 0)
+        # on start, this worker's own list is recovered too
+        self.assertEqual(self.listener.recover_processing_jobs(), 1)
+        # ahead of the jobs already in the queue
+        self.assertEqual(self.queued_ids(), ["j3", "j1"])
+        self.assertGreater(self.r_conn.ttl(queue), 0)
+
+    def test_unfinished_jobs_go_back_to_the_front_of_the_queue(self):
+        queue, processing = ServiceListener.processing_queue_key, ServiceListener.processing_list_key
+        for job in ("j1", "j2", "j3"):
+            self.listener.enqueue_job({"job_id": job})
+        # j1 and j2 were taken (BRPOPLPUSH) by a worker that crashed while running them
+        self.r_conn.rpoplpush(queue, processing)
+        self.r_conn.rpoplpush(queue, processing)
+        self.assertEqual(self.listener.recover_processing_jobs(), 2)
+        self.assertEqual(self.r_conn.llen(processing), 0)
+        self.assertGreater(self.r_conn.ttl(queue), 0)
+        # consumed in the order they were queued in, before the jobs queued after them
+        consumed = [json.loads(self.r_conn.rpop(queue))["job_id"] for _ in range(3)]
+        self.assertEqual(consumed, ["j1", "j2", "j3"])
+        self.assertEqual(self.listener.recover_processing_jobs(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
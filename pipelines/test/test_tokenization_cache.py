@@ -0,0 +1,83 @@
+# (C) 2019 The Johns Hopkins University Applied Physics Laboratory LLC.
+
+# Run from the pipelines directory with
+#   pipenv run python -m unittest discover -s test
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pine.pipelines.tokenization_cache import TokenizationCache
+
+
+def tokenize(text):
+    return text.split()
+
+
+class TokenizationCacheTest(unittest.TestCase):
+
+    def test_tokenizes_each_text_once(self):
+        cache = TokenizationCache("test", 10)
+        calls = list()
+
+        def counting_tokenize(text):
+            calls.append(text)
+            return tokenize(text)
+
+        self.assertEqual(cache.get_or_tokenize("a b", counting_tokenize), ["a", "b"])
+        self.assertEqual(cache.get_or_tokenize("a b", counting_tokenize), ["a", "b"])
+        self.assertEqual(calls, ["a b"])
+        self.assertEqual(cache.stats, dict(hits=1, store_hits=0, misses=1))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_evicts_least_recently_used(self):
+        cache = TokenizationCache("test", 2)
+        cache.get_or_tokenize("a", tokenize)
+        cache.get_or_tokenize("b", tokenize)
+        cache.get_or_tokenize("a", tokenize)
+        cache.get_or_tokenize("c", tokenize)
+        self.assertEqual(len(cache.tokens), 2)
+        self.assertIn(cache._key("a"), cache.tokens)
+        self.assertNotIn(cache._key("b"), cache.tokens)
+
+    def test_store_is_shared_between_caches(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, "tokens.db")
+        TokenizationCache("test", 10, path).get_or_tokenize("a b", tokenize)
+        cache = TokenizationCache("test", 10, path)
+        self.assertEqual(cache.get_or_tokenize("a b", lambda text: self.fail("tokenized again")), ["a", "b"])
+        self.assertEqual(cache.stats["store_hits"], 1)
+        # other tokenizers don't see them
+        other = TokenizationCache("other", 10, path)
+        self.assertEqual(other.get_or_tokenize("a b", lambda text: ["ab"]), ["ab"])
+
+    def test_tokenizes_without_holding_the_lock(self):
+        cache = TokenizationCache("test", 10)
+        first_started = threading.Event()
+        second_done = threading.Event()
+
+        def slow_tokenize(text):
+            first_started.set()
+            # only returns once the other thread got through the cache
+            self.assertTrue(second_done.wait(5))
+            return tokenize(text)
+
+        thread = threading.Thread(target=cache.get_or_tokenize, args=("slow text", slow_tokenize))
+        thread.start()
+        self.assertTrue(first_started.wait(5))
+        self.assertEqual(cache.get_or_tokenize("fast text", tokenize), ["fast", "text"])
+        second_done.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(cache.get_or_tokenize("slow text", tokenize), ["slow", "text"])
+        self.assertEqual(cache.stats["misses"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()